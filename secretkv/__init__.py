@@ -1,2 +1,53 @@
-from secretkv.application import SecretKV as SecretKV  # noqa: F401
-from secretkv.presentation import delete, get, list, set  # noqa: F401
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from secretkv.application import SecretKV as SecretKV  # noqa: F401
+    from secretkv.presentation import (  # noqa: F401
+        agent,
+        batch,
+        bench,
+        compact,
+        delete,
+        dump,
+        get,
+        init,
+        list,
+        rekey,
+        reshard,
+        restore,
+        retention,
+        serve,
+        set,
+    )
+
+_LAZY_ATTRIBUTES = {
+    "SecretKV": "secretkv.application",
+    "agent": "secretkv.presentation",
+    "batch": "secretkv.presentation",
+    "bench": "secretkv.presentation",
+    "compact": "secretkv.presentation",
+    "delete": "secretkv.presentation",
+    "dump": "secretkv.presentation",
+    "get": "secretkv.presentation",
+    "init": "secretkv.presentation",
+    "list": "secretkv.presentation",
+    "rekey": "secretkv.presentation",
+    "reshard": "secretkv.presentation",
+    "restore": "secretkv.presentation",
+    "retention": "secretkv.presentation",
+    "serve": "secretkv.presentation",
+    "set": "secretkv.presentation",
+}
+
+
+def __getattr__(name: str) -> Any:
+    # Importing the application pulls in cryptography, which dominates the
+    # startup time of `skv --help`; only pay for it when it's actually used.
+    if module := _LAZY_ATTRIBUTES.get(name):
+        import importlib
+
+        value = getattr(importlib.import_module(module), name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Generic, List, Optional, Sequence, Tuple, TypeVar
+
+from secretkv import config
+from secretkv.application import Repository, deletions, key_matches, key_names, name_records
+from secretkv.crypto import Crypto, EncryptedStr, name_index
+from secretkv.domain import Secret
+
+T = TypeVar("T")
+
+
+class AsyncRepository(ABC):
+    @abstractmethod
+    async def list_latest_version(self, include_deleted: bool = True) -> List[Secret]:
+        ...
+
+    @abstractmethod
+    async def retrieve_by_key(self, key: EncryptedStr) -> Optional[Secret]:
+        ...
+
+    @abstractmethod
+    async def retireve_history_from_key(self, key: EncryptedStr) -> List[Secret]:
+        ...
+
+    @abstractmethod
+    async def save(self, secret: Secret) -> bool:
+        ...
+
+    @abstractmethod
+    async def is_empty(self) -> bool:
+        ...
+
+    async def load(self) -> None:
+        ...
+
+    async def get_meta(self, name: str) -> Any:
+        return None
+
+    async def retrieve_many(self, keys: Sequence[EncryptedStr]) -> List[Optional[Secret]]:
+        return [await self.retrieve_by_key(key) for key in keys]
+
+    async def save_many(self, secrets: Sequence[Secret]) -> bool:
+        return all([await self.save(secret) for secret in secrets])
+
+
+class ExecutorRepository(AsyncRepository):
+    """Runs a synchronous repository on its own worker thread.
+
+    The repository is built by `factory` on that thread and only ever touched
+    from it, so stores with thread-bound handles (sqlite) work unchanged and
+    calls never interleave.
+    """
+
+    def __init__(self, factory: Callable[[], Repository]) -> None:
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="skv-store")
+        self._repository = self._executor.submit(factory)
+
+    async def list_latest_version(self, include_deleted: bool = True) -> List[Secret]:
+        return await self._run(lambda repository: repository.list_latest_version(include_deleted))
+
+    async def retrieve_by_key(self, key: EncryptedStr) -> Optional[Secret]:
+        return await self._run(lambda repository: repository.retrieve_by_key(key))
+
+    async def retireve_history_from_key(self, key: EncryptedStr) -> List[Secret]:
+        return await self._run(lambda repository: repository.retireve_history_from_key(key))
+
+    async def save(self, secret: Secret) -> bool:
+        return await self._run(lambda repository: repository.save(secret))
+
+    async def is_empty(self) -> bool:
+        return await self._run(lambda repository: repository.is_empty())
+
+    async def load(self) -> None:
+        # Every repository reads its backing store on first access.
+        await self.is_empty()
+
+    async def get_meta(self, name: str) -> Any:
+        return await self._run(lambda repository: repository.get_meta(name))
+
+    async def retrieve_many(self, keys: Sequence[EncryptedStr]) -> List[Optional[Secret]]:
+        return await self._run(lambda repository: repository.retrieve_many(keys))
+
+    async def save_many(self, secrets: Sequence[Secret]) -> bool:
+        return await self._run(lambda repository: repository.save_many(secrets))
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, func: Callable[[Repository], T]) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(self._repository.result()))
+
+
+class SingleFlight(Generic[T]):
+    """Shares one in-flight call of `func` between every concurrent awaiter.
+
+    The result is kept once it succeeds; a failure is handed to everybody that
+    was waiting and the next call starts over.
+    """
+
+    def __init__(self, func: Callable[[], Awaitable[T]]) -> None:
+        self._func = func
+        self._task: Optional[asyncio.Future[T]] = None
+
+    async def __call__(self) -> T:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._func())
+
+        task = self._task
+        try:
+            # One caller being cancelled mustn't cancel the others' work.
+            return await asyncio.shield(task)
+        except BaseException:
+            if task.done() and (task.cancelled() or task.exception()) and self._task is task:
+                self._task = None
+            raise
+
+    def reset(self) -> None:
+        self._task = None
+
+
+class AsyncSecretKV:
+    def __init__(
+        self,
+        repository: AsyncRepository,
+        crypto: Crypto,
+        password: Optional[str] = None,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        self._repository = repository
+        self._crypto = crypto
+        self._executor = executor
+        self._password = password
+        self._derive_key = SingleFlight(self._configure)
+        self._load_store = SingleFlight(self._repository.load)
+
+    @property
+    def crypto(self) -> Crypto:
+        return self._crypto
+
+    def configure(self, password: str) -> None:
+        self._password = password
+        self._derive_key.reset()
+
+    async def verify_password(self) -> bool:
+        """False for a vault from before blind indexes too, until a SecretKV migrates it."""
+        await self._ready()
+        if await self._repository.is_empty():
+            await self.create_or_append(config.TAG, config.TAG[::-1])
+            return True
+
+        return bool(await self.get_value_from_key(config.TAG))
+
+    async def list_every_key(
+        self,
+        include_deleted: bool = False,
+        prefix: str = "",
+        glob: Optional[str] = None,
+    ) -> List[str]:
+        """Every key name, or those starting with `prefix` and matching the shell pattern `glob`."""
+        await self._ready()
+        secrets = await self._repository.list_latest_version(include_deleted)
+        names = await self._run(self._crypto.decrypt_many, key_names(secrets))
+        return [name for name in names if key_matches(name, prefix, glob)]
+
+    async def get_history_from_key(self, key: str) -> List[str]:
+        secrets = await self._repository.retireve_history_from_key(await self._encrypt_key(key))
+        return await self._run(self._crypto.decrypt_many, [secret.val for secret in secrets])
+
+    async def get_value_from_key(self, key: str) -> Optional[str]:
+        if (secret := await self._repository.retrieve_by_key(await self._encrypt_key(key))) and not secret.deleted:
+            return await self._run(self._crypto.decrypt, secret.val)
+        return None
+
+    async def create_or_append(self, key: str, val: str) -> Optional[str]:
+        await self._ready()
+        enc_key, enc_val = await asyncio.gather(self._encrypt_key(key), self._run(self._crypto.encrypt, val))
+        secret = Secret(enc_key, enc_val)
+        names = await self._name_records([enc_key], [key])
+        if await (self._repository.save_many([*names, secret]) if names else self._repository.save(secret)):
+            return key
+        return None
+
+    async def mark_as_deleted(self, key: str) -> Optional[str]:
+        enc_key = await self._encrypt_key(key)
+        if (secret := await self._repository.retrieve_by_key(enc_key)) and not secret.deleted:
+            if await self._repository.save(Secret(enc_key, await self._run(self._crypto.encrypt, ""), deleted=True)):
+                return key
+        return None
+
+    async def get_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        await self._ready()
+        encrypted = await self._run(self._crypto.index_many, keys)
+        found = [
+            secret if secret and not secret.deleted else None
+            for secret in await self._repository.retrieve_many(encrypted)
+        ]
+        vals = iter(await self._run(self._crypto.decrypt_many, [secret.val for secret in found if secret]))
+        return [next(vals) if secret else None for secret in found]
+
+    async def set_many(self, items: Sequence[Tuple[str, str]]) -> List[Optional[str]]:
+        await self._ready()
+        names = [key for key, _ in items]
+        keys, vals = await asyncio.gather(
+            self._run(self._crypto.index_many, names),
+            self._run(self._crypto.encrypt_many, [val for _, val in items]),
+        )
+        secrets = [*await self._name_records(keys, names), *map(Secret, keys, vals)]
+        if await self._repository.save_many(secrets):
+            return [key for key, _ in items]
+        return [None for _ in items]
+
+    async def delete_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        await self._ready()
+        encrypted = await self._run(self._crypto.index_many, keys)
+        deleted, targets = deletions(keys, encrypted, await self._repository.retrieve_many(encrypted))
+        vals = await self._run(self._crypto.encrypt_many, ["" for _ in targets])
+        tombstones = [Secret(key, val, deleted=True) for key, val in zip(targets, vals)]
+        if tombstones and not await self._repository.save_many(tombstones):
+            return [None for _ in keys]
+        return deleted
+
+    async def _ready(self) -> None:
+        # The KDF and the first store read are independent, overlap them.
+        await asyncio.gather(self._derive_key(), self._load_store())
+
+    async def _configure(self) -> None:
+        if self._password is not None:
+            kdf = await self._repository.get_meta("kdf")
+            await self._run(self._crypto.configure, self._password, kdf if isinstance(kdf, dict) else None)
+
+    async def _encrypt_key(self, key: str) -> EncryptedStr:
+        await self._ready()
+        return await self._run(self._crypto.index, key)
+
+    async def _name_records(self, keys: Sequence[EncryptedStr], names: Sequence[str]) -> List[Secret]:
+        found = await self._repository.retrieve_many([name_index(key) for key in keys])
+        return await self._run(name_records, self._crypto, keys, names, found)
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
@@ -1,16 +1,57 @@
 from __future__ import annotations
 
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import time
+import uuid
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from contextlib import nullcontext
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    cast,
+)
 
 from secretkv import config
-from secretkv.crypto import Crypto, EncryptedStr
-from secretkv.domain import Secret
+from secretkv.crypto import (
+    Crypto,
+    EncryptedStr,
+    InvalidKeyException,
+    KdfParams,
+    is_legacy_key,
+    is_name_index,
+    name_index,
+)
+from secretkv.domain import RetentionPolicy, Secret
+from secretkv.instrumentation import span
+from secretkv.utils import TTLCache, chunked
+
+
+class UnnamedKeysException(Exception):
+    ...
+
+
+class StaleRekeyException(Exception):
+    ...
 
 
 class Repository(ABC):
     @abstractmethod
-    def list_latest_version(self) -> List[Secret]:
+    def list_latest_version(self, include_deleted: bool = True) -> List[Secret]:
         ...
 
     @abstractmethod
@@ -28,66 +69,620 @@ class Repository(ABC):
     def is_empty(self) -> bool:
         ...
 
+    def generation(self) -> Hashable:
+        return None
+
+    def retrieve_many(self, keys: Sequence[EncryptedStr]) -> List[Optional[Secret]]:
+        return [self.retrieve_by_key(key) for key in keys]
+
+    def save_many(self, secrets: Iterable[Secret]) -> bool:
+        return all([self.save(secret) for secret in secrets])
+
+    @abstractmethod
+    def replace(self, secrets: Iterable[Secret]) -> bool:
+        ...
+
+    def migrate_tombstones(self, classify: Callable[[List[EncryptedStr]], List[bool]]) -> bool:
+        return False
+
+    def exclusive(self) -> ContextManager[Any]:
+        """Keeps other writers out, so what is read in the block can be replaced without losing a write."""
+        return nullcontext()
+
+    def iter_histories(self) -> Iterator[List[Secret]]:
+        for secret in self.list_latest_version():
+            yield self.retireve_history_from_key(secret.key)
+
+    def get_meta(self, name: str) -> Any:
+        """Json value stored alongside the secrets, like retention policies."""
+        return None
+
+    def set_meta(self, name: str, value: Any) -> bool:
+        return False
+
+
+REKEY_FORMAT = "skv-rekey/1"
+
 
 class SecretKV:
-    def __init__(self, repository: Repository, crypto: Crypto) -> None:
+    CHUNK_SIZE = 4096
+
+    def __init__(
+        self,
+        repository: Repository,
+        crypto: Crypto,
+        cache: Optional[TTLCache[str, str]] = None,
+    ) -> None:
         self._repository = repository
         self._crypto = crypto
+        self._cache = cache
+        self._cache_generation: Hashable = None
 
     @property
     def crypto(self) -> Crypto:
         return self._crypto
 
+    @property
+    def repository(self) -> Repository:
+        return self._repository
+
+    @property
+    def cache(self) -> Optional[TTLCache[str, str]]:
+        return self._cache
+
+    def unlock(self, password: str) -> None:
+        self._crypto.configure(password, self.kdf_params())
+
+    def kdf_params(self) -> Optional[KdfParams]:
+        """How this vault derives its key, None for the defaults of vaults that predate it."""
+        kdf = self._repository.get_meta("kdf")
+        return kdf if isinstance(kdf, dict) else None
+
+    def initialize(self, kdf: KdfParams) -> bool:
+        # A vault with secrets is bound to its key, changing it takes a rekey.
+        if not self._repository.is_empty():
+            return False
+        return self._repository.set_meta("kdf", kdf)
+
     def verify_password(self) -> bool:
+        with span("secretkv.verify_password"):
+            return self._verify_password()
+
+    def _verify_password(self) -> bool:
         if self._repository.is_empty():
             self.create_or_append(config.TAG, config.TAG[::-1])
+            self._repository.set_meta("tombstones", True)
             return True
 
-        return bool(self.get_value_from_key(config.TAG))
+        legacy = None
+        if not self.get_value_from_key(config.TAG):
+            # Key names were encrypted deterministically before blind indexes.
+            legacy = self._repository.retrieve_by_key(self._crypto.encrypt(config.TAG, deterministic=True))
+            if not legacy or not self._crypto.decrypt(legacy.val):
+                return False
 
-    def list_every_key(self, include_deleted: bool) -> List[str]:
-        return [
-            self._crypto.decrypt(secret.key)
-            for secret in self._repository.list_latest_version()
-            if self._crypto.decrypt(secret.val) or include_deleted
-        ]
+        if not self._repository.get_meta("tombstones"):
+            # Versions from before tombstones were flagged are classified once per vault.
+            self._repository.migrate_tombstones(
+                lambda vals: [val == "" for val in self._crypto.decrypt_many(vals)]
+            )
+            self._repository.set_meta("tombstones", True)
+        if legacy:
+            self._migrate_legacy_keys()
+        return True
+
+    def list_every_key(self, include_deleted: bool, prefix: str = "", glob: Optional[str] = None) -> List[str]:
+        """Every key name, or those starting with `prefix` and matching the shell pattern `glob`."""
+        secrets = self._repository.list_latest_version(True)
+        directory = self._key_directory(secrets)
+        names = (
+            directory.get(str(secret.key))
+            for secret in secrets
+            if not is_name_index(secret.key) and (include_deleted or not secret.deleted)
+        )
+        return [name for name in names if name is not None and key_matches(name, prefix, glob)]
 
     def get_history_from_key(self, key: str) -> List[str]:
-        return [
-            self._crypto.decrypt(secret.val) for secret in self._find_all_versions(key)
-        ]
+        return self._crypto.decrypt_many([secret.val for secret in self._find_all_versions(key)])
 
     def get_value_from_key(self, key: str) -> Optional[str]:
-        if secret := self._find_latest_version(key):
-            return self._crypto.decrypt(secret.val)
+        if self._cache is not None and key != config.TAG:
+            self._validate_cache()
+            if (val := self._cache.get(key)) is not None:
+                return val
+
+        if (secret := self._find_latest_version(key)) and not secret.deleted:
+            val = self._crypto.decrypt(secret.val)
+            if self._cache is not None and key != config.TAG:
+                self._cache.put(key, val)
+            return val
         return None
 
     def create_or_append(self, key: str, val: str) -> Optional[str]:
-        secret = Secret(
-            self._crypto.encrypt(key, deterministic=True),
-            self._crypto.encrypt(val),
-        )
-        if self._repository.save(secret):
+        self._invalidate(key)
+        index = self._crypto.index(key)
+        secret = Secret(index, self._crypto.encrypt(val))
+        if names := self._name_records([index], [key]):
+            saved = self._repository.save_many([*names, secret])
+        else:
+            saved = self._repository.save(secret)
+        if saved:
             return key
         return None
 
     def mark_as_deleted(self, key: str) -> Optional[str]:
+        self._invalidate(key)
         if secret := self._find_latest_version(key):
-            if self._crypto.decrypt(secret.val) != "" and self._repository.save(
+            if not secret.deleted and self._repository.save(
                 Secret(
-                    self._crypto.encrypt(key, deterministic=True),
+                    self._crypto.index(key),
                     self._crypto.encrypt(""),
+                    deleted=True,
                 )
             ):
                 return key
         return None
 
-    def _find_latest_version(self, key: str) -> Optional[Secret]:
-        return self._repository.retrieve_by_key(
-            self._crypto.encrypt(key, deterministic=True)
+    def get_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        secrets = self._repository.retrieve_many(self._crypto.index_many(keys))
+        found = [secret if secret and not secret.deleted else None for secret in secrets]
+        vals = iter(self._crypto.decrypt_many([secret.val for secret in found if secret]))
+        return [next(vals) if secret else None for secret in found]
+
+    def set_many(self, items: Sequence[Tuple[str, str]]) -> List[Optional[str]]:
+        for key, _ in items:
+            self._invalidate(key)
+        names = [key for key, _ in items]
+        indexes = self._crypto.index_many(names)
+        secrets = [
+            *self._name_records(indexes, names),
+            *map(Secret, indexes, self._crypto.encrypt_many([val for _, val in items])),
+        ]
+        if self._repository.save_many(secrets):
+            return [key for key, _ in items]
+        return [None for _ in items]
+
+    def delete_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        for key in keys:
+            self._invalidate(key)
+        encrypted = self._crypto.index_many(keys)
+        deleted, targets = deletions(keys, encrypted, self._repository.retrieve_many(encrypted))
+        vals = self._crypto.encrypt_many(["" for _ in targets])
+        tombstones = [Secret(key, val, deleted=True) for key, val in zip(targets, vals)]
+        if tombstones and not self._repository.save_many(tombstones):
+            return [None for _ in keys]
+        return deleted
+
+    def dump(self, plaintext: bool = False) -> Iterator[Dict[str, Any]]:
+        """Every history as a record, encrypted as stored or decrypted with `plaintext`.
+
+        A plaintext dump raises UnnamedKeysException, after the records it
+        already yielded, if some keys have no name record to decrypt.
+        """
+        if not plaintext:
+            for history in self._repository.iter_histories():
+                yield {
+                    "key": str(history[0].key),
+                    "values": [str(secret.val) for secret in history],
+                    "deleted": [secret.deleted for secret in history],
+                }
+            return
+
+        unnamed: List[str] = []
+        for chunk in chunked(self._repository.iter_histories(), self.CHUNK_SIZE):
+            histories = [history for history in chunk if not is_name_index(history[0].key)]
+            names = self._repository.retrieve_many([name_index(history[0].key) for history in histories])
+            unnamed.extend(str(history[0].key) for history, name in zip(histories, names) if not name)
+            if unnamed:
+                continue
+
+            named = [(history, name) for history, name in zip(histories, names) if name]
+            keys = self._crypto.decrypt_many([name.val for _, name in named])
+            vals = iter(self._crypto.decrypt_many([secret.val for history, _ in named for secret in history]))
+            for key, (history, _) in zip(keys, named):
+                record = {"key": key, "values": [next(vals) for _ in history]}
+                if key != config.TAG:
+                    yield record
+
+        if unnamed:
+            raise UnnamedKeysException(f"Dump aborted, no name record for keys: {', '.join(unnamed)}")
+
+    def restore(self, records: Iterable[Dict[str, Any]], plaintext: bool, replace: bool = False) -> bool:
+        if self._cache is not None:
+            self._cache.clear()
+        convert = self._encrypt_records if plaintext else self._verify_records
+        secrets = itertools.chain.from_iterable(
+            convert(chunk, replace) for chunk in chunked(records, self.CHUNK_SIZE)
         )
+        if not replace:
+            return self._repository.save_many(secrets)
 
-    def _find_all_versions(self, key: str) -> List[Secret]:
-        return self._repository.retireve_history_from_key(
-            self._crypto.encrypt(key, deterministic=True)
+        tag = self._crypto.index(config.TAG)
+        return self._repository.replace(
+            itertools.chain(
+                [*self._name_records([tag], [config.TAG], False), Secret(tag, self._crypto.encrypt(config.TAG[::-1]))],
+                secrets,
+            )
         )
+
+    def retention_policy(self, key: Optional[str] = None) -> RetentionPolicy:
+        """The vault policy, or the one set for `key`, which overrides it field by field."""
+        policies = self._repository.get_meta("retention") or {}
+        if key is None:
+            return RetentionPolicy(**policies.get("vault", {}))
+        return RetentionPolicy(**policies.get("keys", {}).get(str(self._encrypt_key(key)), {}))
+
+    def set_retention_policy(self, policy: RetentionPolicy, key: Optional[str] = None) -> bool:
+        policies = self._repository.get_meta("retention") or {}
+        fields = {name: value for name, value in policy._asdict().items() if value is not None}
+        if key is None:
+            policies["vault"] = fields
+        elif fields:
+            policies.setdefault("keys", {})[str(self._encrypt_key(key))] = fields
+        else:
+            policies.setdefault("keys", {}).pop(str(self._encrypt_key(key)), None)
+        return self._repository.set_meta("retention", policies)
+
+    def compact(self, now: Optional[float] = None) -> Optional[Tuple[int, int]]:
+        """Applies the retention policies in one rewrite of the store.
+
+        Returns how many versions and how many keys were dropped, or None if
+        the store couldn't be rewritten.
+        """
+        policies = self._repository.get_meta("retention") or {}
+        vault = RetentionPolicy(**policies.get("vault", {}))
+        keys = {key: vault.override(RetentionPolicy(**fields)) for key, fields in policies.get("keys", {}).items()}
+        tag = str(self._encrypt_key(config.TAG))
+        now = time.time() if now is None else now
+
+        with self._repository.exclusive():
+            kept: List[Secret] = []
+            names: List[Secret] = []
+            versions = purged = 0
+            for history in self._repository.iter_histories():
+                key = str(history[0].key)
+                if is_name_index(history[0].key):
+                    names.extend(history)
+                    continue
+                retained = history if key == tag else keys.get(key, vault).retain(history, now)
+                versions += len(history) - len(retained)
+                purged += not retained
+                kept.extend(retained)
+
+            # A purged key takes its name along.
+            named = {str(name_index(secret.key)) for secret in kept}
+            kept.extend(secret for secret in names if str(secret.key) in named)
+            if versions and not self._repository.replace(kept):
+                return None
+
+        if self._cache is not None:
+            self._cache.clear()
+        return versions, purged
+
+    def rekey(self, crypto: Crypto, staging: str) -> bool:
+        """Re-encrypts every key and value for `crypto`, then swaps the store over.
+
+        The re-encrypted store is staged in `staging`, with a checkpoint after
+        every chunk. Running it again with the same new password resumes from
+        the last checkpoint. Returns False if the store changed while it was
+        being read. Raises StaleRekeyException if the staging belongs to a
+        rekey to another password, and UnnamedKeysException, leaving the store
+        as it is, if some keys have no name record to index them by for the
+        new password.
+        """
+        directory = Path(staging).expanduser()
+        directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if (state := self._load_rekey_state(directory, crypto)) is None:
+            raise StaleRekeyException(
+                f"Rekey aborted, {directory} holds an interrupted rekey to another password: "
+                "resume it with that password or remove the directory"
+            )
+
+        digest = hashlib.blake2b()
+        histories = self._repository.iter_histories()
+        for history in itertools.islice(histories, state["done"]):
+            _update_digest(digest, history)
+        if digest.hexdigest() != state["digest"]:
+            # Written to since the checkpoint, what was staged is stale.
+            shutil.rmtree(directory)
+            return self.rekey(crypto, staging)
+
+        unnamed: List[str] = []
+        for chunk in chunked(histories, self.CHUNK_SIZE):
+            keys = self._reindex(crypto, [history[0].key for history in chunk])
+            # A history without a name record can't be indexed for the new password.
+            unnamed.extend(str(history[0].key) for key, history in zip(keys, chunk) if not key)
+            if unnamed:
+                continue
+
+            vals = iter(crypto.reencrypt_many([secret.val for history in chunk for secret in history], self._crypto))
+            records = [
+                {"key": str(key), "values": [str(next(vals)) for _ in history], "deleted": [s.deleted for s in history]}
+                for key, history in zip(keys, chunk)
+            ]
+            for history in chunk:
+                _update_digest(digest, history)
+
+            _write_atomic(directory / f"chunk-{state['chunks']:06d}.jsonl", "".join(map(_json_line, records)))
+            state.update(done=state["done"] + len(chunk), chunks=state["chunks"] + 1, digest=digest.hexdigest())
+            _write_atomic(directory / "state.json", json.dumps(state))
+
+        if unnamed:
+            shutil.rmtree(directory)
+            raise UnnamedKeysException(f"Rekey aborted, no name record for keys: {', '.join(unnamed)}")
+
+        if not self._swap_rekeyed(directory, crypto, state):
+            shutil.rmtree(directory)
+            return False
+
+        shutil.rmtree(directory)
+        self._crypto = crypto
+        if self._cache is not None:
+            self._cache.clear()
+        return True
+
+    def _load_rekey_state(self, directory: Path, crypto: Crypto) -> Optional[Dict[str, Any]]:
+        try:
+            state = json.loads((directory / "state.json").read_text())
+        except (OSError, ValueError):
+            state = None
+
+        if not isinstance(state, dict) or state.get("format") != REKEY_FORMAT:
+            state = {
+                "format": REKEY_FORMAT,
+                "check": str(crypto.encrypt(config.TAG)),
+                "done": 0,
+                "chunks": 0,
+                "digest": hashlib.blake2b().hexdigest(),
+            }
+            _write_atomic(directory / "state.json", json.dumps(state))
+
+        try:
+            if crypto.decrypt(EncryptedStr(state["check"])) != config.TAG:
+                return None
+        except InvalidKeyException:
+            return None
+        return state
+
+    def _swap_rekeyed(self, directory: Path, crypto: Crypto, state: Dict[str, Any]) -> bool:
+        policies = self._repository.get_meta("retention") or {}
+        old_keys = [*policies.get("keys", {})]
+        new_keys = self._reindex(crypto, [EncryptedStr(key) for key in old_keys])
+        renamed = {old: str(new) for old, new in zip(old_keys, new_keys) if new}
+
+        with self._repository.exclusive():
+            digest = hashlib.blake2b()
+            for history in self._repository.iter_histories():
+                _update_digest(digest, history)
+            if digest.hexdigest() != state["digest"]:
+                return False
+
+            self._rename_policies(policies, renamed, swapped=False)
+            records = (
+                json.loads(line)
+                for index in range(state["chunks"])
+                for line in (directory / f"chunk-{index:06d}.jsonl").read_text().splitlines()
+            )
+            secrets = (
+                Secret(EncryptedStr(record["key"]), EncryptedStr(val), deleted)
+                for record in records
+                for val, deleted in zip(record["values"], record["deleted"])
+            )
+            if not self._repository.replace(secrets):
+                return False
+
+        # The old password mustn't keep opening the key names.
+        self._repository.set_meta("directory", None)
+        self._rename_policies(policies, renamed, swapped=True)
+        return True
+
+    def _migrate_legacy_keys(self) -> bool:
+        """Moves a vault from deterministically encrypted key names to blind indexes."""
+        policies = self._repository.get_meta("retention") or {}
+        old_keys = [key for key in policies.get("keys", {}) if is_legacy_key(EncryptedStr(key))]
+        new_keys = self._crypto.index_many(self._crypto.decrypt_many([EncryptedStr(key) for key in old_keys]))
+        renamed = dict(zip(old_keys, map(str, new_keys)))
+
+        with self._repository.exclusive():
+            secrets: List[Secret] = []
+            for chunk in chunked(self._repository.iter_histories(), self.CHUNK_SIZE):
+                legacy = [history for history in chunk if is_legacy_key(history[0].key)]
+                names = self._crypto.decrypt_many([history[0].key for history in legacy])
+                indexes = self._crypto.index_many(names)
+                secrets.extend(self._name_records(indexes, names, False))
+                for index, history in zip(indexes, legacy):
+                    secrets.extend(Secret(index, secret.val, secret.deleted) for secret in history)
+                secrets.extend(secret for history in chunk if not is_legacy_key(history[0].key) for secret in history)
+
+            self._rename_policies(policies, renamed, swapped=False)
+            if not self._repository.replace(secrets):
+                return False
+
+        self._rename_policies(policies, renamed, swapped=True)
+        if self._cache is not None:
+            self._cache.clear()
+        return True
+
+    def _rename_policies(self, policies: Dict[str, Any], renamed: Dict[str, str], swapped: bool) -> None:
+        """Moves the per key retention policies to the new names of `renamed` keys.
+
+        Until the store is swapped both names are kept, so an interruption
+        loses no policy. Keys that weren't renamed keep their policy.
+        """
+        if not renamed:
+            return
+
+        keys = policies.get("keys", {})
+        if swapped:
+            keys = {renamed.get(key, key): fields for key, fields in keys.items()}
+        else:
+            keys = {**keys, **{renamed[key]: fields for key, fields in keys.items() if key in renamed}}
+        self._repository.set_meta("retention", {**policies, "keys": keys})
+
+    def _key_directory(self, secrets: List[Secret]) -> Dict[str, str]:
+        """Key names by index, kept in a single encrypted blob with the vault.
+
+        Only the names of keys that aren't in the blob yet are decrypted, and
+        the blob is written back whenever keys were added or dropped since.
+        """
+        directory: Any = None
+        if isinstance(blob := self._repository.get_meta("directory"), str):
+            try:
+                directory = json.loads(self._crypto.decrypt(EncryptedStr(blob)))
+            except (InvalidKeyException, ValueError):
+                # Not ours, but the name records have everything to build it again.
+                pass
+        if not isinstance(directory, dict):
+            directory = {}
+
+        names = {str(secret.key): secret.val for secret in secrets if is_name_index(secret.key)}
+        keys = [str(secret.key) for secret in secrets if not is_name_index(secret.key)]
+        current = {key: directory[key] for key in keys if key in directory}
+        missing = [key for key in keys if key not in current and str(name_index(EncryptedStr(key))) in names]
+        if missing or len(current) != len(directory):
+            found = self._crypto.decrypt_many([names[str(name_index(EncryptedStr(key)))] for key in missing])
+            current.update(zip(missing, found))
+            self._repository.set_meta("directory", str(self._crypto.encrypt(json.dumps(current))))
+        return current
+
+    def _reindex(self, crypto: Crypto, keys: Sequence[EncryptedStr]) -> List[Optional[EncryptedStr]]:
+        """Where the records at `keys` go for `crypto`, None for a key without a name record."""
+        found = self._repository.retrieve_many([key if is_name_index(key) else name_index(key) for key in keys])
+        indexes = iter(crypto.index_many(self._crypto.decrypt_many([secret.val for secret in found if secret])))
+        new_keys: List[Optional[EncryptedStr]] = []
+        for key, secret in zip(keys, found):
+            if not secret:
+                new_keys.append(None)
+            elif is_name_index(key):
+                new_keys.append(name_index(next(indexes)))
+            else:
+                new_keys.append(next(indexes))
+        return new_keys
+
+    def _name_records(self, keys: Sequence[EncryptedStr], names: Sequence[str], existing: bool = True) -> List[Secret]:
+        """Name records for the blind indexes `keys` of `names`, but those the store has if `existing`."""
+        found = self._repository.retrieve_many([name_index(key) for key in keys]) if existing else [None for _ in keys]
+        return name_records(self._crypto, keys, names, found)
+
+    def _encrypt_records(self, records: List[Dict[str, Any]], replace: bool) -> List[Secret]:
+        records = [record for record in records if record["key"] != config.TAG]
+        names = [record["key"] for record in records]
+        keys = self._crypto.index_many(names)
+        vals = iter(self._crypto.encrypt_many([val for record in records for val in record["values"]]))
+        return self._name_records(keys, names, not replace) + [
+            Secret(key, next(vals), deleted=val == "")
+            for key, record in zip(keys, records)
+            for val in record["values"]
+        ]
+
+    def _verify_records(self, records: List[Dict[str, Any]], replace: bool) -> List[Secret]:
+        keys = [EncryptedStr(record["key"]) for record in records]
+        # Dumps from before blind indexes have the key names encrypted as keys.
+        legacy = [key for key in keys if is_legacy_key(key)]
+        legacy_names = self._crypto.decrypt_many(legacy)
+        # Decrypting the names also turns down a dump of another vault.
+        names = self._crypto.decrypt_many(
+            [EncryptedStr(record["values"][-1]) for key, record in zip(keys, records) if is_name_index(key)]
+        )
+        names = [name for name in names + legacy_names if name != config.TAG]
+        secrets = self._name_records(self._crypto.index_many(names), names, not replace)
+
+        new_keys = dict(zip(map(str, legacy), self._crypto.index_many(legacy_names)))
+        tag = self._crypto.index(config.TAG)
+        histories = [
+            (key, record)
+            for key, record in ((new_keys.get(str(key), key), record) for key, record in zip(keys, records))
+            if key != tag and not is_name_index(key)
+        ]
+        # Dumps from before tombstones were flagged only tell deletions by their empty value.
+        unflagged = iter(self._crypto.decrypt_many(
+            [EncryptedStr(val) for _, record in histories if "deleted" not in record for val in record["values"]]
+        ))
+        for key, record in histories:
+            flags = record["deleted"] if "deleted" in record else [next(unflagged) == "" for _ in record["values"]]
+            secrets.extend(
+                Secret(key, EncryptedStr(val), bool(deleted))
+                for val, deleted in zip(record["values"], flags)
+            )
+        return secrets
+
+    def _validate_cache(self) -> None:
+        generation = (self._repository.generation(), self._crypto.export_key())
+        if generation != self._cache_generation:
+            cast(TTLCache[str, str], self._cache).clear()
+            self._cache_generation = generation
+
+    def _invalidate(self, key: str) -> None:
+        if self._cache is not None:
+            self._cache.invalidate(key)
+
+    def _encrypt_key(self, key: str) -> EncryptedStr:
+        return self._crypto.index(key)
+
+    def _find_latest_version(self, key: str) -> Optional[Secret]:
+        return self._repository.retrieve_by_key(self._crypto.index(key))
+
+    def _find_all_versions(self, key: str) -> List[Secret]:
+        return self._repository.retireve_history_from_key(self._crypto.index(key))
+
+
+def key_names(secrets: Iterable[Secret]) -> List[EncryptedStr]:
+    """The encrypted names of the keys in `secrets`, from the name records among them."""
+    names: Dict[str, EncryptedStr] = {}
+    keys: List[EncryptedStr] = []
+    for secret in secrets:
+        if is_name_index(secret.key):
+            names[str(secret.key)] = secret.val
+        else:
+            keys.append(secret.key)
+    return [name for key in keys if (name := names.get(str(name_index(key))))]
+
+
+def key_matches(name: str, prefix: str = "", glob: Optional[str] = None) -> bool:
+    return name.startswith(prefix) and (glob is None or fnmatchcase(name, glob))
+
+
+def name_records(
+    crypto: Crypto,
+    keys: Sequence[EncryptedStr],
+    names: Sequence[str],
+    found: Sequence[Optional[Secret]],
+) -> List[Secret]:
+    """Name records for the blind indexes `keys` of `names`, but those whose record is `found` in the store."""
+    missing: Dict[str, str] = {}
+    for key, name, secret in zip(keys, names, found):
+        if not secret:
+            missing.setdefault(str(name_index(key)), name)
+    vals = crypto.encrypt_many([*missing.values()])
+    return [Secret(EncryptedStr(index), val) for index, val in zip(missing, vals)]
+
+
+def deletions(
+    keys: Sequence[str],
+    encrypted: Sequence[EncryptedStr],
+    found: Sequence[Optional[Secret]],
+) -> Tuple[List[Optional[str]], List[EncryptedStr]]:
+    """Which of `keys` get deleted, None for the others, and the blind indexes to write tombstones for."""
+    deleted: List[Optional[str]] = []
+    targets = []
+    for key, enc, secret in zip(keys, encrypted, found):
+        if not secret or secret.deleted or key in deleted:
+            deleted.append(None)
+            continue
+        deleted.append(key)
+        targets.append(enc)
+    return deleted, targets
+
+
+def _update_digest(digest: Any, history: List[Secret]) -> None:
+    digest.update(_json_line([str(history[0].key), [[str(s.val), s.deleted] for s in history]]).encode())
+
+
+def _json_line(record: Any) -> str:
+    return json.dumps(record) + "\n"
+
+
+def _write_atomic(file: Path, text: str) -> None:
+    tmp = file.with_name(f"{file.name}.{uuid.uuid4()}.tmp")
+    tmp.write_text(text)
+    os.replace(tmp, file)
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import itertools
+import platform
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from secretkv.application import Repository, SecretKV
+from secretkv.codec import BinaryCodec
+from secretkv.crypto import Crypto, name_index
+from secretkv.domain import Secret
+from secretkv.infrastructure import (
+    FileRepository,
+    InMemoryRepository,
+    LogRepository,
+    ShardedFileRepository,
+    SqliteRepository,
+)
+
+PASSWORD = "benchmark"
+
+REPOSITORIES: Dict[str, Callable[[Path], Repository]] = {
+    "memory": lambda directory: InMemoryRepository(),
+    "json": lambda directory: FileRepository(str(directory / "secrets.json")),
+    "binary": lambda directory: FileRepository(str(directory / "secrets.skv"), BinaryCodec()),
+    "log": lambda directory: LogRepository(str(directory / "secrets.log"), compact_threshold=10**9),
+    "sqlite": lambda directory: SqliteRepository(str(directory / "secrets.db")),
+    "sharded": lambda directory: ShardedFileRepository(str(directory / "secrets.d")),
+}
+
+
+def run(
+    sizes: Sequence[int] = (1000, 10000, 100000),
+    depth: int = 3,
+    ops: int = 100,
+    repositories: Sequence[str] = ("memory", "json"),
+) -> Dict[str, Any]:
+    crypto = Crypto()
+    results = [
+        _result("configure", 1, _measure(lambda _: crypto.configure(PASSWORD), 1)),
+        _result("index", ops, _measure(lambda i: crypto.index(f"key{i}"), ops)),
+        _result("encrypt", ops, _measure(lambda i: crypto.encrypt(f"val{i}"), ops)),
+    ]
+    ciphertext = crypto.encrypt("val")
+    results.append(_result("decrypt", ops, _measure(lambda _: crypto.decrypt(ciphertext), ops)))
+
+    for name in repositories:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                repository = REPOSITORIES[name](Path(directory))
+                keys = _populate(repository, crypto, size, depth)
+                labels = {"repository": name, "size": size, "depth": depth}
+                results += _run_vault(SecretKV(repository, crypto), keys, ops, labels)
+                if isinstance(repository, SqliteRepository):
+                    repository.close()
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def _populate(repository: Repository, crypto: Crypto, size: int, depth: int) -> List[str]:
+    keys = [f"key{i}" for i in range(size)]
+    indexes = crypto.index_many(keys)
+    names = [Secret(name_index(key), name) for key, name in zip(indexes, crypto.encrypt_many(keys))]
+    repository.save_many(
+        itertools.chain(
+            names,
+            (
+                Secret(key, val)
+                for version in range(depth)
+                for key, val in zip(indexes, crypto.encrypt_many([f"val{version}"] * size))
+            ),
+        )
+    )
+    return keys
+
+
+def _run_vault(app: SecretKV, keys: List[str], ops: int, labels: Dict[str, Any]) -> List[Dict[str, Any]]:
+    rand = random.Random(0)
+    picks = [rand.choice(keys) for _ in range(ops)]
+    listings = max(1, ops // 100)
+    return [
+        _result("get_value_from_key", ops, _measure(lambda i: app.get_value_from_key(picks[i]), ops), **labels),
+        _result("get_history_from_key", ops, _measure(lambda i: app.get_history_from_key(picks[i]), ops), **labels),
+        _result("list_every_key", listings, _measure(lambda _: app.list_every_key(False), listings), **labels),
+        _result("create_or_append", ops, _measure(lambda i: app.create_or_append(picks[i], "val"), ops), **labels),
+    ]
+
+
+def _measure(func: Callable[[int], Any], ops: int) -> float:
+    start = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    return time.perf_counter() - start
+
+
+def _result(
+    name: str,
+    ops: int,
+    seconds: float,
+    repository: Optional[str] = None,
+    size: Optional[int] = None,
+    depth: Optional[int] = None,
+) -> Dict[str, Any]:
+    return {
+        "benchmark": name,
+        "repository": repository,
+        "size": size,
+        "depth": depth,
+        "ops": ops,
+        "seconds": seconds,
+        "us_per_op": seconds / ops * 1e6,
+    }
@@ -2,15 +2,26 @@ from __future__ import annotations
 
 import getpass
 import json
-from argparse import ArgumentParser
-from typing import Any, Dict, List, Optional, Sequence
+import sys
+from argparse import ArgumentParser, ArgumentTypeError
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 import secretkv
-from secretkv import config
+from secretkv import config, keyagent, server
 from secretkv.utils import Result, Status
 
 CommandOutput = Dict[str, List[str]]
 
+PASSWORDLESS_COMMANDS = {"bench", "reshard"}
+
+SERVED_COMMANDS = {"get", "list", "set", "delete"}
+
+# Commands that derive the key themselves instead of asking the agent for it.
+AGENTLESS_COMMANDS = {"agent", "init"}
+
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
 
 class InvalidCommandException(Exception):
     ...
@@ -21,154 +32,414 @@ def get_master_password(command: Command) -> str:
 
 
 class Command:
-    def __init__(self, func_name: str, kwargs: Dict[str, str]) -> None:
+    def __init__(self, func_name: str, kwargs: Dict[str, Any], timings: Optional[str] = None) -> None:
         self.func_name = func_name
         self.kwargs = kwargs
+        self.timings = timings
 
     def execute(self, dependencies: Dict[str, Any]) -> Optional[CommandOutput]:
         func = getattr(secretkv, self.func_name, None)
         if not func or not callable(func):
             return {"message": [f"Command {self.func_name} doesn't exist"]}
 
-        self.kwargs["password"] = get_master_password(self)
+        if self.func_name in PASSWORDLESS_COMMANDS:
+            self.kwargs["password"] = None
+        elif self.func_name not in AGENTLESS_COMMANDS and not self.kwargs.get("masterpass") and (
+            self._unlock_from_agent(dependencies["app"])
+        ):
+            self.kwargs.pop("masterpass", None)
+            self.kwargs["password"] = None
+        else:
+            self.kwargs["password"] = get_master_password(self)
+
+        if self.func_name == "rekey" and not self.kwargs.get("new_masterpass"):
+            self.kwargs["new_masterpass"] = Cli.prompt_for_new_password()
 
         self.kwargs.update(dependencies)
-        response: Result[CommandOutput] = func(**self.kwargs)
+        return self.output(func(**self.kwargs))
+
+    @staticmethod
+    def _unlock_from_agent(app: Any) -> bool:
+        # The agent may hold the key of another vault, or the one from before a rekey.
+        if not (key := keyagent.request_key()):
+            return False
+        app.crypto.configure_from_key(*key)
+        if not app.verify_password():
+            return False
+        keyagent.touch()
+        return True
+
+    def forward(self) -> Optional[Result[CommandOutput]]:
+        if self.func_name not in SERVED_COMMANDS or self.kwargs.get("masterpass"):
+            return None
+
+        args = {name: value for name, value in self.kwargs.items() if name != "masterpass"}
+        if (response := server.request(self.func_name, args)) is None:
+            return None
+        return Result[CommandOutput](Status.Ok if response.get("ok") else Status.Err, response.get("data") or {})
+
+    @staticmethod
+    def output(response: Result[CommandOutput]) -> Optional[CommandOutput]:
         if response.status == Status.Ok:
             if output := response.data:
                 return output
             return None
 
-        return {"message": ["Something went wrong!"]}
+        return {"message": response.data.get("message") or ["Something went wrong!"]}
 
 
 class Cli:
     def __init__(self, parser: ArgumentParser) -> None:
+        self._add_global_arguments(parser)
+        # Knows only the options before the subcommand, to find where it starts.
+        self._global_parser = ArgumentParser(add_help=False)
+        self._add_global_arguments(self._global_parser)
 
-        subparsers = parser.add_subparsers(
+        self._subparsers = parser.add_subparsers(
             title="subcommmands", dest="func", metavar="", required=True
         )
+        self._commands: Dict[str, Tuple[str, Callable[[ArgumentParser], None]]] = {
+            "init": ("set up a new vault", self._add_init_arguments),
+            "list": ("list every key", self._add_list_arguments),
+            "get": ("get secret", self._add_get_arguments),
+            "set": ("set secret", self._add_set_arguments),
+            "delete": ("delete secret", self._add_delete_arguments),
+            "batch": ("apply json lines operations", self._add_batch_arguments),
+            "dump": ("dump all secrets", self._add_dump_arguments),
+            "restore": ("restore from dump file", self._add_restore_arguments),
+            "agent": ("cache the derived key for other commands", self._add_agent_arguments),
+            "bench": ("benchmark crypto and storage", self._add_bench_arguments),
+            "serve": ("serve secrets to other commands", self._add_serve_arguments),
+            "reshard": ("change the number of shards of the sharded store", self._add_reshard_arguments),
+            "retention": ("show or set how much history is kept", self._add_retention_arguments),
+            "compact": ("drop history according to the retention policies", self._add_compact_arguments),
+            "rekey": ("change the master password", self._add_rekey_arguments),
+        }
+        self._subcommands = {
+            name: self._subparsers.add_parser(name, help=help)
+            for name, (help, _) in self._commands.items()
+        }
 
-        list_subcommand = subparsers.add_parser(
-            "list",
-            help="list every key",
+        self._parser = parser
+
+    def parse(self, argv: Optional[Sequence[str]]) -> Command:
+        argv = sys.argv[1:] if argv is None else argv
+        _, rest = self._global_parser.parse_known_args(argv)
+        name = next((arg for arg in rest if not arg.startswith("-")), None)
+        if name in self._commands:
+            _, add_arguments = self._commands[name]
+            add_arguments(self._subcommands[name])
+
+        kwargs = vars(self._parser.parse_args(argv))
+        func_name = kwargs.pop("func")
+        show_timings, timings_file = kwargs.pop("timings"), kwargs.pop("timings_file")
+        return Command(func_name, kwargs, timings_file or ("-" if show_timings else None))
+
+    @staticmethod
+    def _add_global_arguments(parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "--timings",
+            action="store_true",
+            help="print a per-phase timing breakdown to stderr",
+        )
+        parser.add_argument(
+            "--timings-file",
+            metavar="FILE",
+            help="write the per-phase timing breakdown as json to FILE",
         )
-        list_subcommand.add_argument(
+
+    @staticmethod
+    def _add_init_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
+            "--kdf",
+            choices=["pbkdf2", "scrypt"],
+            default="pbkdf2",
+            help="key derivation function",
+        )
+        subcommand.add_argument(
+            "--target-ms",
+            type=float,
+            help="tune the key derivation to take this long on this machine",
+        )
+        subcommand.add_argument(
+            "-p",
+            "--masterpass",
+            help="master password",
+        )
+
+    @staticmethod
+    def _add_list_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
             "-a",
             "--all",
             action="store_true",
             help="include deleted key",
         )
-        list_subcommand.add_argument(
+        subcommand.add_argument(
+            "--prefix",
+            help="only keys starting with this prefix",
+        )
+        subcommand.add_argument(
+            "--glob",
+            help="only keys matching this shell pattern, like 'prod/db/*'",
+        )
+        subcommand.add_argument(
             "-p",
             "--masterpass",
             help="master password",
         )
 
-        get_subcommand = subparsers.add_parser(
-            "get",
-            help="get secret",
-        )
-        get_subcommand.add_argument(
+    @staticmethod
+    def _add_get_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
             "key",
             help="key name",
         )
-        get_subcommand.add_argument(
+        subcommand.add_argument(
             "-H",
             "--history",
             action="store_true",
             help="get entire history of values",
         )
-        get_subcommand.add_argument(
+        subcommand.add_argument(
             "-p",
             "--masterpass",
             help="master password",
         )
 
-        set_subcommand = subparsers.add_parser(
-            "set",
-            help="set secret",
-        )
-        set_subcommand.add_argument(
+    @staticmethod
+    def _add_set_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
             "key",
             help="key name",
         )
-        set_subcommand.add_argument(
+        subcommand.add_argument(
             "val",
             help="secret value",
         )
-        set_subcommand.add_argument(
+        subcommand.add_argument(
             "-p",
             "--masterpass",
             help="master password",
         )
 
-        del_subcommand = subparsers.add_parser(
-            "delete",
-            help="delete secret",
-        )
-        del_subcommand.add_argument(
+    @staticmethod
+    def _add_delete_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
             "key",
             help="key name",
         )
-        del_subcommand.add_argument(
+        subcommand.add_argument(
             "-p",
             "--masterpass",
             help="master password",
         )
 
-        dump_subcommand = subparsers.add_parser(
-            "dump",
-            help="dump all secrets",
+    @staticmethod
+    def _add_batch_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
+            "-i",
+            "--input",
+            help="read operations from file instead of stdin",
         )
-        dump_subcommand.add_argument(
+        subcommand.add_argument(
+            "-o",
+            "--output",
+            help="write results to file instead of stdout",
+        )
+        subcommand.add_argument(
+            "-p",
+            "--masterpass",
+            help="master password",
+        )
+
+    @staticmethod
+    def _add_dump_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
             "--plaintext",
             action="store_true",
             help="dump secrets in plaintext",
         )
-        dump_subcommand.add_argument(
+        subcommand.add_argument(
             "-o",
             "--output",
             help="write dump to file",
         )
-        dump_subcommand.add_argument(
+        subcommand.add_argument(
             "-p",
             "--masterpass",
             help="master password",
         )
 
-        restore_subcommand = subparsers.add_parser(
-            "restore",
-            help="restore from dump file",
-        )
-        restore_subcommand.add_argument(
+    @staticmethod
+    def _add_restore_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
             "file",
             help="dump file",
         )
-        restore_subcommand.add_argument(
+        subcommand.add_argument(
             "--replace",
+            action="store_true",
             help="drop full database before restore",
         )
-        restore_subcommand.add_argument(
+        subcommand.add_argument(
             "-p",
             "--masterpass",
             help="master password",
         )
 
-        self._parser = parser
+    @staticmethod
+    def _add_agent_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
+            "--ttl",
+            type=float,
+            default=900,
+            help="seconds without requests before the agent exits",
+        )
+        subcommand.add_argument(
+            "-p",
+            "--masterpass",
+            help="master password",
+        )
 
-    def parse(self, argv: Optional[Sequence[str]]) -> Command:
-        kwargs = vars(self._parser.parse_args(argv))
-        func_name = kwargs.pop("func")
-        return Command(func_name, kwargs)
+    @staticmethod
+    def _add_bench_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[1000, 10000, 100000],
+            help="number of keys in each synthetic vault",
+        )
+        subcommand.add_argument(
+            "--depth",
+            type=int,
+            default=3,
+            help="number of versions per key",
+        )
+        subcommand.add_argument(
+            "--ops",
+            type=int,
+            default=100,
+            help="operations per benchmark",
+        )
+        subcommand.add_argument(
+            "--repositories",
+            nargs="+",
+            choices=["binary", "json", "log", "memory", "sharded", "sqlite"],
+            default=["memory", "json"],
+            help="repositories to benchmark",
+        )
+        subcommand.add_argument(
+            "-o",
+            "--output",
+            help="write results to file",
+        )
+
+    @staticmethod
+    def _add_serve_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
+            "-p",
+            "--masterpass",
+            help="master password",
+        )
+
+    @staticmethod
+    def _add_reshard_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
+            "shards",
+            type=int,
+            help="new number of shards",
+        )
+
+    @staticmethod
+    def _add_retention_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
+            "key",
+            nargs="?",
+            help="key name, the whole vault if omitted",
+        )
+        subcommand.add_argument(
+            "--keep",
+            type=positive_int,
+            help="number of versions to keep",
+        )
+        subcommand.add_argument(
+            "--max-age",
+            type=duration,
+            help="drop versions older than this, like 90d or 12h",
+        )
+        subcommand.add_argument(
+            "--purge-deleted",
+            type=duration,
+            help="drop keys deleted longer ago than this",
+        )
+        subcommand.add_argument(
+            "--clear",
+            action="store_true",
+            help="remove the policy",
+        )
+        subcommand.add_argument(
+            "-p",
+            "--masterpass",
+            help="master password",
+        )
+
+    @staticmethod
+    def _add_compact_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
+            "-p",
+            "--masterpass",
+            help="master password",
+        )
+
+    @staticmethod
+    def _add_rekey_arguments(subcommand: ArgumentParser) -> None:
+        subcommand.add_argument(
+            "-n",
+            "--new-masterpass",
+            help="new master password",
+        )
+        subcommand.add_argument(
+            "-p",
+            "--masterpass",
+            help="master password",
+        )
 
     @staticmethod
     def prompt_for_password() -> str:
         return getpass.getpass()
 
+    @staticmethod
+    def prompt_for_new_password() -> str:
+        password = getpass.getpass("New password: ")
+        return password if password == getpass.getpass("Repeat new password: ") else ""
+
     @staticmethod
     def show_output(results: CommandOutput) -> None:
         if "values" in results:
             print(json.dumps({"values": results}, indent=2))
             return
         print(json.dumps(results, indent=2))
+
+
+def positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"invalid number {value!r}")
+    if number < 1:
+        raise ArgumentTypeError("must be at least 1")
+    return number
+
+
+def duration(value: str) -> float:
+    """Seconds in a duration like 30d, 12h, 15m or 90s; plain numbers are days."""
+    number, unit = (value[:-1], value[-1]) if value[-1:] in DURATION_UNITS else (value, "d")
+    try:
+        seconds = float(number) * DURATION_UNITS[unit]
+    except ValueError:
+        raise ArgumentTypeError(f"invalid duration {value!r}")
+    if not 0 <= seconds < float("inf"):
+        raise ArgumentTypeError(f"invalid duration {value!r}")
+    return seconds
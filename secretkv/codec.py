@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import base64
+import json
+import mmap
+import os
+import struct
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, MutableMapping, Optional, Tuple, Union
+
+MAGIC = b"SKV\x00"
+FORMAT_VERSION = 1
+
+# Block: total length of what follows, key length, raw key, then entries until the end of the block.
+BLOCK_HEADER = struct.Struct("<IH")
+# Entry: version, flags, raw value length, followed by the raw value.
+ENTRY_HEADER = struct.Struct("<IBI")
+
+DELETED = 1
+LEGACY = 2
+
+# Store flags, in the byte after the format version.
+HAS_LEGACY = 1
+
+History = List[Tuple[Any, ...]]
+Span = Tuple[int, int, int]
+
+
+class UnsupportedFormatException(Exception):
+    ...
+
+
+class Codec(ABC):
+    @abstractmethod
+    def dumps(self, obj: Any) -> bytes:
+        ...
+
+    @abstractmethod
+    def loads(self, data: bytes) -> Any:
+        ...
+
+    def stored(self, file: Path, data: bytes, stamp: Tuple[int, int]) -> None:
+        """Called with the contents of `file` whenever they're written or read."""
+
+
+class JsonCodec(Codec):
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class BinaryCodec(Codec):
+    """Secrets histories as length prefixed raw Fernet tokens.
+
+    Tokens are stored base64 decoded and versions as integers, which makes
+    the file about a third smaller than json. Loading only walks the block
+    headers; a history is decoded the first time it's read, and histories
+    that were never touched are copied back verbatim when saving.
+    """
+
+    def dumps(self, obj: MutableMapping[str, History]) -> bytes:
+        items: Iterable[Tuple[str, Union[bytes, History]]] = obj.items()
+        raw_legacy = False
+        if isinstance(obj, BinaryHistories):
+            items, raw_legacy = obj.raw_items(), obj.legacy
+
+        blocks = []
+        legacy = False
+        for key, value in items:
+            if isinstance(value, bytes):
+                blocks.append(value)
+                legacy = legacy or raw_legacy
+            else:
+                blocks.append(encode_block(key, value))
+                legacy = legacy or any(len(entry) < 3 for entry in value)
+        return b"".join([MAGIC, bytes([FORMAT_VERSION, HAS_LEGACY if legacy else 0]), *blocks])
+
+    def loads(self, data: bytes) -> BinaryHistories:
+        if data[:len(MAGIC)] != MAGIC:
+            raise UnsupportedFormatException("Not a secretkv binary store")
+        if data[len(MAGIC)] != FORMAT_VERSION:
+            raise UnsupportedFormatException(f"Unsupported store format version {data[len(MAGIC)]}")
+
+        spans: Dict[str, Union[Span, History]] = {}
+        offset = len(MAGIC) + 2
+        unpack = BLOCK_HEADER.unpack_from
+        encode = base64.urlsafe_b64encode
+        while offset < len(data):
+            length, key_length = unpack(data, offset)
+            start = offset + BLOCK_HEADER.size
+            spans[encode(data[start:start + key_length]).decode()] = (offset, start + key_length, offset + 4 + length)
+            offset += 4 + length
+        return BinaryHistories(data, spans, legacy=bool(data[len(MAGIC) + 1] & HAS_LEGACY))
+
+    def stored(self, file: Path, data: bytes, stamp: Tuple[int, int]) -> None:
+        try:
+            BlockIndex(file).update(data, stamp)
+        except OSError:
+            # Only a cache; lookups fall back to loading the store.
+            pass
+
+
+class BinaryHistories(MutableMapping[str, History]):
+    def __init__(self, data: bytes, spans: Dict[str, Union[Span, History]], legacy: bool = False) -> None:
+        self._data = data
+        # Whether any entry may predate tombstone flags, see Repository.migrate_tombstones.
+        self.legacy = legacy
+        # Raw spans until decoded; a single dict keeps the insertion order.
+        self._entries = spans
+
+    def raw_items(self) -> Iterator[Tuple[str, Union[bytes, History]]]:
+        """Items with every history that was never decoded as its raw block."""
+        for key, value in self._entries.items():
+            yield key, self._data[value[0]:value[2]] if isinstance(value, tuple) else value
+
+    def __getitem__(self, key: str) -> History:
+        value = self._entries[key]
+        if isinstance(value, tuple):
+            value = self._entries[key] = decode_entries(self._data, value[1], value[2])
+        return value
+
+    def __setitem__(self, key: str, value: History) -> None:
+        self._entries[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self._entries[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def encode_block(key: str, history: History) -> bytes:
+    raw_key = base64.urlsafe_b64decode(key)
+    entries = []
+    for entry in history:
+        raw_val = base64.urlsafe_b64decode(entry[0])
+        flags = LEGACY if len(entry) < 3 else DELETED if entry[2] else 0
+        entries.append(ENTRY_HEADER.pack(int(entry[1]), flags, len(raw_val)) + raw_val)
+    body = b"".join(entries)
+    return BLOCK_HEADER.pack(2 + len(raw_key) + len(body), len(raw_key)) + raw_key + body
+
+
+def decode_block(data: bytes, offset: int) -> Tuple[str, History]:
+    length, key_length = BLOCK_HEADER.unpack_from(data, offset)
+    start = offset + BLOCK_HEADER.size
+    key = base64.urlsafe_b64encode(data[start:start + key_length]).decode()
+    return key, decode_entries(data, start + key_length, offset + 4 + length)
+
+
+def decode_entries(data: bytes, offset: int, end: int) -> History:
+    history: History = []
+    encode = base64.urlsafe_b64encode
+    while offset < end:
+        version, flags, length = ENTRY_HEADER.unpack_from(data, offset)
+        offset += ENTRY_HEADER.size
+        val = encode(data[offset:offset + length]).decode()
+        history.append((val, version) if flags & LEGACY else (val, version, bool(flags & DELETED)))
+        offset += length
+    return history
+
+
+class StaleIndexException(Exception):
+    ...
+
+
+class BlockIndex:
+    """Sorted sidecar index of a binary store, read through mmap.
+
+    Maps a fingerprint of every raw key to the offset of its block, so one
+    key can be found with a binary search and a single block decode instead
+    of loading the whole store. The index records the generation of the data
+    file it was built from and is never trusted for any other.
+    """
+
+    MAGIC = b"SKVI"
+    VERSION = 1
+    # Magic, version, data file mtime_ns and size, number of slots.
+    HEADER = struct.Struct("<4sB3xqqI")
+    # The tail of a raw key is an HMAC, good enough as a fingerprint. A key and its name
+    # record share it, lookups check the key bytes.
+    SLOT = struct.Struct("<16sQ")
+
+    def __init__(self, file: Path) -> None:
+        self._file = file
+        self._index_file = file.with_name(f"{file.name}.idx")
+
+    def update(self, data: bytes, stamp: Tuple[int, int]) -> None:
+        if self._header() == stamp:
+            return
+
+        slots = []
+        offset = len(MAGIC) + 2
+        unpack, pack = BLOCK_HEADER.unpack_from, self.SLOT.pack
+        while offset < len(data):
+            length, key_length = unpack(data, offset)
+            start = offset + BLOCK_HEADER.size
+            # Packed slots sort by fingerprint, no need for tuples.
+            slots.append(pack(_fingerprint(data[start:start + key_length]), offset))
+            offset += 4 + length
+        slots.sort()
+
+        tmp = self._index_file.with_name(f"{self._index_file.name}.{uuid.uuid4()}.tmp")
+        tmp.write_bytes(self.HEADER.pack(self.MAGIC, self.VERSION, *stamp, len(slots)) + b"".join(slots))
+        os.replace(tmp, self._index_file)
+
+    def lookup(self, key: str) -> Optional[History]:
+        try:
+            raw_key = base64.urlsafe_b64decode(key)
+        except ValueError:
+            return None
+        fingerprint = _fingerprint(raw_key)
+        with self._open() as (index, data):
+            count = self.HEADER.unpack_from(index)[4]
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if self._slot(index, middle)[0] < fingerprint:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            for slot in range(low, count):
+                slot_fingerprint, offset = self._slot(index, slot)
+                if slot_fingerprint != fingerprint:
+                    break
+                length, key_length = BLOCK_HEADER.unpack_from(data, offset)
+                block = data[offset + BLOCK_HEADER.size:offset + 4 + length]
+                if block[:key_length] == raw_key:
+                    return decode_entries(block, key_length, len(block))
+        return None
+
+    def count(self) -> int:
+        with self._open() as (index, _):
+            return int(self.HEADER.unpack_from(index)[4])
+
+    def clear(self) -> None:
+        self._index_file.unlink(missing_ok=True)
+
+    def _slot(self, index: mmap.mmap, slot: int) -> Tuple[bytes, int]:
+        return self.SLOT.unpack_from(index, self.HEADER.size + slot * self.SLOT.size)
+
+    def _header(self) -> Optional[Tuple[int, int]]:
+        try:
+            with self._index_file.open("rb") as f:
+                magic, version, mtime, size, _ = self.HEADER.unpack(f.read(self.HEADER.size))
+        except (OSError, struct.error):
+            return None
+        return (mtime, size) if magic == self.MAGIC and version == self.VERSION else None
+
+    @contextmanager
+    def _open(self) -> Iterator[Tuple[mmap.mmap, mmap.mmap]]:
+        try:
+            with self._file.open("rb") as data_file, self._index_file.open("rb") as index_file:
+                stat = os.fstat(data_file.fileno())
+                with mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index, mmap.mmap(
+                    data_file.fileno(), 0, access=mmap.ACCESS_READ
+                ) as data:
+                    magic, version, mtime, size, _ = self.HEADER.unpack_from(index)
+                    if (magic, version, mtime, size) != (self.MAGIC, self.VERSION, stat.st_mtime_ns, stat.st_size):
+                        raise StaleIndexException("Index doesn't match the store")
+                    yield index, data
+        except (OSError, ValueError, struct.error) as e:
+            raise StaleIndexException("Index unavailable") from e
+
+
+def read_flags(file: Path) -> int:
+    with file.open("rb") as f:
+        header = f.read(len(MAGIC) + 2)
+    if header[:len(MAGIC)] != MAGIC or len(header) < len(MAGIC) + 2:
+        raise UnsupportedFormatException("Not a secretkv binary store")
+    return header[len(MAGIC) + 1]
+
+
+def _fingerprint(raw_key: bytes) -> bytes:
+    return raw_key[-16:].rjust(16, b"\0")
@@ -5,3 +5,15 @@ SEED = os.getenv("SECRETKV_SEED")
 MASTERPASS = os.getenv("SECRETKV_MASTERPASS")
 
 TAG = os.getenv("SECRETKV_TAG") or "03d39895-5416-4db5-b743-e10c94e4227c"
+
+AGENT_SOCKET = os.getenv("SECRETKV_AGENT_SOCK") or "~/.skv/agent.sock"
+
+SERVER_SOCKET = os.getenv("SECRETKV_SERVER_SOCK") or "~/.skv/server.sock"
+
+STORAGE = os.getenv("SECRETKV_STORAGE") or "json"
+
+REKEY_DIR = os.getenv("SECRETKV_REKEY_DIR") or "~/.skv/rekey"
+
+SHARDS = int(os.getenv("SECRETKV_SHARDS") or 16)
+
+WORKERS = int(os.getenv("SECRETKV_WORKERS") or 0)
@@ -1,13 +1,21 @@
 from __future__ import annotations
 
 import base64
-from typing import Any, Optional, cast
+import hashlib
+import hmac
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar, cast
 
 from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
 from secretkv import config
+from secretkv.instrumentation import span
 
 
 class MissingCipherKeyException(Exception):
@@ -18,6 +26,26 @@ class InvalidKeyException(Exception):
     ...
 
 
+class UnsupportedKdfException(Exception):
+    ...
+
+
+KdfParams = Dict[str, Any]
+
+# What vaults created before the KDF was configurable use, with the salt taken from the seed.
+DEFAULT_KDF: KdfParams = {"algorithm": "pbkdf2", "iterations": 390000}
+
+# Blind indexes are the base64 of a kind byte and a truncated HMAC of the key name.
+# The kind bytes differ in their top bits, so the kind is the first base64 character.
+KEY_INDEX = b"\x04"
+NAME_INDEX = b"\x08"
+INDEX_SIZE = 20
+
+MIN_PBKDF2_ITERATIONS = 100000
+MIN_SCRYPT_N = 2**14
+MAX_SCRYPT_N = 2**20
+
+
 class EncryptedStr:
     def __init__(self, ciphertext: str) -> None:
         self._ciphertext = ciphertext
@@ -31,54 +59,208 @@ class EncryptedStr:
         return self._ciphertext == other._ciphertext
 
 
+T = TypeVar("T")
+R = TypeVar("R")
+
+
 class Crypto:
-    def __init__(self) -> None:
+    PARALLEL_THRESHOLD = 256
+
+    def __init__(self, workers: Optional[int] = None) -> None:
         self._seed: Optional[bytes] = None
         self._cipher: Optional[Fernet] = None
+        self._key = b""
+        self._index_key = b""
+        self._workers = workers or config.WORKERS or min(32, (os.cpu_count() or 1) + 4)
+        self._executor: Optional[ThreadPoolExecutor] = None
 
-    def configure(self, password: str) -> None:
+    def configure(self, password: str, kdf: Optional[KdfParams] = None) -> None:
         self._seed = self._digest(config.SEED or password)
 
-        key = self._derive_key_from_password(password)
+        with span("crypto.kdf"):
+            key = self._derive_key_from_password(password, kdf or DEFAULT_KDF)
+        self.configure_from_key(self._seed, key)
+
+    def configure_from_key(self, seed: bytes, key: bytes) -> None:
+        self._seed = seed
         self._cipher = Fernet(key)
+        self._key = key
+        self._index_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b"secretkv blind index",
+        ).derive(base64.urlsafe_b64decode(key))
+
+    def export_key(self) -> Tuple[bytes, bytes]:
+        if not self._cipher:
+            raise MissingCipherKeyException("Cipher not configured")
+
+        return cast(bytes, self._seed), self._key
 
     def encrypt(self, msg: str, deterministic: bool = False) -> EncryptedStr:
         if not self._cipher:
             raise MissingCipherKeyException("Cipher not configured")
 
+        with span("crypto.encrypt"):
+            return self._encrypt_chunk([msg], deterministic)[0]
+
+    def decrypt(self, msg: EncryptedStr) -> str:
+        if not self._cipher:
+            raise MissingCipherKeyException("Cipher not configured")
+
+        with span("crypto.decrypt"):
+            return self._decrypt_chunk([msg])[0]
+
+    def encrypt_many(self, msgs: Sequence[str], deterministic: bool = False) -> List[EncryptedStr]:
+        with span("crypto.encrypt"):
+            return self._map(lambda chunk: self._encrypt_chunk(chunk, deterministic), msgs)
+
+    def decrypt_many(self, msgs: Sequence[EncryptedStr]) -> List[str]:
+        with span("crypto.decrypt"):
+            return self._map(self._decrypt_chunk, msgs)
+
+    def index(self, msg: str) -> EncryptedStr:
+        """Blind index of a key name, a keyed hash that's the same every time for the same key."""
+        with span("crypto.index"):
+            return self._index_chunk([msg])[0]
+
+    def index_many(self, msgs: Sequence[str]) -> List[EncryptedStr]:
+        with span("crypto.index"):
+            return self._index_chunk(msgs)
+
+    def reencrypt_many(self, msgs: Sequence[EncryptedStr], source: Crypto) -> List[EncryptedStr]:
+        """Encrypts what `source` decrypts from each token, keeping its timestamp."""
+        if not source._cipher:
+            raise MissingCipherKeyException("Cipher not configured")
+
+        with span("crypto.reencrypt"):
+            return self._map(lambda chunk: self._reencrypt_chunk(chunk, source), msgs)
+
+    def _map(self, func: Callable[[Sequence[T]], List[R]], msgs: Sequence[T]) -> List[R]:
+        if not self._cipher:
+            raise MissingCipherKeyException("Cipher not configured")
+
+        if len(msgs) < self.PARALLEL_THRESHOLD or self._workers < 2:
+            return func(msgs)
+
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(self._workers)
+
+        size = -(-len(msgs) // self._workers)
+        chunks = [msgs[i:i + size] for i in range(0, len(msgs), size)]
+        return [result for results in self._executor.map(func, chunks) for result in results]
+
+    def _encrypt_chunk(self, msgs: Sequence[str], deterministic: bool) -> List[EncryptedStr]:
+        cipher = cast(Fernet, self._cipher)
         try:
             if not deterministic:
-                return EncryptedStr(self._cipher.encrypt(msg.encode()).decode())
-
-            return EncryptedStr(
-                self._cipher._encrypt_from_parts(
-                    msg.encode(),
-                    len(msg),
-                    cast(bytes, self._seed)[16:],
-                ).decode()
-            )
+                return [EncryptedStr(cipher.encrypt(msg.encode()).decode()) for msg in msgs]
+
+            iv = cast(bytes, self._seed)[16:]
+            return [EncryptedStr(cipher._encrypt_from_parts(msg.encode(), len(msg), iv).decode()) for msg in msgs]
         except InvalidToken:
             raise InvalidKeyException("Invalid key")
 
-    def decrypt(self, msg: EncryptedStr) -> str:
-        if not self._cipher:
+    def _reencrypt_chunk(self, msgs: Sequence[EncryptedStr], source: Crypto) -> List[EncryptedStr]:
+        encrypt_at_time = cast(Fernet, self._cipher).encrypt_at_time
+        return [
+            EncryptedStr(encrypt_at_time(val.encode(), token_timestamp(msg)).decode())
+            for msg, val in zip(msgs, source._decrypt_chunk(msgs))
+        ]
+
+    def _index_chunk(self, msgs: Sequence[str]) -> List[EncryptedStr]:
+        if not self._index_key:
             raise MissingCipherKeyException("Cipher not configured")
 
+        key, digest, encode = self._index_key, hmac.digest, base64.urlsafe_b64encode
+        return [
+            EncryptedStr(encode(KEY_INDEX + digest(key, msg.encode(), hashlib.sha256)[:INDEX_SIZE]).decode())
+            for msg in msgs
+        ]
+
+    def _decrypt_chunk(self, msgs: Sequence[EncryptedStr]) -> List[str]:
+        decrypt = cast(Fernet, self._cipher).decrypt
         try:
-            return self._cipher.decrypt(str(msg).encode()).decode()
+            return [decrypt(str(msg).encode()).decode() for msg in msgs]
         except InvalidToken:
             raise InvalidKeyException("Invalid key")
 
-    def _derive_key_from_password(self, password: str) -> bytes:
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=cast(bytes, self._seed)[:16],
-            iterations=390000,
-        )
-        return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+    def _derive_key_from_password(self, password: str, kdf: KdfParams) -> bytes:
+        try:
+            salt = base64.b64decode(kdf["salt"], validate=True) if "salt" in kdf else cast(bytes, self._seed)[:16]
+        except (TypeError, ValueError) as e:
+            raise UnsupportedKdfException("Invalid kdf salt") from e
+        return base64.urlsafe_b64encode(_kdf(kdf, salt).derive(password.encode()))
 
     def _digest(self, msg: str) -> bytes:
         digest = hashes.Hash(hashes.SHA256())
         digest.update(msg.encode())
         return digest.finalize()
+
+
+def name_index(key: EncryptedStr) -> EncryptedStr:
+    """Where the encrypted name of the key indexed by `key` is stored."""
+    return EncryptedStr(_NAME_PREFIX + str(key)[1:])
+
+
+def is_name_index(key: EncryptedStr) -> bool:
+    return str(key)[:1] == _NAME_PREFIX
+
+
+def is_legacy_key(key: EncryptedStr) -> bool:
+    """Whether `key` is a key name encrypted deterministically, from before blind indexes."""
+    return str(key)[:1] == _LEGACY_PREFIX
+
+
+_NAME_PREFIX = base64.urlsafe_b64encode(NAME_INDEX).decode()[0]
+# Every Fernet token starts with the version byte 0x80.
+_LEGACY_PREFIX = base64.urlsafe_b64encode(b"\x80").decode()[0]
+
+
+def token_timestamp(token: EncryptedStr) -> int:
+    """Seconds since the epoch when a Fernet token was made, readable without the key."""
+    return int.from_bytes(base64.urlsafe_b64decode(str(token))[1:9], "big")
+
+
+def new_kdf(algorithm: str = "pbkdf2", target_ms: Optional[float] = None) -> KdfParams:
+    """Parameters for a new vault, with a random salt and sized to take about `target_ms` here."""
+    kdf = dict(DEFAULT_KDF) if algorithm == "pbkdf2" else {"algorithm": "scrypt", "n": MIN_SCRYPT_N, "r": 8, "p": 1}
+    if target_ms is not None:
+        kdf = calibrate_kdf(kdf, target_ms)
+    return {**kdf, "salt": base64.b64encode(os.urandom(16)).decode()}
+
+
+def calibrate_kdf(kdf: KdfParams, target_ms: float) -> KdfParams:
+    # Both costs grow linearly, time a cheap derivation and scale it up.
+    if kdf["algorithm"] == "pbkdf2":
+        probe = {**kdf, "iterations": MIN_PBKDF2_ITERATIONS // 10}
+        # Long enough for the fixed setup cost not to skew the estimate.
+        while (elapsed := _time_kdf(probe)) < 50:
+            probe["iterations"] *= 2
+        iterations = int(probe["iterations"] * target_ms / elapsed)
+        return {**kdf, "iterations": max(MIN_PBKDF2_ITERATIONS, iterations)}
+
+    probe = {**kdf, "n": MIN_SCRYPT_N // 4}
+    ms_per_n = _time_kdf(probe) / probe["n"]
+    n = MIN_SCRYPT_N
+    while n < MAX_SCRYPT_N and ms_per_n * 2 * n <= target_ms:
+        n *= 2
+    return {**kdf, "n": n}
+
+
+def _time_kdf(kdf: KdfParams) -> float:
+    start = time.perf_counter()
+    _kdf(kdf, bytes(16)).derive(b"calibration")
+    return max((time.perf_counter() - start) * 1000, 1e-3)
+
+
+def _kdf(kdf: KdfParams, salt: bytes) -> Any:
+    try:
+        if kdf["algorithm"] == "pbkdf2":
+            return PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=int(kdf["iterations"]))
+        if kdf["algorithm"] == "scrypt":
+            return Scrypt(salt=salt, length=32, n=int(kdf["n"]), r=int(kdf["r"]), p=int(kdf["p"]))
+    except (KeyError, TypeError, ValueError) as e:
+        raise UnsupportedKdfException(f"Invalid kdf parameters {kdf}") from e
+    raise UnsupportedKdfException(f"Unsupported kdf {kdf.get('algorithm')}")
@@ -1,10 +1,44 @@
 from __future__ import annotations
 
-from typing import NamedTuple
+from typing import List, NamedTuple, Optional
 
-from secretkv.crypto import EncryptedStr
+from secretkv.crypto import EncryptedStr, token_timestamp
 
 
 class Secret(NamedTuple):
     key: EncryptedStr
     val: EncryptedStr
+    deleted: bool = False
+
+
+class RetentionPolicy(NamedTuple):
+    """How much of a key's history is kept, unset fields keep everything.
+
+    Ages are in seconds and come from the timestamp of each value's token.
+    The latest version of a key is only ever dropped by purging the key.
+    """
+
+    keep_versions: Optional[int] = None
+    max_age: Optional[float] = None
+    purge_deleted_after: Optional[float] = None
+
+    def override(self, policy: RetentionPolicy) -> RetentionPolicy:
+        return self._replace(**{name: value for name, value in policy._asdict().items() if value is not None})
+
+    def retain(self, history: List[Secret], now: float) -> List[Secret]:
+        if not history:
+            return []
+
+        latest = history[-1]
+        if (
+            latest.deleted
+            and self.purge_deleted_after is not None
+            and now - token_timestamp(latest.val) >= self.purge_deleted_after
+        ):
+            return []
+
+        kept = history[-self.keep_versions:] if self.keep_versions else history
+        if self.max_age is not None:
+            max_age = self.max_age
+            kept = [secret for secret in kept[:-1] if now - token_timestamp(secret.val) < max_age] + kept[-1:]
+        return kept
@@ -1,12 +1,43 @@
+from __future__ import annotations
+
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
+from secretkv import config
 from secretkv.application import Repository
+from secretkv.codec import HAS_LEGACY, BinaryCodec, BlockIndex, Codec, JsonCodec, StaleIndexException, read_flags
 from secretkv.crypto import EncryptedStr
 from secretkv.domain import Secret
-from secretkv.utils import PersistentDict as PDict
+from secretkv.instrumentation import span
+from secretkv.utils import FileLock, PersistentDict as PDict, locked
+
+R = TypeVar("R")
 
-SecretsHistory = List[Tuple[str, int]]
+SecretsHistory = List[Tuple[Any, ...]]
 SecretsMapping = Union[
     Dict[str, SecretsHistory],
     PDict[str, SecretsHistory],
@@ -16,91 +47,960 @@ SecretsMapping = Union[
 class InMemoryRepository(Repository):
     def __init__(self) -> None:
         self._secrets: SecretsMapping = {}
+        self._meta: Dict[str, Any] = {}
+        self._generation = 0
 
-    def list_latest_version(self) -> List[Secret]:
+    def list_latest_version(self, include_deleted: bool = True) -> List[Secret]:
         secrets = []
-        for key, values in self._secrets.items():
-            values.sort(key=lambda x: x[1])
-
-            secrets.append(
-                Secret(
-                    EncryptedStr(key),
-                    EncryptedStr(values[-1][0]),
-                )
-            )
+        for key, history in self._secrets.items():
+            secret = self._to_secret(EncryptedStr(key), history[-1])
+            if include_deleted or not secret.deleted:
+                secrets.append(secret)
 
         return secrets
 
     def retrieve_by_key(self, key: EncryptedStr) -> Optional[Secret]:
-        if not (history := self._retrieve_history_by_key(key)):
+        if not (history := self._secrets.get(str(key))):
             return None
 
-        val, _ = history[-1]
-        secret = Secret(key, EncryptedStr(val))
-        return secret
+        return self._to_secret(key, history[-1])
 
     def retireve_history_from_key(self, key: EncryptedStr) -> List[Secret]:
         return [
-            Secret(key, EncryptedStr(secret[0]))
-            for secret in self._retrieve_history_by_key(key)
+            self._to_secret(key, entry)
+            for entry in self._secrets.get(str(key), [])
         ]
 
     def save(self, secret: Secret) -> bool:
-        latest = self._find_latest_version_number(secret.key)
-        self._secrets[str(secret.key)] = self._secrets.get(str(secret.key), []) + [
+        history = self._secrets.get(str(secret.key)) or []
+        history.append(
             (
                 str(secret.val),
-                latest + 1,
+                self._latest_version_number(history) + 1,
+                secret.deleted,
             )
+        )
+        self._secrets[str(secret.key)] = history
+        self._generation += 1
+        return True
+
+    def migrate_tombstones(self, classify: Callable[[List[EncryptedStr]], List[bool]]) -> bool:
+        legacy = [
+            (key, i)
+            for key, history in self._secrets.items()
+            for i, entry in enumerate(history)
+            if len(entry) < 3
         ]
+        if not legacy:
+            return False
+
+        histories: Dict[str, SecretsHistory] = {}
+        flags = classify([EncryptedStr(self._secrets[key][i][0]) for key, i in legacy])
+        for (key, i), deleted in zip(legacy, flags):
+            history = histories.setdefault(key, [tuple(entry) for entry in self._secrets[key]])
+            val, version = history[i]
+            history[i] = (val, version, deleted)
+
+        for key, history in histories.items():
+            self._secrets[key] = history
+        self._generation += 1
         return True
 
     def is_empty(self) -> bool:
         return len(self._secrets) == 0
 
-    def _retrieve_history_by_key(self, key: EncryptedStr) -> SecretsHistory:
-        values = [(val, version) for val, version in self._secrets.get(str(key), [])]
-        values.sort(key=lambda x: x[1])
-        return values
+    def generation(self) -> Hashable:
+        return self._generation
+
+    def replace(self, secrets: Iterable[Secret]) -> bool:
+        repository = InMemoryRepository()
+        repository.save_many(secrets)
+        self._secrets = repository._secrets
+        self._generation += 1
+        return True
+
+    def iter_histories(self) -> Iterator[List[Secret]]:
+        for key in self._secrets:
+            yield self.retireve_history_from_key(EncryptedStr(key))
+
+    def get_meta(self, name: str) -> Any:
+        return self._meta.get(name)
+
+    def set_meta(self, name: str, value: Any) -> bool:
+        self._meta[name] = value
+        return True
 
     def _find_latest_version_number(self, key: EncryptedStr) -> int:
-        if history := self._retrieve_history_by_key(key):
-            return history[-1][1]
+        return self._latest_version_number(self._secrets.get(str(key), []))
+
+    @staticmethod
+    def _latest_version_number(history: SecretsHistory) -> int:
+        if history:
+            return int(history[-1][1])
         return 0
 
+    @staticmethod
+    def _to_secret(key: EncryptedStr, entry: Tuple[Any, ...]) -> Secret:
+        return Secret(key, EncryptedStr(entry[0]), len(entry) > 2 and bool(entry[2]))
+
 
 class FileRepository(Repository):
-    def __init__(self, file: str = "~/.skv/secrets.json") -> None:
+    """Single file store, safe to write from several processes at once.
+
+    The file is json by default, or the compact binary format with
+    `codec=BinaryCodec()`; `migrate_from` seeds a new file from a json store.
+
+    Writers spool their records to `<file>.pending/` and then take the file
+    lock. Whoever holds it applies every spooled record in a single rewrite,
+    so writers queued behind the lock usually find theirs already committed.
+    Spools are renamed to `.commit` before the rewrite and removed after it;
+    one left behind by a crash is only applied where it's missing.
+
+    Binary stores keep a sorted key index next to the file, `<file>.idx`, and
+    answer single key reads from it until the store has been loaded.
+    Metadata lives in a json file of its own, `<file>.meta`.
+    """
+
+    def __init__(
+        self,
+        file: str = "~/.skv/secrets.json",
+        codec: Optional[Codec] = None,
+        migrate_from: Optional[str] = None,
+    ) -> None:
+        if migrate_from:
+            self._migrate(Path(file).expanduser(), Path(migrate_from).expanduser(), codec or JsonCodec())
+
         self._implementation = InMemoryRepository()
-        self._implementation._secrets = PDict(file=file)
+        self._implementation._secrets = self._secrets = PDict[str, SecretsHistory](file=file, codec=codec)
         self._file = Path(file)
+        self._pending = self._file.expanduser().with_name(f"{self._file.name}.pending")
+        self._index = BlockIndex(self._file.expanduser()) if isinstance(codec, BinaryCodec) else None
+        self._meta = _MetaFile(_meta_file_of(self._file.expanduser()))
+        self._depth = 0
+
+    def __enter__(self) -> FileRepository:
+        self._secrets.__enter__()
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._depth -= 1
+        self._secrets.__exit__(*exc_info)
+
+    def flush(self) -> None:
+        self._secrets.flush()
 
-    def list_latest_version(self) -> List[Secret]:
+    def list_latest_version(self, include_deleted: bool = True) -> List[Secret]:
         try:
-            return self._implementation.list_latest_version()
+            return self._implementation.list_latest_version(include_deleted)
         except Exception:
             return []
 
     def retrieve_by_key(self, key: EncryptedStr) -> Optional[Secret]:
+        try:
+            history = self._lookup(key)
+            return self._implementation._to_secret(key, history[-1]) if history else None
+        except StaleIndexException:
+            pass
+
         try:
             return self._implementation.retrieve_by_key(key)
         except Exception:
             return None
 
     def retireve_history_from_key(self, key: EncryptedStr) -> List[Secret]:
+        try:
+            return [self._implementation._to_secret(key, entry) for entry in self._lookup(key) or []]
+        except StaleIndexException:
+            pass
+
         try:
             return self._implementation.retireve_history_from_key(key)
         except Exception:
             return []
 
     def save(self, secret: Secret) -> bool:
+        return self.save_many([secret])
+
+    def save_many(self, secrets: Iterable[Secret]) -> bool:
+        if self._depth:
+            # The caller holds the lock and writes back when its block ends.
+            return self._implementation.save_many(secrets)
+
+        try:
+            spooled = self._spool(secrets)
+        except (OSError, ValueError):
+            return False
+
+        try:
+            return self._commit(spooled)
+        except (OSError, ValueError):
+            spooled.unlink(missing_ok=True)
+            spooled.with_suffix(".commit").unlink(missing_ok=True)
+            return False
+
+    def replace(self, secrets: Iterable[Secret]) -> bool:
         try:
-            return self._implementation.save(secret)
+            repository = InMemoryRepository()
+            repository.save_many(secrets)
         except Exception:
             return False
+        return self.replace_histories(dict(repository._secrets))
+
+    def replace_histories(self, histories: Dict[str, SecretsHistory]) -> bool:
+        try:
+            self._secrets.replace(histories)
+        except Exception:
+            return False
+        return True
+
+    def iter_histories(self) -> Iterator[List[Secret]]:
+        return self._implementation.iter_histories()
+
+    def get_meta(self, name: str) -> Any:
+        return self._meta.get(name)
+
+    def set_meta(self, name: str, value: Any) -> bool:
+        return self._meta.set(name, value)
+
+    def exclusive(self) -> ContextManager[Any]:
+        return self
+
+    def migrate_tombstones(self, classify: Callable[[List[EncryptedStr]], List[bool]]) -> bool:
+        with self._secrets:
+            # Binary stores know up front, saves decoding every history to find out.
+            if self._index is not None and not read_flags(self._file.expanduser()) & HAS_LEGACY:
+                return False
+            return self._implementation.migrate_tombstones(classify)
 
     def is_empty(self) -> bool:
-        return len(self._implementation._secrets) == 0
+        if self._index is not None and not self._secrets.is_cached():
+            try:
+                return self._index.count() == 0
+            except StaleIndexException:
+                pass
+        return len(self._secrets) == 0
+
+    def generation(self) -> Hashable:
+        try:
+            return self._secrets.stamp()
+        except OSError:
+            return None
 
     def clear(self) -> None:
         self._file.unlink()
+        self._secrets.lock_file.unlink(missing_ok=True)
+        shutil.rmtree(self._pending, ignore_errors=True)
+        self._meta.clear()
+        if self._index is not None:
+            self._index.clear()
+
+    @classmethod
+    def _migrate(cls, file: Path, source: Path, codec: Codec) -> None:
+        if file.exists() or not source.exists():
+            return
+
+        file.parent.mkdir(parents=True, exist_ok=True)
+        # The metadata goes first, a store without its kdf parameters can't be unlocked.
+        if (meta := _meta_file_of(source)).exists():
+            cls._create(_meta_file_of(file), meta.read_bytes())
+        cls._create(file, codec.dumps(json.loads(source.read_text())))
+
+    @staticmethod
+    def _create(file: Path, data: bytes) -> None:
+        tmp = file.with_name(f"{file.name}.{uuid.uuid4()}.tmp")
+        tmp.write_bytes(data)
+        try:
+            # Unlike a rename, never clobbers a file another process just created.
+            os.link(tmp, file)
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink()
+
+    def _lookup(self, key: EncryptedStr) -> Optional[SecretsHistory]:
+        # A loaded store is as fast and may hold writes the index hasn't seen.
+        if self._index is None or self._secrets.is_cached():
+            raise StaleIndexException("Index not in use")
+        with span("store.index"):
+            return self._index.lookup(str(key))
+
+    def _spool(self, secrets: Iterable[Secret]) -> Path:
+        self._pending.mkdir(exist_ok=True)
+        # Names sort in submission order, which keeps versions in order.
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+        tmp = self._pending / f"{name}.tmp"
+        tmp.write_text(json.dumps([[str(secret.key), str(secret.val), secret.deleted] for secret in secrets]))
+        return tmp.rename(self._pending / f"{name}.json")
+
+    def _commit(self, spooled: Path) -> bool:
+        with self._secrets:
+            # Renamed by a writer that died before cleaning up, maybe after its rewrite.
+            interrupted = sorted(self._pending.glob("*.commit"))
+            if not spooled.exists() and not interrupted:
+                return True
+
+            self._implementation.save_many(self._unapplied(self._read_spools(interrupted)))
+            batch = [file.rename(file.with_suffix(".commit")) for file in sorted(self._pending.glob("*.json"))]
+            self._implementation.save_many(self._read_spools(batch))
+            self._secrets.flush()
+            for file in interrupted + batch:
+                file.unlink()
+        return True
+
+    def _unapplied(self, secrets: List[Secret]) -> List[Secret]:
+        # Values are encrypted with a random IV, one already in the history was applied.
+        return [
+            secret
+            for secret in secrets
+            if all(entry[0] != str(secret.val) for entry in self._secrets.get(str(secret.key)) or [])
+        ]
+
+    @staticmethod
+    def _read_spools(files: List[Path]) -> List[Secret]:
+        return [
+            Secret(EncryptedStr(key), EncryptedStr(val), deleted)
+            for file in files
+            for key, val, deleted in json.loads(file.read_text())
+        ]
+
+
+class ShardedFileRepository(Repository):
+    """Json store split across shard files by a hash of the encrypted key.
+
+    `manifest.json` holds the shard count. While resharding it also holds the
+    target count: writes go to the new layout, reads look at the new layout
+    first and fall back to the old one until every shard has been moved.
+    """
+
+    def __init__(
+        self,
+        directory: str = "~/.skv/secrets.d",
+        shards: int = config.SHARDS,
+        workers: Optional[int] = None,
+    ) -> None:
+        self._directory = Path(directory).expanduser()
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._layout_lock = self._directory / "layout.lock"
+        self._manifest = PDict[str, int](file=str(self._directory / "manifest.json"))
+        with self._manifest:
+            if "shards" not in self._manifest:
+                self._manifest["shards"] = shards
+        self._meta = _MetaFile(self._directory / "meta.json")
+        self._shards: Dict[Tuple[int, int], FileRepository] = {}
+        # The thread holding the layout lock exclusively through `exclusive`.
+        self._owner: Optional[int] = None
+        self._workers = workers or None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @staticmethod
+    def shard_of(key: str, count: int) -> int:
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % count
+
+    def list_latest_version(self, include_deleted: bool = True) -> List[Secret]:
+        shards = [self._shard(count, index) for count in self._layouts() for index in range(count)]
+        seen = set()
+        secrets = []
+        # Newest layout first, so a key that was already moved shadows its old copy.
+        for secret in itertools.chain.from_iterable(self._map(lambda shard: shard.list_latest_version(), shards)):
+            if str(secret.key) in seen:
+                continue
+            seen.add(str(secret.key))
+            if include_deleted or not secret.deleted:
+                secrets.append(secret)
+        return secrets
+
+    def retrieve_by_key(self, key: EncryptedStr) -> Optional[Secret]:
+        for count in self._layouts():
+            if secret := self._shard(count, self.shard_of(str(key), count)).retrieve_by_key(key):
+                return secret
+        return None
+
+    def retireve_history_from_key(self, key: EncryptedStr) -> List[Secret]:
+        new, *old = [
+            self._shard(count, self.shard_of(str(key), count)).retireve_history_from_key(key)
+            for count in self._layouts()
+        ]
+        if old and old[0] and not (new and new[0].val == old[0][0].val):
+            return old[0] + new
+        return new
+
+    def save(self, secret: Secret) -> bool:
+        return self.save_many([secret])
+
+    def save_many(self, secrets: Iterable[Secret]) -> bool:
+        # Shared with other writers, exclusive with a reshard switching layouts.
+        with self._locked_layout(shared=True):
+            count = self._layouts()[0]
+            groups: Dict[int, List[Secret]] = {}
+            for secret in secrets:
+                groups.setdefault(self.shard_of(str(secret.key), count), []).append(secret)
+            return all([self._shard(count, index).save_many(group) for index, group in groups.items()])
+
+    def replace(self, secrets: Iterable[Secret]) -> bool:
+        repository = InMemoryRepository()
+        repository.save_many(secrets)
+        with self._locked_layout():
+            layouts = self._layouts()
+            count = layouts[0]
+            groups: Dict[int, Dict[str, SecretsHistory]] = {index: {} for index in range(count)}
+            for key, history in repository._secrets.items():
+                groups[self.shard_of(key, count)][key] = history
+            if not all([self._shard(count, index).replace_histories(group) for index, group in groups.items()]):
+                return False
+            self._finish(layouts)
+        return True
+
+    def migrate_tombstones(self, classify: Callable[[List[EncryptedStr]], List[bool]]) -> bool:
+        shards = [self._shard(count, index) for count in self._layouts() for index in range(count)]
+        return any([shard.migrate_tombstones(classify) for shard in shards])
+
+    def is_empty(self) -> bool:
+        return all(self._shard(count, index).is_empty() for count in self._layouts() for index in range(count))
+
+    def generation(self) -> Hashable:
+        return tuple(
+            self._shard(count, index).generation() for count in self._layouts() for index in range(count)
+        )
+
+    def get_meta(self, name: str) -> Any:
+        return self._meta.get(name)
+
+    def set_meta(self, name: str, value: Any) -> bool:
+        return self._meta.set(name, value)
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        if self._owner == threading.get_ident():
+            yield
+            return
+
+        with locked(self._layout_lock):
+            self._owner = threading.get_ident()
+            try:
+                yield
+            finally:
+                self._owner = None
+
+    def reshard(self, count: int) -> None:
+        with self._locked_layout():
+            layouts = self._layouts()
+            if len(layouts) == 1:
+                if layouts[0] == count:
+                    return
+                with self._manifest:
+                    self._manifest["target"] = count
+                layouts = [count, *layouts]
+
+        if layouts[0] != count:
+            # An interrupted reshard to another count has to be finished first.
+            self.reshard(layouts[0])
+            self.reshard(count)
+            return
+
+        for index in range(layouts[-1]):
+            self._move(self._shard(layouts[-1], index), count)
+
+        with self._locked_layout():
+            self._finish(self._layouts())
+
+    def close(self) -> None:
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    def clear(self) -> None:
+        self.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _locked_layout(self, shared: bool = False) -> ContextManager[None]:
+        # Already held exclusively by this thread, a second flock would wait on itself.
+        if self._owner == threading.get_ident():
+            return nullcontext()
+        return locked(self._layout_lock, shared)
+
+    def _layouts(self) -> List[int]:
+        manifest = dict(self._manifest.items())
+        if "target" in manifest:
+            return [manifest["target"], manifest["shards"]]
+        return [manifest["shards"]]
+
+    def _shard(self, count: int, index: int) -> FileRepository:
+        if (shard := self._shards.get((count, index))) is None:
+            shard = FileRepository(str(self._directory / f"shard-{count}-{index:04d}.json"))
+            self._shards[(count, index)] = shard
+        return shard
+
+    def _move(self, source: FileRepository, count: int) -> None:
+        groups: Dict[int, Dict[str, SecretsHistory]] = {}
+        for key, history in source._secrets.items():
+            groups.setdefault(self.shard_of(key, count), {})[key] = history
+
+        for index, group in groups.items():
+            with self._shard(count, index)._secrets as secrets:
+                for key, old in group.items():
+                    new = secrets.get(key) or []
+                    if new and new[0][0] == old[0][0]:
+                        continue
+                    # Whatever was written during the reshard is newer than the old history.
+                    secrets[key] = [(entry[0], i + 1, *entry[2:]) for i, entry in enumerate([*old, *new])]
+
+    def _finish(self, layouts: List[int]) -> None:
+        with self._manifest:
+            self._manifest["shards"] = layouts[0]
+            self._manifest.pop("target", None)
+
+        self._shards = {layout: shard for layout, shard in self._shards.items() if layout[0] == layouts[0]}
+        for path in self._directory.glob("shard-*.json"):
+            if not path.name.startswith(f"shard-{layouts[0]}-"):
+                FileRepository(str(path)).clear()
+
+    def _map(self, func: Callable[[FileRepository], R], shards: List[FileRepository]) -> List[R]:
+        if len(shards) < 2:
+            return [func(shard) for shard in shards]
+
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(self._workers)
+        return list(self._executor.map(func, shards))
+
+
+class LogRepository(Repository):
+    def __init__(self, file: str = "~/.skv/secrets.log", compact_threshold: int = 1000) -> None:
+        self._implementation = InMemoryRepository()
+        self._file = Path(file).expanduser()
+        self._meta = _MetaFile(_meta_file_of(self._file))
+        self._lock = FileLock(self._lock_file())
+        self._compact_threshold = compact_threshold
+        # Where the replayed part of the log ends, and which file it was read
+        # from; another process compacting swaps the file for a new inode.
+        self._offset = 0
+        self._inode: Optional[int] = None
+        self._appended = 0
+
+        self._file.parent.mkdir(parents=True, exist_ok=True)
+        self._file.touch()
+        with span("store.load"):
+            self._refresh()
+
+    def list_latest_version(self, include_deleted: bool = True) -> List[Secret]:
+        self._refresh()
+        return self._implementation.list_latest_version(include_deleted)
+
+    def retrieve_by_key(self, key: EncryptedStr) -> Optional[Secret]:
+        self._refresh()
+        return self._implementation.retrieve_by_key(key)
+
+    def retireve_history_from_key(self, key: EncryptedStr) -> List[Secret]:
+        self._refresh()
+        return self._implementation.retireve_history_from_key(key)
+
+    def save(self, secret: Secret) -> bool:
+        return self.save_many([secret])
+
+    def save_many(self, secrets: Iterable[Secret]) -> bool:
+        secrets = list(secrets)
+        with self._lock:
+            # Number versions after everything other writers appended so far.
+            self._refresh(exclusive=True)
+            versions: Dict[str, int] = {}
+            records = []
+            for secret in secrets:
+                key = str(secret.key)
+                version = versions.get(key) or self._implementation._find_latest_version_number(secret.key)
+                versions[key] = version + 1
+                records.append(json.dumps([key, str(secret.val), version + 1, secret.deleted]) + "\n")
+
+            data = "".join(records).encode()
+            try:
+                with span("store.save"), self._file.open("ab") as f:
+                    f.write(data)
+            except OSError:
+                return False
+
+            # Only apply to memory what is known to be on disk.
+            self._implementation.save_many(secrets)
+            self._offset += len(data)
+            self._appended += len(records)
+            if self._appended >= self._compact_threshold:
+                self.compact()
+        return True
+
+    def is_empty(self) -> bool:
+        self._refresh()
+        return self._implementation.is_empty()
+
+    def generation(self) -> Hashable:
+        self._refresh()
+        return self._implementation.generation()
+
+    def iter_histories(self) -> Iterator[List[Secret]]:
+        self._refresh()
+        return self._implementation.iter_histories()
+
+    def get_meta(self, name: str) -> Any:
+        return self._meta.get(name)
+
+    def set_meta(self, name: str, value: Any) -> bool:
+        return self._meta.set(name, value)
+
+    def exclusive(self) -> ContextManager[Any]:
+        return self._lock
+
+    def migrate_tombstones(self, classify: Callable[[List[EncryptedStr]], List[bool]]) -> bool:
+        with self._lock:
+            self._refresh(exclusive=True)
+            if not self._implementation.migrate_tombstones(classify):
+                return False
+            try:
+                self.compact()
+            except OSError:
+                self._reset()
+                raise
+        return True
+
+    def replace(self, secrets: Iterable[Secret]) -> bool:
+        implementation = InMemoryRepository()
+        implementation.save_many(secrets)
+        with self._lock:
+            try:
+                self._write_snapshot(implementation)
+            except OSError:
+                return False
+
+            implementation._generation = self._implementation._generation + 1
+            self._implementation = implementation
+        return True
+
+    def compact(self) -> None:
+        with self._lock:
+            self._refresh(exclusive=True)
+            self._write_snapshot(self._implementation)
+
+    def _write_snapshot(self, implementation: InMemoryRepository) -> None:
+        tmp = self._file.with_name(self._file.name + ".tmp")
+        with span("store.save"), tmp.open("w") as f:
+            for key, history in implementation._secrets.items():
+                f.write(json.dumps([key, history]) + "\n")
+        os.replace(tmp, self._file)
+
+        stat = self._file.stat()
+        self._inode, self._offset, self._appended = stat.st_ino, stat.st_size, 0
+
+    def clear(self) -> None:
+        self._file.unlink()
+        self._meta.clear()
+        self._lock_file().unlink(missing_ok=True)
+
+    def _lock_file(self) -> Path:
+        return self._file.with_name(f"{self._file.name}.lock")
+
+    def _reset(self) -> None:
+        generation = self._implementation._generation
+        self._implementation = InMemoryRepository()
+        self._implementation._generation = generation + 1
+        self._inode, self._offset, self._appended = None, 0, 0
+
+    def _refresh(self, exclusive: bool = False) -> None:
+        """Replay whatever other processes appended since the last read.
+
+        A partial last line is a write still in progress, unless `exclusive`
+        is set: then no writer can be running and the torn record is cut off.
+        """
+        try:
+            f = self._file.open("rb")
+        except FileNotFoundError:
+            if self._inode is not None:
+                self._reset()
+            return
+
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._reset()
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return
+
+            f.seek(self._offset)
+            data = f.read()
+
+        complete = data.rfind(b"\n") + 1
+        if exclusive and complete < len(data):
+            with self._file.open("r+b") as torn:
+                torn.truncate(self._offset + complete)
+
+        self._appended += self._apply(data[:complete])
+        self._offset += complete
+
+    def _apply(self, data: bytes) -> int:
+        appended = 0
+        secrets = self._implementation._secrets
+        for line in data.splitlines():
+            record = json.loads(line)
+            if len(record) == 2:
+                key, history = record
+                secrets[key] = [tuple(entry) for entry in history]
+            else:
+                key, *entry = record
+                secrets.setdefault(key, []).append(tuple(entry))
+                appended += 1
+
+        if data:
+            self._implementation._generation += 1
+        return appended
+
+
+class SqliteRepository(Repository):
+    def __init__(self, file: str = "~/.skv/secrets.db", migrate_from: Optional[str] = None) -> None:
+        self._file = Path(file).expanduser()
+        self._file.parent.mkdir(parents=True, exist_ok=True)
+
+        self._connection = sqlite3.connect(str(self._file), check_same_thread=False)
+        self._exclusive = False
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS secrets (
+                    key TEXT NOT NULL,
+                    val TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    deleted INTEGER,
+                    PRIMARY KEY (key, version)
+                )
+                """
+            )
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(secrets)")]
+            if "deleted" not in columns:
+                self._connection.execute("ALTER TABLE secrets ADD COLUMN deleted INTEGER")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+        if migrate_from and self.is_empty() and (legacy := Path(migrate_from).expanduser()).exists():
+            self.migrate_json(str(legacy))
+
+    def list_latest_version(self, include_deleted: bool = True) -> List[Secret]:
+        with span("store.read"):
+            rows = self._connection.execute(
+                """
+                SELECT secrets.key, secrets.val, secrets.deleted FROM secrets JOIN (
+                    SELECT key, MAX(version) AS version, MIN(rowid) AS created FROM secrets GROUP BY key
+                ) AS latest USING (key, version)
+                WHERE ? OR NOT COALESCE(secrets.deleted, 0)
+                ORDER BY latest.created
+                """,
+                (include_deleted,),
+            ).fetchall()
+        return [Secret(EncryptedStr(key), EncryptedStr(val), bool(deleted)) for key, val, deleted in rows]
+
+    def retrieve_by_key(self, key: EncryptedStr) -> Optional[Secret]:
+        with span("store.read"):
+            row = self._connection.execute(
+                "SELECT val, deleted FROM secrets WHERE key = ? ORDER BY version DESC LIMIT 1",
+                (str(key),),
+            ).fetchone()
+        if not row:
+            return None
+        return Secret(key, EncryptedStr(row[0]), bool(row[1]))
+
+    def retireve_history_from_key(self, key: EncryptedStr) -> List[Secret]:
+        with span("store.read"):
+            rows = self._connection.execute(
+                "SELECT val, deleted FROM secrets WHERE key = ? ORDER BY version",
+                (str(key),),
+            ).fetchall()
+        return [Secret(key, EncryptedStr(val), bool(deleted)) for val, deleted in rows]
+
+    def save(self, secret: Secret) -> bool:
+        return self.save_many([secret])
+
+    def save_many(self, secrets: Iterable[Secret]) -> bool:
+        try:
+            with span("store.save"), self._transaction():
+                self._insert(secrets)
+        except sqlite3.Error:
+            return False
+        return True
+
+    def replace(self, secrets: Iterable[Secret]) -> bool:
+        try:
+            with span("store.save"), self._transaction():
+                self._connection.execute("DELETE FROM secrets")
+                self._insert(secrets)
+        except sqlite3.Error:
+            return False
+        return True
+
+    def is_empty(self) -> bool:
+        return self._connection.execute("SELECT 1 FROM secrets LIMIT 1").fetchone() is None
+
+    def generation(self) -> Hashable:
+        data_version, = self._connection.execute("PRAGMA data_version").fetchone()
+        return data_version, self._connection.total_changes
+
+    def iter_histories(self) -> Iterator[List[Secret]]:
+        rows = self._connection.execute(
+            """
+            SELECT secrets.key, secrets.val, secrets.deleted FROM secrets JOIN (
+                SELECT key, MIN(rowid) AS created FROM secrets GROUP BY key
+            ) AS first USING (key)
+            ORDER BY first.created, secrets.version
+            """
+        )
+        for key, group in itertools.groupby(rows, key=lambda row: str(row[0])):
+            yield [Secret(EncryptedStr(key), EncryptedStr(val), bool(deleted)) for _, val, deleted in group]
+
+    def get_meta(self, name: str) -> Any:
+        row = self._connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, name: str, value: Any) -> bool:
+        try:
+            with self._transaction():
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, json.dumps(value))
+                )
+        except sqlite3.Error:
+            return False
+        return True
+
+    def migrate_tombstones(self, classify: Callable[[List[EncryptedStr]], List[bool]]) -> bool:
+        legacy = self._connection.execute("SELECT rowid, val FROM secrets WHERE deleted IS NULL").fetchall()
+        if not legacy:
+            return False
+
+        flags = classify([EncryptedStr(val) for _, val in legacy])
+        with self._transaction():
+            self._connection.executemany(
+                "UPDATE secrets SET deleted = ? WHERE rowid = ?",
+                [(deleted, rowid) for (rowid, _), deleted in zip(legacy, flags)],
+            )
+        return True
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        if self._exclusive:
+            yield
+            return
+
+        # Takes the write lock up front, other writers wait until the commit.
+        self._connection.execute("BEGIN IMMEDIATE")
+        self._exclusive = True
+        try:
+            yield
+        except BaseException:
+            self._connection.rollback()
+            raise
+        else:
+            self._connection.commit()
+        finally:
+            self._exclusive = False
+
+    def migrate_json(self, file: str) -> int:
+        source = Path(file).expanduser()
+        secrets: Dict[str, SecretsHistory] = json.loads(source.read_text())
+        rows = [
+            (key, val, version, deleted[0] if deleted else None)
+            for key, history in secrets.items()
+            for val, version, *deleted in history
+        ]
+        meta_file = _meta_file_of(source)
+        meta: Dict[str, Any] = json.loads(meta_file.read_text()) if meta_file.exists() else {}
+        with self._transaction():
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO secrets (key, val, version, deleted) VALUES (?, ?, ?, ?)", rows
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)",
+                [(name, json.dumps(value)) for name, value in meta.items()],
+            )
+        return len(rows)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        if not self._exclusive:
+            with self._connection:
+                yield
+            return
+
+        # Inside `exclusive` a failed write only rolls back itself, the block commits.
+        self._connection.execute("SAVEPOINT write")
+        try:
+            yield
+        except BaseException:
+            self._connection.execute("ROLLBACK TO write")
+            raise
+        finally:
+            self._connection.execute("RELEASE write")
+
+    def _insert(self, secrets: Iterable[Secret]) -> None:
+        self._connection.executemany(
+            """
+            INSERT INTO secrets (key, val, version, deleted)
+            SELECT ?, ?, COALESCE(MAX(version), 0) + 1, ? FROM secrets WHERE key = ?
+            """,
+            ((str(secret.key), str(secret.val), secret.deleted, str(secret.key)) for secret in secrets),
+        )
+
+    def clear(self) -> None:
+        self.close()
+        for suffix in ["", "-wal", "-shm"]:
+            Path(f"{self._file}{suffix}").unlink(missing_ok=True)
+
+
+def _meta_file_of(file: Path) -> Path:
+    return file.with_name(f"{file.name}.meta")
+
+
+class _MetaFile:
+    """Json metadata next to a store, only created once something is set."""
+
+    def __init__(self, file: Path) -> None:
+        self._file = file
+        self._data: Optional[PDict[str, Any]] = None
+
+    def get(self, name: str) -> Any:
+        if self._data is None and not self._file.exists():
+            return None
+        return self._open().get(name)
+
+    def set(self, name: str, value: Any) -> bool:
+        try:
+            self._open()[name] = value
+        except (OSError, ValueError, TypeError):
+            return False
+        return True
+
+    def clear(self) -> None:
+        if self._data is not None:
+            self._data.lock_file.unlink(missing_ok=True)
+        self._file.unlink(missing_ok=True)
+        self._data = None
+
+    def _open(self) -> PDict[str, Any]:
+        if self._data is None:
+            self._data = PDict[str, Any](file=str(self._file), span_name="meta")
+        return self._data
+
+
+class InvalidStorageException(Exception):
+    ...
+
+
+REPOSITORIES: Dict[str, Callable[[], Repository]] = {
+    "json": FileRepository,
+    "binary": lambda: FileRepository("~/.skv/secrets.skv", BinaryCodec(), migrate_from="~/.skv/secrets.json"),
+    "log": LogRepository,
+    "sqlite": lambda: SqliteRepository(migrate_from="~/.skv/secrets.json"),
+    "sharded": ShardedFileRepository,
+}
+
+
+def create_repository(storage: str = config.STORAGE) -> Repository:
+    if storage not in REPOSITORIES:
+        raise InvalidStorageException(f"Unknown storage {storage}")
+    return REPOSITORIES[storage]()
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+
+class Sink:
+    def record(self, name: str, seconds: float) -> None:
+        ...
+
+    def flush(self) -> None:
+        ...
+
+
+class NullSink(Sink):
+    ...
+
+
+class AggregatingSink(Sink):
+    def __init__(self) -> None:
+        self._spans: Dict[str, Tuple[int, float]] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        count, total = self._spans.get(name, (0, 0.0))
+        self._spans[name] = (count + 1, total + seconds)
+
+    def spans(self) -> List[Dict[str, Any]]:
+        return [
+            {"name": name, "count": count, "seconds": total}
+            for name, (count, total) in self._spans.items()
+        ]
+
+
+class StderrSink(AggregatingSink):
+    def __init__(self, stream: Optional[TextIO] = None) -> None:
+        super().__init__()
+        self._stream = stream
+
+    def flush(self) -> None:
+        stream = self._stream or sys.stderr
+        for span in self.spans():
+            stream.write(f"{span['name']:<32} {span['count']:>6}x {span['seconds'] * 1000:>10.3f} ms\n")
+
+
+class JsonFileSink(AggregatingSink):
+    def __init__(self, file: str) -> None:
+        super().__init__()
+        self._file = Path(file).expanduser()
+
+    def flush(self) -> None:
+        self._file.write_text(json.dumps({"spans": self.spans()}, indent=2))
+
+
+_sink: Sink = NullSink()
+
+
+def get_sink() -> Sink:
+    return _sink
+
+
+def set_sink(sink: Sink) -> Sink:
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    sink = _sink
+    if isinstance(sink, NullSink):
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        sink.record(name, time.perf_counter() - start)
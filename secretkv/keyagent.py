@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import base64
+import json
+import os
+import socket
+import struct
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from secretkv import config
+
+if TYPE_CHECKING:
+    from secretkv.crypto import Crypto
+
+KeyMaterial = Tuple[bytes, bytes]
+
+_SOL_LOCAL = 0
+_XUCRED = "IIh16I"
+
+
+class AgentUnavailableException(Exception):
+    ...
+
+
+def is_supported() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+
+class Agent:
+    def __init__(
+        self,
+        crypto: Crypto,
+        socket_path: str = config.AGENT_SOCKET,
+        ttl: float = 900,
+    ) -> None:
+        self._crypto = crypto
+        self._socket_path = Path(socket_path).expanduser()
+        self._ttl = ttl
+
+    def serve(self) -> None:
+        if not is_supported():
+            raise AgentUnavailableException("Unix domain sockets are not supported")
+
+        self._socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if request_key(str(self._socket_path)):
+            raise AgentUnavailableException("Agent already running")
+        self._socket_path.unlink(missing_ok=True)
+
+        server = listen(self._socket_path)
+        try:
+            deadline = time.monotonic() + self._ttl
+            while (remaining := deadline - time.monotonic()) > 0:
+                server.settimeout(remaining)
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+
+                # A client that stalls or hangs up only loses its own request.
+                try:
+                    with conn:
+                        if self._handle(conn):
+                            deadline = time.monotonic() + self._ttl
+                except OSError:
+                    continue
+        finally:
+            server.close()
+            self._socket_path.unlink(missing_ok=True)
+
+    def _handle(self, conn: socket.socket) -> bool:
+        if not peer_is_owner(conn):
+            return False
+
+        conn.settimeout(1)
+        request = conn.makefile("r").readline().strip()
+        if request == "touch":
+            # Sent once the key opened the vault, a key that doesn't fit never renews the agent.
+            conn.sendall(b"{}\n")
+            return True
+        if request != "key":
+            return False
+
+        seed, key = self._crypto.export_key()
+        response = {
+            "seed": base64.b64encode(seed).decode(),
+            "key": base64.b64encode(key).decode(),
+        }
+        conn.sendall(json.dumps(response).encode() + b"\n")
+        return False
+
+
+def request_key(socket_path: str = config.AGENT_SOCKET, timeout: float = 1) -> Optional[KeyMaterial]:
+    path = Path(socket_path).expanduser()
+    if not is_supported() or not path.exists():
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(str(path))
+            client.sendall(b"key\n")
+            response = json.loads(client.makefile("r").readline())
+        return base64.b64decode(response["seed"]), base64.b64decode(response["key"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def touch(socket_path: str = config.AGENT_SOCKET, timeout: float = 1) -> bool:
+    """Tells the agent its key was used, which restarts its idle ttl."""
+    path = Path(socket_path).expanduser()
+    if not is_supported() or not path.exists():
+        return False
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(str(path))
+            client.sendall(b"touch\n")
+            return bool(client.makefile("r").readline())
+    except OSError:
+        return False
+
+
+def listen(path: Path) -> socket.socket:
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(str(path))
+    finally:
+        os.umask(umask)
+
+    os.chmod(path, 0o600)
+    server.listen()
+    return server
+
+
+def peer_is_owner(conn: socket.socket) -> bool:
+    # Fail closed: without a way to ask the kernel who is connected, the 0600
+    # socket mode alone is not trusted to keep other users out.
+    uid = _peer_uid(conn)
+    return uid is not None and uid == os.getuid()
+
+
+def _peer_uid(conn: socket.socket) -> Optional[int]:
+    if hasattr(socket, "SO_PEERCRED"):
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        _, uid, _ = struct.unpack("3i", creds)
+        return int(uid)
+
+    if hasattr(socket, "LOCAL_PEERCRED"):
+        # BSD and macOS: struct xucred {cr_version, cr_uid, cr_ngroups, cr_groups[16]} at level SOL_LOCAL.
+        try:
+            creds = conn.getsockopt(_SOL_LOCAL, socket.LOCAL_PEERCRED, struct.calcsize(_XUCRED))
+        except OSError:
+            return None
+        _, uid, *_ = struct.unpack(_XUCRED, creds)
+        return int(uid)
+
+    return None
@@ -1,10 +1,8 @@
 from argparse import ArgumentParser
 from typing import Optional, Sequence
 
-from secretkv import SecretKV
 from secretkv.cli import Cli
-from secretkv.crypto import Crypto
-from secretkv.infrastructure import FileRepository
+from secretkv.instrumentation import JsonFileSink, StderrSink, set_sink, span
 
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
@@ -13,14 +11,36 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
 
     command = cli.parse(argv)
 
-    app = SecretKV(
-        FileRepository(),
-        Crypto(),
-    )
+    sink = None
+    if command.timings:
+        sink = StderrSink() if command.timings == "-" else JsonFileSink(command.timings)
+        set_sink(sink)
 
-    if output := command.execute(dependencies={"app": app}):
+    with span("main.forward"):
+        forwarded = command.forward()
+
+    if forwarded is not None:
+        output = command.output(forwarded)
+    else:
+        with span("main.open"):
+            from secretkv.application import SecretKV
+            from secretkv.crypto import Crypto
+            from secretkv.infrastructure import create_repository
+
+            app = SecretKV(
+                create_repository(),
+                Crypto(),
+            )
+
+        with span("main.command"):
+            output = command.execute(dependencies={"app": app})
+
+    if output:
         Cli.show_output(output)
 
+    if sink:
+        sink.flush()
+
     return 0
 
 
@@ -1,31 +1,66 @@
-from typing import Dict, List, Optional
+import itertools
+import json
+import os
+import sys
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, TextIO
 
 from secretkv import config
-from secretkv.application import SecretKV
+from secretkv.application import SecretKV, StaleRekeyException, UnnamedKeysException
+from secretkv.crypto import Crypto, InvalidKeyException, UnsupportedKdfException, new_kdf
+from secretkv.domain import RetentionPolicy
+from secretkv.keyagent import Agent, AgentUnavailableException
+from secretkv.server import Server, ServerUnavailableException
 from secretkv.utils import Result, Status
 
+DUMP_FORMAT = "skv-dump/1"
+
+
+def init(
+    app: SecretKV,
+    password: Optional[str],
+    kdf: str = "pbkdf2",
+    target_ms: Optional[float] = None,
+) -> Result[Dict[str, List[str]]]:
+    if not app.repository.is_empty():
+        return Result[Dict[str, List[str]]](Status.Err, {"message": ["Vault already has secrets, use skv rekey"]})
+
+    params = new_kdf(kdf, target_ms)
+    if not app.initialize(params):
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    _unlock(app, password)
+    if not app.verify_password():
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    data = {"kdf": [f"{name}: {value}" for name, value in params.items() if name != "salt"]}
+    return Result[Dict[str, List[str]]](Status.Ok, data)
+
 
 def list(
     app: SecretKV,
-    password: str,
+    password: Optional[str],
     all: bool = False,
+    prefix: Optional[str] = None,
+    glob: Optional[str] = None,
 ) -> Result[Dict[str, List[str]]]:
-    app.crypto.configure(password)
+    _unlock(app, password)
 
     if not app.verify_password():
         return Result[Dict[str, List[str]]](Status.Err, {})
 
-    data = {"keys": [k for k in app.list_every_key(all) if k != config.TAG]}
+    data = {"keys": [k for k in app.list_every_key(all, prefix or "", glob or None) if k != config.TAG]}
     return Result[Dict[str, List[str]]](Status.Ok, data)
 
 
 def get(
     app: SecretKV,
     key: str,
-    password: str,
+    password: Optional[str],
     history: bool = False,
 ) -> Result[Dict[str, List[str]]]:
-    app.crypto.configure(password)
+    _unlock(app, password)
 
     if (
         not key
@@ -48,9 +83,9 @@ def set(
     app: SecretKV,
     key: str,
     val: str,
-    password: str,
+    password: Optional[str],
 ) -> Result[Dict[str, List[str]]]:
-    app.crypto.configure(password)
+    _unlock(app, password)
 
     if (
         not key
@@ -67,9 +102,9 @@ def set(
 def delete(
     app: SecretKV,
     key: str,
-    password: str,
+    password: Optional[str],
 ) -> Result[Dict[str, List[str]]]:
-    app.crypto.configure(password)
+    _unlock(app, password)
 
     if (
         not key
@@ -83,20 +118,299 @@ def delete(
     return Result[Dict[str, List[str]]](Status.Ok, {})
 
 
+def batch(
+    app: SecretKV,
+    password: Optional[str],
+    input: Optional[str] = None,
+    output: Optional[str] = None,
+) -> Result[Dict[str, List[str]]]:
+    _unlock(app, password)
+
+    if not app.verify_password():
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    try:
+        with ExitStack() as files:
+            source = files.enter_context(open(input)) if input else sys.stdin
+            sink = files.enter_context(open(output, "w")) if output else sys.stdout
+            for op, group in itertools.groupby(_read_operations(source), key=lambda x: x.get("op")):
+                for result in _apply_operations(app, op, [*group]):
+                    sink.write(json.dumps(result) + "\n")
+    except OSError:
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    return Result[Dict[str, List[str]]](Status.Ok, {})
+
+
 def dump(
     app: SecretKV,
-    password: str,
+    password: Optional[str],
     plaintext: bool = False,
     output: Optional[str] = None,
-) -> None:
-    app.crypto.configure(password)
-    ...
+) -> Result[Dict[str, List[str]]]:
+    _unlock(app, password)
+
+    if not app.verify_password():
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    try:
+        with ExitStack() as files:
+            sink = (
+                files.enter_context(os.fdopen(os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w"))
+                if output
+                else sys.stdout
+            )
+            header = {"format": DUMP_FORMAT, "plaintext": plaintext}
+            if not plaintext:
+                # Ciphertext only opens with the key derived the same way.
+                header["kdf"] = app.kdf_params()
+            sink.write(json.dumps(header) + "\n")
+            for record in app.dump(plaintext):
+                sink.write(json.dumps(record) + "\n")
+    except OSError:
+        return Result[Dict[str, List[str]]](Status.Err, {})
+    except UnnamedKeysException as e:
+        # An incomplete dump mustn't pass for a backup.
+        if output:
+            Path(output).unlink(missing_ok=True)
+        return Result[Dict[str, List[str]]](Status.Err, {"message": [str(e)]})
+
+    return Result[Dict[str, List[str]]](Status.Ok, {})
 
 
 def restore(
     app: SecretKV,
-    password: str,
+    password: Optional[str],
+    file: str,
     replace: bool = False,
-) -> None:
-    app.crypto.configure(password)
-    ...
+) -> Result[Dict[str, List[str]]]:
+    try:
+        with open(file) as source:
+            header = json.loads(source.readline())
+            if header.get("format") != DUMP_FORMAT:
+                return Result[Dict[str, List[str]]](Status.Err, {})
+
+            plaintext = bool(header.get("plaintext"))
+            kdf = None if plaintext else header.get("kdf")
+            if password is not None and isinstance(kdf, dict) and _is_new_vault(app):
+                # A lost vault comes back with the key derivation its ciphertext was made with,
+                # stored once it's known to work.
+                app.crypto.configure(password, kdf)
+                app.initialize(kdf)
+            else:
+                _unlock(app, password)
+
+            if not app.verify_password():
+                return Result[Dict[str, List[str]]](Status.Err, {})
+
+            records = (json.loads(line) for line in source if line.strip())
+            if not app.restore(records, plaintext, replace):
+                return Result[Dict[str, List[str]]](Status.Err, {})
+    except (OSError, ValueError, KeyError, TypeError, AttributeError, InvalidKeyException, UnsupportedKdfException):
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    return Result[Dict[str, List[str]]](Status.Ok, {})
+
+
+def bench(
+    app: SecretKV,
+    password: Optional[str],
+    sizes: Sequence[int] = (1000, 10000, 100000),
+    depth: int = 3,
+    ops: int = 100,
+    repositories: Sequence[str] = ("memory", "json"),
+    output: Optional[str] = None,
+) -> Result[Dict[str, List[str]]]:
+    from secretkv import benchmark
+
+    try:
+        with ExitStack() as files:
+            # Opened first, a bad path shouldn't cost a whole benchmark run.
+            sink = files.enter_context(open(output, "w")) if output else sys.stdout
+            results = benchmark.run(sizes, depth, ops, repositories)
+            sink.write(json.dumps(results, indent=2) + "\n")
+    except OSError:
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    return Result[Dict[str, List[str]]](Status.Ok, {})
+
+
+def agent(
+    app: SecretKV,
+    password: Optional[str],
+    ttl: float = 900,
+) -> Result[Dict[str, List[str]]]:
+    _unlock(app, password)
+
+    if not app.verify_password():
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    try:
+        Agent(app.crypto, ttl=ttl).serve()
+    except AgentUnavailableException as e:
+        return Result[Dict[str, List[str]]](Status.Ok, {"message": [str(e)]})
+    except KeyboardInterrupt:
+        pass
+
+    return Result[Dict[str, List[str]]](Status.Ok, {})
+
+
+def serve(
+    app: SecretKV,
+    password: Optional[str],
+) -> Result[Dict[str, List[str]]]:
+    _unlock(app, password)
+
+    if not app.verify_password():
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    try:
+        Server(app).serve()
+    except ServerUnavailableException as e:
+        return Result[Dict[str, List[str]]](Status.Ok, {"message": [str(e)]})
+    except KeyboardInterrupt:
+        pass
+
+    return Result[Dict[str, List[str]]](Status.Ok, {})
+
+
+def reshard(
+    app: SecretKV,
+    password: Optional[str],
+    shards: int,
+) -> Result[Dict[str, List[str]]]:
+    from secretkv.infrastructure import ShardedFileRepository
+
+    if not isinstance(app.repository, ShardedFileRepository):
+        return Result[Dict[str, List[str]]](Status.Ok, {"message": ["Storage is not sharded"]})
+    if shards < 1:
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    app.repository.reshard(shards)
+    return Result[Dict[str, List[str]]](Status.Ok, {})
+
+
+def retention(
+    app: SecretKV,
+    password: Optional[str],
+    key: Optional[str] = None,
+    keep: Optional[int] = None,
+    max_age: Optional[float] = None,
+    purge_deleted: Optional[float] = None,
+    clear: bool = False,
+) -> Result[Dict[str, List[str]]]:
+    _unlock(app, password)
+
+    if key == config.TAG or not app.verify_password():
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    changes = RetentionPolicy(keep, max_age, purge_deleted)
+    if not clear and changes == RetentionPolicy():
+        policy = app.retention_policy(key)
+        data = {"retention": [f"{name}: {_format_value(name, value)}" for name, value in policy._asdict().items()]}
+        return Result[Dict[str, List[str]]](Status.Ok, data)
+
+    policy = (RetentionPolicy() if clear else app.retention_policy(key)).override(changes)
+    if not app.set_retention_policy(policy, key):
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    return Result[Dict[str, List[str]]](Status.Ok, {})
+
+
+def compact(
+    app: SecretKV,
+    password: Optional[str],
+) -> Result[Dict[str, List[str]]]:
+    _unlock(app, password)
+
+    if not app.verify_password() or (dropped := app.compact()) is None:
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    versions, keys = dropped
+    return Result[Dict[str, List[str]]](Status.Ok, {"message": [f"Dropped {versions} versions and {keys} keys"]})
+
+
+def rekey(
+    app: SecretKV,
+    password: Optional[str],
+    new_masterpass: str,
+    staging: str = config.REKEY_DIR,
+) -> Result[Dict[str, List[str]]]:
+    _unlock(app, password)
+
+    if not new_masterpass or not app.verify_password():
+        return Result[Dict[str, List[str]]](Status.Err, {})
+
+    crypto = Crypto()
+    crypto.configure(new_masterpass, app.kdf_params())
+    try:
+        if not app.rekey(crypto, staging):
+            return Result[Dict[str, List[str]]](Status.Err, {})
+    except (StaleRekeyException, UnnamedKeysException) as e:
+        return Result[Dict[str, List[str]]](Status.Ok, {"message": [str(e)]})
+
+    return Result[Dict[str, List[str]]](Status.Ok, {})
+
+
+def _format_value(name: str, value: Any) -> str:
+    if value is None:
+        return "-"
+    if name == "keep_versions":
+        return str(value)
+
+    for unit, seconds in [("d", 86400), ("h", 3600), ("m", 60)]:
+        if value >= seconds and value % seconds == 0:
+            return f"{value // seconds:g}{unit}"
+    return f"{value:g}s"
+
+
+def _read_operations(source: TextIO) -> Iterator[Dict[str, Any]]:
+    for line in source:
+        if not line.strip():
+            continue
+        try:
+            operation = json.loads(line)
+        except ValueError:
+            operation = None
+        yield operation if isinstance(operation, dict) else {"op": None}
+
+
+def _apply_operations(app: SecretKV, op: Optional[str], operations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    valid = [i for i, operation in enumerate(operations) if _is_valid_operation(op, operation)]
+    keys = [operations[i]["key"] for i in valid]
+
+    values: List[Any] = []
+    if op == "get":
+        values = [[val] if val else None for val in app.get_many(keys)]
+    elif op == "set":
+        values = app.set_many([(key, operations[i]["val"]) for i, key in zip(valid, keys)])
+    elif op == "delete":
+        values = app.delete_many(keys)
+
+    results: List[Any] = [None for _ in operations]
+    for i, value in zip(valid, values):
+        results[i] = value
+
+    responses = []
+    for operation, result in zip(operations, results):
+        response = {"op": op, "key": operation.get("key"), "ok": bool(result)}
+        if op == "get" and result:
+            response["values"] = result
+        responses.append(response)
+    return responses
+
+
+def _is_valid_operation(op: Optional[str], operation: Dict[str, Any]) -> bool:
+    key, val = operation.get("key"), operation.get("val")
+    if not key or not isinstance(key, str) or key == config.TAG:
+        return False
+    return op != "set" or bool(val and isinstance(val, str))
+
+
+def _is_new_vault(app: SecretKV) -> bool:
+    return app.kdf_params() is None and app.repository.is_empty()
+
+
+def _unlock(app: SecretKV, password: Optional[str]) -> None:
+    if password is not None:
+        app.unlock(password)
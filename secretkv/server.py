@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import json
+import socket
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from secretkv import config, keyagent
+from secretkv.utils import ReadWriteLock
+
+if TYPE_CHECKING:
+    from secretkv.application import SecretKV
+
+Response = Dict[str, Any]
+Handler = Callable[..., Optional[Dict[str, List[str]]]]
+
+
+class ServerUnavailableException(Exception):
+    ...
+
+
+class Server:
+    """Answers get, list, set and delete requests for an unlocked SecretKV.
+
+    Every connection is served on its own thread. Requests and responses are
+    json lines, and a client may send any number of them per connection.
+    """
+
+    WRITES = {"set", "delete"}
+
+    def __init__(self, app: SecretKV, socket_path: str = config.SERVER_SOCKET) -> None:
+        self._app = app
+        self._socket_path = Path(socket_path).expanduser()
+        self._lock = ReadWriteLock()
+        self._stopped = threading.Event()
+        self._handlers: Dict[str, Handler] = {
+            "ping": lambda: {},
+            "get": self._get,
+            "list": self._list,
+            "set": self._set,
+            "delete": self._delete,
+        }
+
+    def serve(self) -> None:
+        if not keyagent.is_supported():
+            raise ServerUnavailableException("Unix domain sockets are not supported")
+
+        self._socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if request("ping", {}, str(self._socket_path)):
+            raise ServerUnavailableException("Server already running")
+        self._socket_path.unlink(missing_ok=True)
+
+        server = keyagent.listen(self._socket_path)
+        try:
+            server.settimeout(0.2)
+            while not self._stopped.is_set():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+
+                conn.settimeout(None)
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            server.close()
+            self._socket_path.unlink(missing_ok=True)
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+
+    def dispatch(self, request: Any) -> Response:
+        if not isinstance(request, dict):
+            return {"ok": False, "data": {}}
+
+        op, args = str(request.get("op")), request.get("args", {})
+        if not (handler := self._handlers.get(op)) or not isinstance(args, dict):
+            return {"ok": False, "data": {}}
+
+        lock = self._lock.write if op in self.WRITES else self._lock.read
+        try:
+            with lock():
+                data = handler(**args)
+        except Exception:
+            # Bad arguments or a failing store answer this request, the server keeps going.
+            data = None
+
+        return {"ok": data is not None, "data": data or {}}
+
+    def _handle(self, conn: socket.socket) -> None:
+        with conn:
+            if not keyagent.peer_is_owner(conn):
+                return
+
+            for line in conn.makefile("r"):
+                try:
+                    response = self.dispatch(json.loads(line))
+                except ValueError:
+                    response = self.dispatch(None)
+                try:
+                    conn.sendall(json.dumps(response).encode() + b"\n")
+                except OSError:
+                    return
+
+    def _get(self, key: str, history: bool = False) -> Optional[Dict[str, List[str]]]:
+        if not _is_valid_key(key):
+            return None
+
+        if history:
+            vals = self._app.get_history_from_key(key)
+        else:
+            vals = [val] if (val := self._app.get_value_from_key(key)) else []
+        return {"values": vals[::-1]} if vals else None
+
+    def _list(
+        self,
+        all: bool = False,
+        prefix: Optional[str] = None,
+        glob: Optional[str] = None,
+    ) -> Optional[Dict[str, List[str]]]:
+        if not _is_optional_str(prefix) or not _is_optional_str(glob):
+            return None
+        keys = self._app.list_every_key(all, prefix or "", glob or None)
+        return {"keys": [key for key in keys if key != config.TAG]}
+
+    def _set(self, key: str, val: str) -> Optional[Dict[str, List[str]]]:
+        if not _is_valid_key(key) or not val or not isinstance(val, str):
+            return None
+        return {} if self._app.create_or_append(key, val) else None
+
+    def _delete(self, key: str) -> Optional[Dict[str, List[str]]]:
+        if not _is_valid_key(key):
+            return None
+        return {} if self._app.mark_as_deleted(key) else None
+
+
+def request(
+    op: str,
+    args: Dict[str, Any],
+    socket_path: str = config.SERVER_SOCKET,
+    timeout: float = 1,
+) -> Optional[Response]:
+    """The server's response, or None if no server could be reached.
+
+    Once connected the request may have been applied, so the caller mustn't
+    run it again: a lost or garbled reply is reported as a failed request.
+    """
+    path = Path(socket_path).expanduser()
+    if not keyagent.is_supported() or not path.exists():
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.settimeout(timeout)
+            client.connect(str(path))
+        except OSError:
+            return None
+
+        try:
+            # A long write or a big listing may take a while, wait for it.
+            client.settimeout(None)
+            client.sendall(json.dumps({"op": op, "args": args}).encode() + b"\n")
+            response = json.loads(client.makefile("r").readline())
+        except (OSError, ValueError):
+            response = None
+
+    return response if isinstance(response, dict) else {"ok": False, "data": {}}
+
+
+def _is_valid_key(key: Any) -> bool:
+    return bool(key and isinstance(key, str) and key != config.TAG)
+
+
+def _is_optional_str(value: Any) -> bool:
+    return value is None or isinstance(value, str)
@@ -1,8 +1,69 @@
-import json
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, Generic, MutableMapping, TypeVar, cast
+from typing import (
+    Any,
+    Callable,
+    Generic,
+    Iterable,
+    ItemsView,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+    TypeVar,
+    cast,
+)
+
+from secretkv.codec import Codec, JsonCodec
+from secretkv.instrumentation import span
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def _lock_file(fd: int, shared: bool = False) -> None:
+        # Windows has no shared locks, readers of the lock exclude each other.
+        while True:
+            try:
+                # LK_LOCK gives up after ~10 seconds, keep waiting like flock does.
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+
+    def _unlock_file(fd: int) -> None:
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+else:
+    import fcntl
+
+    def _lock_file(fd: int, shared: bool = False) -> None:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    def _unlock_file(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextmanager
+def locked(file: Path, shared: bool = False) -> Iterator[None]:
+    fd = os.open(file, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        _lock_file(fd, shared)
+        try:
+            yield
+        finally:
+            _unlock_file(fd)
+    finally:
+        os.close(fd)
 
 
 class Status(Enum):
@@ -24,49 +85,200 @@ class Result(Generic[RT]):
         return self.status == other.status and self.data == other.data
 
 
+T = TypeVar("T")
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    chunk: List[T] = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 KT = TypeVar("KT")
 VT = TypeVar("VT")
 
 
+class FileLock:
+    """Exclusive advisory lock on `file`, between processes and threads.
+
+    Re-entrant for the thread holding it; only the outermost `with` block
+    takes and releases the os level lock.
+    """
+
+    def __init__(self, file: Path) -> None:
+        self._file = file
+        self._thread_lock = threading.RLock()
+        self._fd: Optional[int] = None
+        self._depth = 0
+
+    def __enter__(self) -> FileLock:
+        self._thread_lock.acquire()
+        if not self._depth:
+            try:
+                fd = os.open(self._file, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    _lock_file(fd)
+                except BaseException:
+                    os.close(fd)
+                    raise
+            except BaseException:
+                self._thread_lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._depth -= 1
+        if not self._depth and self._fd is not None:
+            fd, self._fd = self._fd, None
+            try:
+                _unlock_file(fd)
+            finally:
+                os.close(fd)
+        self._thread_lock.release()
+
+
 class PersistentDict(MutableMapping[KT, VT]):
     def __init__(
         self,
         *args,
         file: str = f"/tmp/{uuid.uuid4()}",
+        codec: Optional[Codec] = None,
+        span_name: str = "store",
         **kwargs,
     ) -> None:
         self._file = Path(file).expanduser()
+        self._codec = codec or JsonCodec()
+        self._span_name = span_name
+        self._cache: Optional[MutableMapping[KT, VT]] = None
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._dirty = False
+        self._depth = 0
+        self._lock = FileLock(self.lock_file)
 
         if not self._file.exists():
             self._file.parent.mkdir(parents=True, exist_ok=True)
-            self._file.write_text("{}")
+            with self._lock:
+                if not self._file.exists():
+                    self._file.write_bytes(self._codec.dumps({}))
+
+        if args or kwargs:
+            self.update(dict(*args, **kwargs))
+
+    @property
+    def lock_file(self) -> Path:
+        return self._file.with_name(f"{self._file.name}.lock")
+
+    def __enter__(self) -> PersistentDict[KT, VT]:
+        # Holding the lock for the whole block makes read-modify-write atomic
+        # with respect to other processes writing the same file.
+        self._lock.__enter__()
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type: Any, *exc_info: Any) -> None:
+        try:
+            self._depth -= 1
+            if self._depth:
+                return
+
+            if exc_type is None:
+                self.flush()
+            elif self._dirty:
+                self._cache = None
+                self._dirty = False
+        finally:
+            self._lock.__exit__(exc_type, *exc_info)
+
+    def replace(self, dct: MutableMapping[KT, VT]) -> None:
+        with self._lock:
+            self._write(dct)
+        self._cache = dct
+        self._dirty = False
+
+    def flush(self) -> None:
+        if not self._dirty or self._cache is None:
+            return
+
+        with self._lock:
+            self._write(self._cache)
+        self._dirty = False
+
+    def _write(self, dct: MutableMapping[KT, VT]) -> None:
+        # Readers don't take the lock, so never let them see a partial file.
+        tmp = self._file.with_name(f"{self._file.name}.{uuid.uuid4()}.tmp")
+        with span(f"{self._span_name}.save"):
+            data = self._codec.dumps(dct)
+            tmp.write_bytes(data)
+            os.replace(tmp, self._file)
+        self._stamp = self._stat()
+        self._codec.stored(self._file, data, self._stamp)
 
-        self.update(dict(*args, **kwargs))
+    @property
+    def data(self) -> MutableMapping[KT, VT]:
+        return self._load()
 
-    def _load(self) -> Dict[KT, VT]:
-        return cast(Dict[KT, VT], json.loads(self._file.read_text()))
+    def stamp(self) -> Tuple[int, int]:
+        return self._stat()
 
-    def _save(self, dct: Dict[KT, VT]) -> None:
-        self._file.write_text(json.dumps(dct))
+    def is_cached(self) -> bool:
+        return self._cache is not None and (self._dirty or self._stat() == self._stamp)
+
+    def _stat(self) -> Tuple[int, int]:
+        stat = self._file.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self) -> MutableMapping[KT, VT]:
+        if self._cache is not None and self.is_cached():
+            return self._cache
+
+        stamp = self._stat()
+        with span(f"{self._span_name}.load"):
+            data = self._file.read_bytes()
+            self._cache = cast(MutableMapping[KT, VT], self._codec.loads(data))
+        self._stamp = stamp
+        self._codec.stored(self._file, data, stamp)
+        return self._cache
+
+    def _save(self, dct: MutableMapping[KT, VT]) -> None:
+        self._cache = dct
+        self._dirty = True
+        if not self._depth:
+            self.flush()
 
     def update(self, *args, **kwargs) -> None:
-        dct = self._load()
-        dct.update(dict(*args, **kwargs))
-        self._save(dct)
+        with self:
+            dct = self._load()
+            dct.update(dict(*args, **kwargs))
+            self._save(dct)
+
+    def get(self, key: KT, default: Any = None) -> Any:
+        return self._load().get(key, default)
+
+    def items(self) -> ItemsView[KT, VT]:
+        return self._load().items()
 
     def __getitem__(self, key: KT) -> VT:
         dct = self._load()
         return dct[key]
 
     def __setitem__(self, key: KT, value: VT) -> None:
-        dct = self._load()
-        dct[key] = value
-        self._save(dct)
+        with self:
+            dct = self._load()
+            dct[key] = value
+            self._save(dct)
 
     def __delitem__(self, key: KT) -> None:
-        dct = self._load()
-        del dct[key]
-        self._save(dct)
+        with self:
+            dct = self._load()
+            del dct[key]
+            self._save(dct)
 
     def __iter__(self):
         dct = self._load()
@@ -83,3 +295,93 @@ class PersistentDict(MutableMapping[KT, VT]):
     def __repr__(self) -> str:
         dct = self._load()
         return repr(dct)
+
+
+class TTLCache(Generic[KT, VT]):
+    """Least recently used entries that expire after `ttl` seconds, safe to share between threads."""
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._entries: OrderedDict[KT, Tuple[float, VT]] = OrderedDict()
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: KT) -> Optional[VT]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: KT, value: VT) -> None:
+        with self._lock:
+            self._entries[key] = (self._clock() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: KT) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ReadWriteLock:
+    """Lets any number of readers in at once, or a single writer.
+
+    A waiting writer holds back new readers so writes can't be starved.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._condition:
+            while self._writing or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
@@ -1,9 +1,32 @@
 import pytest
 from secretkv import config
 from secretkv.application import SecretKV
-from secretkv.crypto import Crypto, EncryptedStr
+from secretkv.codec import BinaryCodec
+from secretkv.crypto import Crypto, EncryptedStr, name_index
 from secretkv.domain import Secret
-from secretkv.infrastructure import FileRepository, InMemoryRepository
+from secretkv.infrastructure import (
+    FileRepository,
+    InMemoryRepository,
+    LogRepository,
+    ShardedFileRepository,
+    SqliteRepository,
+)
+
+
+def seed(repository, crypto, legacy=False):
+    secrets = [
+        (config.TAG, config.TAG[::-1], False),
+        ("key0", "", True),
+        ("key1", "val1a", False),
+        ("key1", "val1b", False),
+        ("key2", "val2", False),
+    ]
+    index = (lambda key: crypto.encrypt(key, deterministic=True)) if legacy else crypto.index
+    for key, val, deleted in secrets:
+        repository.save(Secret(index(key), crypto.encrypt(val), deleted=deleted))
+    if not legacy:
+        for key in dict.fromkeys(key for key, _, _ in secrets):
+            repository.save(Secret(name_index(crypto.index(key)), crypto.encrypt(key)))
 
 
 @pytest.fixture(scope="session")
@@ -43,26 +66,54 @@ def unconfigured_crypto():
 @pytest.fixture
 def in_memory_repository(crypto: Crypto):
     repository = InMemoryRepository()
-    repository.save(
-        Secret(crypto.encrypt(config.TAG, deterministic=True), crypto.encrypt(config.TAG[::-1]))
-    )
-    repository.save(Secret(crypto.encrypt("key0", deterministic=True), crypto.encrypt("")))
-    repository.save(Secret(crypto.encrypt("key1", deterministic=True), crypto.encrypt("val1a")))
-    repository.save(Secret(crypto.encrypt("key1", deterministic=True), crypto.encrypt("val1b")))
-    repository.save(Secret(crypto.encrypt("key2", deterministic=True), crypto.encrypt("val2")))
+    seed(repository, crypto)
+    return repository
+
+
+@pytest.fixture
+def legacy_repository(crypto: Crypto):
+    """Key names encrypted deterministically, like vaults from before blind indexes."""
+    repository = InMemoryRepository()
+    seed(repository, crypto, legacy=True)
     return repository
 
 
 @pytest.fixture
 def file_repository(crypto: Crypto):
     repository = FileRepository("test.json")
-    repository.save(
-        Secret(crypto.encrypt(config.TAG, deterministic=True), crypto.encrypt(config.TAG[::-1]))
-    )
-    repository.save(Secret(crypto.encrypt("key0", deterministic=True), crypto.encrypt("")))
-    repository.save(Secret(crypto.encrypt("key1", deterministic=True), crypto.encrypt("val1a")))
-    repository.save(Secret(crypto.encrypt("key1", deterministic=True), crypto.encrypt("val1b")))
-    repository.save(Secret(crypto.encrypt("key2", deterministic=True), crypto.encrypt("val2")))
+    seed(repository, crypto)
+    yield repository
+    repository.clear()
+
+
+@pytest.fixture
+def log_repository(crypto: Crypto):
+    repository = LogRepository("test.log")
+    seed(repository, crypto)
+    yield repository
+    repository.clear()
+
+
+@pytest.fixture
+def sqlite_repository(crypto: Crypto):
+    repository = SqliteRepository("test.db")
+    seed(repository, crypto)
+    yield repository
+    repository.clear()
+
+
+@pytest.fixture
+def binary_repository(crypto: Crypto, tmp_path):
+    repository = FileRepository(str(tmp_path / "secrets.skv"), codec=BinaryCodec())
+    seed(repository, crypto)
+    yield repository
+    repository.clear()
+
+
+@pytest.fixture
+def sharded_repository(crypto: Crypto, tmp_path):
+    repository = ShardedFileRepository(str(tmp_path / "secrets.d"), shards=4)
+    seed(repository, crypto)
     yield repository
     repository.clear()
 
@@ -0,0 +1,170 @@
+import asyncio
+
+import pytest
+
+from secretkv import config
+from secretkv.aio import AsyncSecretKV, ExecutorRepository, SingleFlight
+from secretkv.application import SecretKV
+from secretkv.crypto import Crypto, new_kdf
+from secretkv.infrastructure import InMemoryRepository, SqliteRepository
+
+
+class CountingCrypto(Crypto):
+    def __init__(self):
+        super().__init__()
+        self.configured = 0
+
+    def configure(self, password, kdf=None):
+        self.configured += 1
+        super().configure(password, kdf)
+
+
+class CountingRepository(ExecutorRepository):
+    def __init__(self, factory):
+        super().__init__(factory)
+        self.loaded = 0
+
+    async def load(self):
+        self.loaded += 1
+        await asyncio.sleep(0.01)
+        await super().load()
+
+
+@pytest.fixture(params=["in_memory_repository", "file_repository"])
+def async_skv(request, password):
+    repository = request.getfixturevalue(request.param)
+    async_repository = ExecutorRepository(lambda: repository)
+    yield AsyncSecretKV(async_repository, Crypto(), password)
+    async_repository.close()
+
+
+def test_get(async_skv):
+    assert asyncio.run(async_skv.get_value_from_key("key1")) == "val1b"
+    assert asyncio.run(async_skv.get_value_from_key("key0")) is None
+    assert asyncio.run(async_skv.get_value_from_key("missing")) is None
+
+
+def test_list_and_history(async_skv):
+    assert asyncio.run(async_skv.list_every_key()) == [config.TAG, "key1", "key2"]
+    assert asyncio.run(async_skv.get_history_from_key("key1")) == ["val1a", "val1b"]
+
+
+def test_set_and_delete(async_skv):
+    async def scenario():
+        assert await async_skv.create_or_append("key3", "val3") == "key3"
+        assert await async_skv.mark_as_deleted("key2") == "key2"
+        assert await async_skv.mark_as_deleted("key2") is None
+        assert await async_skv.set_many([("key4", "val4"), ("key1", "val1c")]) == ["key4", "key1"]
+        return await async_skv.get_many(["key1", "key2", "key3", "key4"])
+
+    assert asyncio.run(scenario()) == ["val1c", None, "val3", "val4"]
+
+
+def test_delete_many(async_skv):
+    async def scenario():
+        deleted = await async_skv.delete_many(["key1", "key0", "missing", "key1"])
+        return deleted, await async_skv.list_every_key()
+
+    assert asyncio.run(scenario()) == (["key1", None, None, None], [config.TAG, "key2"])
+
+
+def test_list_with_prefix_and_glob(async_skv):
+    async def scenario():
+        await async_skv.set_many([("prod/db/user", "u"), ("prod/api", "a"), ("dev/db/user", "d")])
+        return (
+            await async_skv.list_every_key(prefix="prod/"),
+            await async_skv.list_every_key(glob="*/db/*"),
+            await async_skv.list_every_key(prefix="prod/", glob="*/db/*"),
+        )
+
+    by_prefix, by_glob, both = asyncio.run(scenario())
+    assert sorted(by_prefix) == ["prod/api", "prod/db/user"]
+    assert sorted(by_glob) == ["dev/db/user", "prod/db/user"]
+    assert both == ["prod/db/user"]
+
+
+def test_verify_password(async_skv, wrong_password):
+    assert asyncio.run(async_skv.verify_password())
+
+    async_skv.configure(wrong_password)
+    assert not asyncio.run(async_skv.verify_password())
+
+
+def test_verify_password_on_legacy_vault(legacy_repository, crypto, password):
+    repository = ExecutorRepository(lambda: legacy_repository)
+    skv = AsyncSecretKV(repository, Crypto(), password)
+
+    assert not asyncio.run(skv.verify_password())
+    assert SecretKV(legacy_repository, crypto).verify_password()
+    assert asyncio.run(skv.verify_password())
+    assert asyncio.run(skv.list_every_key(True)) == [config.TAG, "key0", "key1", "key2"]
+    repository.close()
+
+
+def test_verify_password_initializes_empty_store(password):
+    repository = ExecutorRepository(InMemoryRepository)
+    skv = AsyncSecretKV(repository, Crypto(), password)
+
+    assert asyncio.run(skv.verify_password())
+    assert asyncio.run(skv.verify_password())
+    repository.close()
+
+
+def test_sqlite_repository_runs_on_worker_thread(tmp_path, password):
+    repository = ExecutorRepository(lambda: SqliteRepository(str(tmp_path / "secrets.db")))
+    skv = AsyncSecretKV(repository, Crypto(), password)
+
+    async def scenario():
+        await skv.create_or_append("key", "val")
+        return await skv.get_value_from_key("key")
+
+    assert asyncio.run(scenario()) == "val"
+    repository.close()
+
+
+def test_concurrent_gets_share_key_derivation_and_store_load(in_memory_repository, password):
+    crypto = CountingCrypto()
+    repository = CountingRepository(lambda: in_memory_repository)
+    skv = AsyncSecretKV(repository, crypto, password)
+
+    async def scenario():
+        return await asyncio.gather(*[skv.get_value_from_key("key1") for _ in range(20)])
+
+    assert asyncio.run(scenario()) == ["val1b"] * 20
+    assert crypto.configured == 1
+    assert repository.loaded == 1
+    repository.close()
+
+
+def test_single_flight_retries_after_failure():
+    calls = []
+
+    async def flaky():
+        calls.append(None)
+        if len(calls) == 1:
+            raise OSError
+        return len(calls)
+
+    flight = SingleFlight(flaky)
+
+    async def scenario():
+        with pytest.raises(OSError):
+            await flight()
+        return await flight(), await flight()
+
+    assert asyncio.run(scenario()) == (2, 2)
+
+
+def test_configure_uses_vault_kdf(password):
+    repository = InMemoryRepository()
+    SecretKV(repository, Crypto()).initialize(new_kdf("scrypt"))
+    async_repository = ExecutorRepository(lambda: repository)
+    try:
+        async_skv = AsyncSecretKV(async_repository, Crypto(), password)
+        assert asyncio.run(async_skv.create_or_append("key1", "val1")) == "key1"
+    finally:
+        async_repository.close()
+
+    sync_skv = SecretKV(repository, Crypto())
+    sync_skv.unlock(password)
+    assert sync_skv.get_value_from_key("key1") == "val1"
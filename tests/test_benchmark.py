@@ -0,0 +1,32 @@
+import json
+
+import secretkv
+from secretkv import benchmark
+from secretkv.utils import Status
+
+
+def test_run_covers_every_repository_and_size():
+    results = benchmark.run(sizes=[5, 10], depth=2, ops=3, repositories=sorted(benchmark.REPOSITORIES))["results"]
+
+    assert [result["benchmark"] for result in results[:4]] == [
+        "configure",
+        "index",
+        "encrypt",
+        "decrypt",
+    ]
+    assert {(result["repository"], result["size"]) for result in results[4:]} == {
+        (repository, size) for repository in benchmark.REPOSITORIES for size in [5, 10]
+    }
+    assert len(results) == 4 + 4 * len(benchmark.REPOSITORIES) * 2
+
+
+def test_bench_writes_json(tmp_path):
+    result = secretkv.bench(None, None, sizes=[5], ops=2, repositories=["memory"], output=str(tmp_path / "bench.json"))
+
+    assert result.status == Status.Ok
+    assert len(json.loads((tmp_path / "bench.json").read_text())["results"]) == 8
+
+
+def test_bench_to_missing_directory(tmp_path):
+    result = secretkv.bench(None, None, sizes=[5], ops=2, repositories=["memory"], output=str(tmp_path / "x" / "b"))
+    assert result.status == Status.Err
@@ -0,0 +1,168 @@
+import base64
+import json
+import os
+
+import pytest
+
+from secretkv import config
+from secretkv.application import SecretKV
+from secretkv.codec import BinaryCodec, BinaryHistories, BlockIndex, StaleIndexException, UnsupportedFormatException
+from secretkv.domain import Secret
+from secretkv.infrastructure import FileRepository
+from secretkv.instrumentation import AggregatingSink, set_sink
+
+
+@pytest.fixture
+def histories(crypto):
+    return {
+        str(crypto.encrypt("key0", deterministic=True)): [(str(crypto.encrypt("val0")), 1, False)],
+        str(crypto.encrypt("key1", deterministic=True)): [
+            (str(crypto.encrypt("val1a")), 1, False),
+            (str(crypto.encrypt("")), 2, True),
+        ],
+        str(crypto.encrypt("key2", deterministic=True)): [(str(crypto.encrypt("val2")), 1)],
+    }
+
+
+def test_binary_round_trip(histories):
+    codec = BinaryCodec()
+    loaded = codec.loads(codec.dumps(histories))
+
+    assert isinstance(loaded, BinaryHistories)
+    assert loaded.legacy
+    assert list(loaded) == list(histories)
+    assert dict(loaded.items()) == histories
+
+
+def test_binary_untouched_histories_are_copied_verbatim(histories, crypto):
+    codec = BinaryCodec()
+    data = codec.dumps(histories)
+    loaded = codec.loads(data)
+
+    assert codec.dumps(loaded) == data
+
+    key = str(crypto.encrypt("key3", deterministic=True))
+    loaded[key] = [(str(crypto.encrypt("val3")), 1, False)]
+    assert dict(codec.loads(codec.dumps(loaded)).items()) == {**histories, key: loaded[key]}
+
+
+def test_binary_is_smaller_than_json(histories):
+    assert len(BinaryCodec().dumps(histories)) < 0.8 * len(json.dumps(histories))
+
+
+def test_binary_legacy_flag_is_cleared(histories):
+    codec = BinaryCodec()
+    histories = {key: [(*entry[:2], False) for entry in history] for key, history in histories.items()}
+
+    assert not codec.loads(codec.dumps(histories)).legacy
+
+
+@pytest.mark.parametrize("data", [b"{}", b"SKV\x00\x02\x00"])
+def test_binary_rejects_unknown_format(data):
+    with pytest.raises(UnsupportedFormatException):
+        BinaryCodec().loads(data)
+
+
+def test_binary_store_migrates_json(tmp_path, crypto, histories):
+    legacy = tmp_path / "secrets.json"
+    legacy.write_text(json.dumps(histories))
+    path = tmp_path / "secrets.skv"
+
+    repository = FileRepository(str(path), BinaryCodec(), migrate_from=str(legacy))
+
+    assert path.read_bytes().startswith(b"SKV\x00\x01")
+    assert path.stat().st_size < legacy.stat().st_size
+    key1 = crypto.encrypt("key1", deterministic=True)
+    assert [crypto.decrypt(secret.val) for secret in repository.retireve_history_from_key(key1)] == ["val1a", ""]
+
+    repository.save(Secret(key1, crypto.encrypt("val1c")))
+    reopened = FileRepository(str(path), BinaryCodec(), migrate_from=str(legacy))
+    assert crypto.decrypt(reopened.retrieve_by_key(key1).val) == "val1c"
+
+
+def test_binary_store_migrates_tombstones_once(tmp_path, crypto, histories):
+    path = tmp_path / "secrets.skv"
+    tag = str(crypto.encrypt(config.TAG, deterministic=True))
+    path.write_bytes(BinaryCodec().dumps({tag: [(str(crypto.encrypt(config.TAG[::-1])), 1)], **histories}))
+    repository = FileRepository(str(path), BinaryCodec())
+
+    assert SecretKV(repository, crypto).verify_password()
+
+    assert not BinaryCodec().loads(path.read_bytes()).legacy
+    assert not repository.migrate_tombstones(lambda vals: pytest.fail("store already migrated"))
+
+
+def _write_indexed(path, histories):
+    data = BinaryCodec().dumps(histories)
+    path.write_bytes(data)
+    stat = path.stat()
+    BlockIndex(path).update(data, (stat.st_mtime_ns, stat.st_size))
+
+
+def test_block_index_lookup(tmp_path, crypto, histories):
+    path = tmp_path / "secrets.skv"
+    _write_indexed(path, histories)
+    index = BlockIndex(path)
+
+    assert index.count() == len(histories)
+    for key, history in histories.items():
+        assert index.lookup(key) == history
+    assert index.lookup(str(crypto.encrypt("missing", deterministic=True))) is None
+    assert index.lookup("not base64!") is None
+
+
+def test_block_index_resolves_fingerprint_collisions(tmp_path, crypto):
+    tail = os.urandom(16)
+    keys = [base64.urlsafe_b64encode(prefix * 8 + tail).decode() for prefix in (b"a", b"b", b"c")]
+    histories = {key: [(str(crypto.encrypt(key)), 1, False)] for key in keys}
+    path = tmp_path / "secrets.skv"
+    _write_indexed(path, histories)
+
+    for key in keys:
+        assert BlockIndex(path).lookup(key) == histories[key]
+
+
+def test_block_index_is_not_trusted_for_another_generation(tmp_path, histories):
+    path = tmp_path / "secrets.skv"
+    _write_indexed(path, histories)
+    path.write_bytes(BinaryCodec().dumps({}))
+
+    with pytest.raises(StaleIndexException):
+        BlockIndex(path).lookup(next(iter(histories)))
+
+
+def test_block_index_missing(tmp_path, histories):
+    path = tmp_path / "secrets.skv"
+    path.write_bytes(BinaryCodec().dumps(histories))
+
+    with pytest.raises(StaleIndexException):
+        BlockIndex(path).count()
+
+
+def test_binary_store_reads_one_key_without_loading(binary_repository, crypto, tmp_path):
+    path = str(tmp_path / "secrets.skv")
+    sink = AggregatingSink()
+    previous = set_sink(sink)
+    try:
+        app = SecretKV(FileRepository(path, BinaryCodec()), crypto)
+        assert app.verify_password()
+        assert app.get_value_from_key("key1") == "val1b"
+        assert app.get_history_from_key("key0") == [""]
+    finally:
+        set_sink(previous)
+
+    assert "store.load" not in [span["name"] for span in sink.spans()]
+
+
+def test_binary_store_rebuilds_stale_index(binary_repository, crypto, tmp_path):
+    path = tmp_path / "secrets.skv"
+    (tmp_path / "secrets.skv.idx").unlink()
+    key = crypto.index("key1")
+
+    assert crypto.decrypt(FileRepository(str(path), BinaryCodec()).retrieve_by_key(key).val) == "val1b"
+
+    # The fallback load left a fresh index behind.
+    assert BlockIndex(path).count() == len(BinaryCodec().loads(path.read_bytes()))
+    FileRepository(str(path), BinaryCodec()).save(Secret(key, crypto.encrypt("val1c")))
+    assert crypto.decrypt(BinaryCodec().loads(path.read_bytes())[str(key)][-1][0]) == "val1c"
+    assert crypto.decrypt(FileRepository(str(path), BinaryCodec()).retrieve_by_key(key).val) == "val1c"
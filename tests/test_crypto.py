@@ -1,6 +1,21 @@
 import pytest
+from cryptography.fernet import Fernet
 
-from secretkv.crypto import MissingCipherKeyException
+from secretkv.crypto import (
+    DEFAULT_KDF,
+    MIN_PBKDF2_ITERATIONS,
+    MIN_SCRYPT_N,
+    Crypto,
+    InvalidKeyException,
+    MissingCipherKeyException,
+    UnsupportedKdfException,
+    calibrate_kdf,
+    is_legacy_key,
+    is_name_index,
+    name_index,
+    new_kdf,
+    token_timestamp,
+)
 
 
 def test_encrypt_deterministic(crypto, plaintext, ciphertext):
@@ -8,6 +23,24 @@ def test_encrypt_deterministic(crypto, plaintext, ciphertext):
     assert result == ciphertext
 
 
+def test_index(crypto, plaintext, ciphertext, wrong_password):
+    other = Crypto()
+    other.configure(wrong_password)
+
+    index = crypto.index(plaintext)
+
+    assert index == crypto.index(plaintext) and crypto.index_many([plaintext, "other"])[0] == index
+    assert len(str(index)) == 28 and str(index) != str(other.index(plaintext))
+    assert not is_name_index(index) and not is_legacy_key(index)
+    assert is_name_index(name_index(index)) and str(name_index(index))[1:] == str(index)[1:]
+    assert is_legacy_key(ciphertext)
+
+
+def test_unconfigured_crypto_on_index(unconfigured_crypto, plaintext):
+    with pytest.raises(MissingCipherKeyException):
+        unconfigured_crypto.index(plaintext)
+
+
 def test_decrypt(crypto, plaintext, ciphertext):
     result = crypto.decrypt(ciphertext)
     assert result == plaintext
@@ -26,3 +59,80 @@ def test_uncofigured_crypto_on_encrypt(unconfigured_crypto, plaintext):
 def test_uncofigured_crypto_on_decrypt(unconfigured_crypto, ciphertext):
     with pytest.raises(MissingCipherKeyException):
         unconfigured_crypto.decrypt(ciphertext)
+
+
+def test_encrypt_many_deterministic(crypto, plaintext, ciphertext):
+    result = crypto.encrypt_many([plaintext, plaintext], deterministic=True)
+    assert result == [ciphertext, ciphertext]
+
+
+def test_decrypt_many_keeps_order(crypto, monkeypatch):
+    monkeypatch.setattr(crypto, "PARALLEL_THRESHOLD", 2)
+    msgs = [str(i) for i in range(100)]
+    result = crypto.decrypt_many(crypto.encrypt_many(msgs))
+    assert result == msgs
+
+
+def test_decrypt_many_with_wrong_key(crypto, ciphertext):
+    other = Crypto()
+    other.configure_from_key(b"\0" * 32, Fernet.generate_key())
+    with pytest.raises(InvalidKeyException):
+        other.decrypt_many([ciphertext])
+
+
+def test_uncofigured_crypto_on_decrypt_many(unconfigured_crypto, ciphertext):
+    with pytest.raises(MissingCipherKeyException):
+        unconfigured_crypto.decrypt_many([ciphertext])
+
+
+def test_default_kdf_is_the_legacy_one(crypto, password):
+    legacy = Crypto()
+    legacy.configure(password, dict(DEFAULT_KDF))
+
+    assert legacy.export_key() == crypto.export_key()
+
+
+@pytest.mark.parametrize("algorithm", ["pbkdf2", "scrypt"])
+def test_new_kdf(algorithm, password, plaintext):
+    kdf = new_kdf(algorithm)
+    crypto = Crypto()
+    crypto.configure(password, kdf)
+    again = Crypto()
+    again.configure(password, kdf)
+    other = Crypto()
+    other.configure(password, new_kdf(algorithm))
+
+    assert kdf["algorithm"] == algorithm
+    assert again.decrypt(crypto.encrypt(plaintext)) == plaintext
+    with pytest.raises(InvalidKeyException):
+        other.decrypt(crypto.encrypt(plaintext))
+
+
+def test_calibrated_kdf_has_a_floor():
+    assert calibrate_kdf(dict(DEFAULT_KDF), 0)["iterations"] == MIN_PBKDF2_ITERATIONS
+    assert calibrate_kdf(new_kdf("scrypt"), 0)["n"] == MIN_SCRYPT_N
+
+
+@pytest.mark.parametrize(
+    "kdf",
+    [
+        {"algorithm": "argon2"},
+        {"algorithm": "pbkdf2"},
+        {"algorithm": "scrypt", "n": 1000, "r": 8, "p": 1},
+        {**DEFAULT_KDF, "salt": "not base64!"},
+    ],
+)
+def test_unsupported_kdf(kdf, password):
+    with pytest.raises(UnsupportedKdfException):
+        Crypto().configure(password, kdf)
+
+
+def test_reencrypt_many_keeps_timestamps(crypto, password, plaintext):
+    other = Crypto()
+    other.configure(password, new_kdf())
+    tokens = [crypto.encrypt(plaintext) for _ in range(3)]
+
+    reencrypted = other.reencrypt_many(tokens, crypto)
+
+    assert other.decrypt_many(reencrypted) == [plaintext] * 3
+    assert [token_timestamp(token) for token in reencrypted] == [token_timestamp(token) for token in tokens]
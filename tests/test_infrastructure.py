@@ -1,5 +1,25 @@
+import json
+import multiprocessing
+import threading
+import time
 from pathlib import Path
-from secretkv.infrastructure import FileRepository
+
+import pytest
+
+from secretkv import config
+from secretkv.application import SecretKV, key_names
+from secretkv.codec import BinaryCodec
+from secretkv.crypto import Crypto, name_index, new_kdf
+from secretkv.domain import RetentionPolicy, Secret
+from secretkv.instrumentation import AggregatingSink, set_sink
+from secretkv.infrastructure import (
+    FileRepository,
+    InMemoryRepository,
+    LogRepository,
+    ShardedFileRepository,
+    SqliteRepository,
+)
+from secretkv.utils import PersistentDict
 
 
 def test_file_is_creted():
@@ -9,3 +29,407 @@ def test_file_is_creted():
     path_obj = Path(path).expanduser()
     assert path_obj.is_file()
     path_obj.unlink()
+
+
+def test_log_is_replayed(tmp_path, crypto):
+    path = str(tmp_path / "secrets.log")
+    key = crypto.encrypt("key", deterministic=True)
+    repository = LogRepository(path)
+    repository.save(Secret(key, crypto.encrypt("val1")))
+    repository.save(Secret(key, crypto.encrypt("val2")))
+
+    history = LogRepository(path).retireve_history_from_key(key)
+    assert [crypto.decrypt(secret.val) for secret in history] == ["val1", "val2"]
+
+
+def test_log_save_appends_one_record(tmp_path, crypto):
+    path = tmp_path / "secrets.log"
+    repository = LogRepository(str(path))
+    repository.save(Secret(crypto.encrypt("key1", deterministic=True), crypto.encrypt("val1")))
+    repository.save(Secret(crypto.encrypt("key2", deterministic=True), crypto.encrypt("val2")))
+
+    assert len(path.read_text().splitlines()) == 2
+
+
+def test_log_is_compacted_after_threshold(tmp_path, crypto):
+    path = tmp_path / "secrets.log"
+    key = crypto.encrypt("key", deterministic=True)
+    repository = LogRepository(str(path), compact_threshold=3)
+    for val in ["val1", "val2", "val3"]:
+        repository.save(Secret(key, crypto.encrypt(val)))
+
+    assert len(path.read_text().splitlines()) == 1
+    assert crypto.decrypt(LogRepository(str(path)).retrieve_by_key(key).val) == "val3"
+
+
+def test_log_ignores_torn_record(tmp_path, crypto):
+    path = tmp_path / "secrets.log"
+    key = crypto.encrypt("key", deterministic=True)
+    LogRepository(str(path)).save(Secret(key, crypto.encrypt("val1")))
+    with path.open("a") as f:
+        f.write('["torn", "rec')
+
+    repository = LogRepository(str(path))
+    repository.save(Secret(key, crypto.encrypt("val2")))
+
+    assert crypto.decrypt(LogRepository(str(path)).retrieve_by_key(key).val) == "val2"
+
+
+def test_log_writers_see_each_others_appends(tmp_path, crypto):
+    path = str(tmp_path / "secrets.log")
+    key = crypto.encrypt("key", deterministic=True)
+    first, second = LogRepository(path), LogRepository(path)
+    first.save(Secret(key, crypto.encrypt("val1")))
+    second.save(Secret(key, crypto.encrypt("val2")))
+    first.save(Secret(key, crypto.encrypt("val3")))
+
+    history = LogRepository(path).retireve_history_from_key(key)
+    assert [crypto.decrypt(secret.val) for secret in history] == ["val1", "val2", "val3"]
+    assert [record[2] for record in map(json.loads, Path(path).read_text().splitlines())] == [1, 2, 3]
+
+
+def test_log_compaction_keeps_other_writers_appends(tmp_path, crypto):
+    path = str(tmp_path / "secrets.log")
+    key1, key2 = crypto.encrypt("key1", deterministic=True), crypto.encrypt("key2", deterministic=True)
+    first, second = LogRepository(path), LogRepository(path, compact_threshold=2)
+    second.save(Secret(key1, crypto.encrypt("val1")))
+    first.save(Secret(key2, crypto.encrypt("val2")))
+    second.save(Secret(key1, crypto.encrypt("val3")))
+
+    assert len(Path(path).read_text().splitlines()) == 2
+    first.save(Secret(key2, crypto.encrypt("val4")))
+
+    repository = LogRepository(path)
+    assert [crypto.decrypt(secret.val) for secret in repository.retireve_history_from_key(key1)] == ["val1", "val3"]
+    assert [crypto.decrypt(secret.val) for secret in repository.retireve_history_from_key(key2)] == ["val2", "val4"]
+
+
+def test_log_failed_append_leaves_memory_untouched(tmp_path, crypto, monkeypatch):
+    path = tmp_path / "secrets.log"
+    key = crypto.encrypt("key", deterministic=True)
+    repository = LogRepository(str(path))
+    repository.save(Secret(key, crypto.encrypt("val1")))
+
+    def failing_open(self, mode="r", *args, **kwargs):
+        if mode == "ab":
+            raise OSError("disk full")
+        return original_open(self, mode, *args, **kwargs)
+
+    original_open = Path.open
+    monkeypatch.setattr(Path, "open", failing_open)
+    assert not repository.save(Secret(key, crypto.encrypt("val2")))
+    monkeypatch.undo()
+
+    assert len(repository.retireve_history_from_key(key)) == 1
+    assert repository.save(Secret(key, crypto.encrypt("val3")))
+    assert [record[2] for record in map(json.loads, path.read_text().splitlines())] == [1, 2]
+
+
+@pytest.mark.parametrize(
+    "factory",
+    [
+        lambda directory: LogRepository(str(directory / "secrets.log")),
+        lambda directory: SqliteRepository(str(directory / "secrets.db")),
+        lambda directory: ShardedFileRepository(str(directory / "secrets.d"), shards=2),
+    ],
+    ids=["log", "sqlite", "sharded"],
+)
+def test_exclusive_holds_off_other_writers(tmp_path, crypto, factory):
+    key = crypto.encrypt("key", deterministic=True)
+    first, second = factory(tmp_path), factory(tmp_path)
+    first.save(Secret(key, crypto.encrypt("val1")))
+    writer = threading.Thread(target=lambda: second.save(Secret(key, crypto.encrypt("val2"))))
+
+    with first.exclusive():
+        secrets = [secret for history in first.iter_histories() for secret in history]
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()
+        assert first.replace(secrets)
+    writer.join()
+
+    history = factory(tmp_path).retireve_history_from_key(key)
+    assert [crypto.decrypt(secret.val) for secret in history] == ["val1", "val2"]
+
+
+def test_file_repository_writes_back_on_exit(tmp_path, crypto):
+    path = tmp_path / "secrets.json"
+    key = crypto.encrypt("key", deterministic=True)
+    repository = FileRepository(str(path))
+    with repository:
+        repository.save(Secret(key, crypto.encrypt("val1")))
+        repository.save(Secret(key, crypto.encrypt("val2")))
+        assert path.read_text() == "{}"
+
+    assert crypto.decrypt(FileRepository(str(path)).retrieve_by_key(key).val) == "val2"
+
+
+def _save_from_process(path, password, worker, count):
+    crypto = Crypto()
+    crypto.configure(password)
+    repository = FileRepository(path)
+    for i in range(count):
+        repository.save(Secret(crypto.encrypt(f"key{worker}", deterministic=True), crypto.encrypt(str(i))))
+
+
+def test_file_repository_concurrent_processes_lose_no_updates(tmp_path, crypto, password):
+    path = str(tmp_path / "secrets.json")
+    FileRepository(path)
+    processes = [
+        multiprocessing.Process(target=_save_from_process, args=(path, password, worker, 10)) for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    repository = FileRepository(path)
+    for worker in range(4):
+        history = repository.retireve_history_from_key(crypto.encrypt(f"key{worker}", deterministic=True))
+        assert [crypto.decrypt(secret.val) for secret in history] == [str(i) for i in range(10)]
+    assert not list((tmp_path / "secrets.json.pending").iterdir())
+
+
+def test_file_repository_group_commits_waiting_writers(tmp_path, crypto):
+    path = tmp_path / "secrets.json"
+    repository = FileRepository(str(path))
+    secrets = [Secret(crypto.encrypt(f"key{i}", deterministic=True), crypto.encrypt(f"val{i}")) for i in range(8)]
+    results = []
+    threads = [
+        threading.Thread(target=lambda secret=secret: results.append(repository.save(secret))) for secret in secrets
+    ]
+
+    sink = AggregatingSink()
+    previous = set_sink(sink)
+    try:
+        with FileRepository(str(path))._secrets:
+            for thread in threads:
+                thread.start()
+            while len(list((tmp_path / "secrets.json.pending").glob("*.json"))) < len(secrets):
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+    finally:
+        set_sink(previous)
+
+    assert results == [True] * len(secrets)
+    assert [span["count"] for span in sink.spans() if span["name"] == "store.save"] == [1]
+    assert len(FileRepository(str(path)).list_latest_version()) == len(secrets)
+
+
+@pytest.mark.parametrize("crash_in", ["flush", "unlink"])
+def test_file_repository_recovers_interrupted_commit(tmp_path, crypto, monkeypatch, crash_in):
+    path = tmp_path / "secrets.json"
+    key = crypto.encrypt("key", deterministic=True)
+
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    if crash_in == "flush":
+        monkeypatch.setattr(PersistentDict, "flush", crash)
+    else:
+        monkeypatch.setattr(Path, "unlink", crash)
+    with pytest.raises(KeyboardInterrupt):
+        FileRepository(str(path)).save(Secret(key, crypto.encrypt("val1")))
+    monkeypatch.undo()
+
+    repository = FileRepository(str(path))
+    repository.save(Secret(key, crypto.encrypt("val2")))
+
+    history = FileRepository(str(path)).retireve_history_from_key(key)
+    assert [crypto.decrypt(secret.val) for secret in history] == ["val1", "val2"]
+    assert not list((tmp_path / "secrets.json.pending").iterdir())
+
+
+def test_sqlite_migrates_json_store(tmp_path, crypto):
+    key = crypto.encrypt("key", deterministic=True)
+    legacy = FileRepository(str(tmp_path / "secrets.json"))
+    legacy.save(Secret(key, crypto.encrypt("val1")))
+    legacy.save(Secret(key, crypto.encrypt("val2")))
+
+    repository = SqliteRepository(str(tmp_path / "secrets.db"), migrate_from=str(tmp_path / "secrets.json"))
+    repository.save(Secret(key, crypto.encrypt("val3")))
+
+    history = repository.retireve_history_from_key(key)
+    assert [crypto.decrypt(secret.val) for secret in history] == ["val1", "val2", "val3"]
+    repository.close()
+
+
+@pytest.mark.parametrize(
+    "factory",
+    [
+        lambda directory, source: FileRepository(str(directory / "secrets.skv"), BinaryCodec(), migrate_from=source),
+        lambda directory, source: SqliteRepository(str(directory / "secrets.db"), migrate_from=source),
+    ],
+    ids=["binary", "sqlite"],
+)
+def test_migrated_vault_keeps_its_metadata(tmp_path, password, factory):
+    source = str(tmp_path / "secrets.json")
+    skv = SecretKV(FileRepository(source), Crypto())
+    assert skv.initialize(new_kdf("scrypt"))
+    skv.unlock(password)
+    assert skv.verify_password()
+    skv.create_or_append("a", "1")
+    assert skv.set_retention_policy(RetentionPolicy(keep_versions=2))
+
+    migrated = SecretKV(factory(tmp_path, source), Crypto())
+    migrated.unlock(password)
+
+    assert migrated.kdf_params() == skv.kdf_params()
+    assert migrated.verify_password()
+    assert migrated.get_value_from_key("a") == "1"
+    assert migrated.retention_policy() == RetentionPolicy(keep_versions=2)
+
+
+def test_sqlite_uses_wal(tmp_path):
+    repository = SqliteRepository(str(tmp_path / "secrets.db"))
+    assert repository._connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    repository.close()
+
+
+def _legacy_store(crypto):
+    return {
+        str(crypto.encrypt(config.TAG, deterministic=True)): [[str(crypto.encrypt(config.TAG[::-1])), 1]],
+        str(crypto.encrypt("key0", deterministic=True)): [
+            [str(crypto.encrypt("val0")), 1],
+            [str(crypto.encrypt("")), 2],
+        ],
+        str(crypto.encrypt("key1", deterministic=True)): [[str(crypto.encrypt("val1")), 1]],
+    }
+
+
+def test_file_tombstones_are_migrated(tmp_path, crypto):
+    path = tmp_path / "secrets.json"
+    path.write_text(json.dumps(_legacy_store(crypto)))
+    repository = FileRepository(str(path))
+
+    assert SecretKV(repository, crypto).verify_password()
+
+    assert all(len(entry) == 3 for history in json.loads(path.read_text()).values() for entry in history)
+    assert SecretKV(repository, crypto).list_every_key(False) == [config.TAG, "key1"]
+    assert not repository.migrate_tombstones(lambda vals: pytest.fail("store already migrated"))
+
+
+def test_log_tombstones_are_migrated(tmp_path, crypto):
+    path = tmp_path / "secrets.log"
+    path.write_text("".join(json.dumps([key, history]) + "\n" for key, history in _legacy_store(crypto).items()))
+
+    assert SecretKV(LogRepository(str(path)), crypto).verify_password()
+
+    repository = LogRepository(str(path))
+    assert SecretKV(repository, crypto).list_every_key(False) == [config.TAG, "key1"]
+    assert not repository.migrate_tombstones(lambda vals: pytest.fail("store already migrated"))
+
+
+def test_sqlite_tombstones_are_migrated(tmp_path, crypto):
+    (tmp_path / "secrets.json").write_text(json.dumps(_legacy_store(crypto)))
+    repository = SqliteRepository(str(tmp_path / "secrets.db"), migrate_from=str(tmp_path / "secrets.json"))
+
+    assert SecretKV(repository, crypto).verify_password()
+
+    assert SecretKV(repository, crypto).list_every_key(False) == [config.TAG, "key1"]
+    assert not repository.migrate_tombstones(lambda vals: pytest.fail("store already migrated"))
+    repository.close()
+
+
+def test_in_memory_history_is_append_ordered(crypto):
+    key = crypto.encrypt("key", deterministic=True)
+    repository = InMemoryRepository()
+    for val in ["val1", "val2", "val3"]:
+        repository.save(Secret(key, crypto.encrypt(val)))
+
+    assert [version for _, version, _ in repository._secrets[str(key)]] == [1, 2, 3]
+    assert crypto.decrypt(repository.retrieve_by_key(key).val) == "val3"
+    assert repository._find_latest_version_number(key) == 3
+
+
+def _decrypted_keys(crypto, repository, include_deleted=True):
+    return sorted(crypto.decrypt_many(key_names(repository.list_latest_version(include_deleted))))
+
+
+def test_sharded_save_touches_one_shard(tmp_path, crypto):
+    repository = ShardedFileRepository(str(tmp_path / "secrets.d"), shards=4)
+    key = crypto.encrypt("key", deterministic=True)
+    repository.save(Secret(key, crypto.encrypt("val")))
+
+    written = [path for path in (tmp_path / "secrets.d").glob("shard-*.json") if path.read_text() != "{}"]
+    assert [path.name for path in written] == [f"shard-4-{ShardedFileRepository.shard_of(str(key), 4):04d}.json"]
+    assert json.loads((tmp_path / "secrets.d" / "manifest.json").read_text()) == {"shards": 4}
+
+
+def test_sharded_repository_through_secretkv(sharded_repository, crypto):
+    skv = SecretKV(sharded_repository, crypto)
+
+    assert skv.verify_password()
+    assert skv.get_value_from_key("key1") == "val1b"
+    assert skv.get_history_from_key("key1") == ["val1a", "val1b"]
+    assert skv.get_many(["key0", "key2", "missing"]) == [None, "val2", None]
+    assert skv.mark_as_deleted("key2") == "key2"
+    assert sorted(skv.list_every_key(False)) == sorted([config.TAG, "key1"])
+    assert sorted(skv.list_every_key(True)) == sorted([config.TAG, "key0", "key1", "key2"])
+
+
+def test_sharded_reshard_keeps_histories(sharded_repository, crypto, tmp_path):
+    sharded_repository.reshard(16)
+
+    assert json.loads((tmp_path / "secrets.d" / "manifest.json").read_text()) == {"shards": 16}
+    assert not list((tmp_path / "secrets.d").glob("shard-4-*.json"))
+    assert _decrypted_keys(crypto, sharded_repository) == sorted([config.TAG, "key0", "key1", "key2"])
+    history = sharded_repository.retireve_history_from_key(crypto.index("key1"))
+    assert [crypto.decrypt(secret.val) for secret in history] == ["val1a", "val1b"]
+    assert sharded_repository.retrieve_by_key(crypto.index("key0")).deleted
+
+
+def test_sharded_reads_and_writes_during_reshard(sharded_repository, crypto, tmp_path):
+    key1 = crypto.index("key1")
+    # Stop a reshard right after it switched layouts, before any shard moved.
+    with sharded_repository._manifest:
+        sharded_repository._manifest["target"] = 2
+
+    sharded_repository.save(Secret(key1, crypto.encrypt("val1c")))
+    assert crypto.decrypt(sharded_repository.retrieve_by_key(key1).val) == "val1c"
+    history = sharded_repository.retireve_history_from_key(key1)
+    assert [crypto.decrypt(secret.val) for secret in history] == ["val1a", "val1b", "val1c"]
+    assert _decrypted_keys(crypto, sharded_repository) == sorted([config.TAG, "key0", "key1", "key2"])
+
+    # Another process resuming with a different count finishes this reshard first.
+    ShardedFileRepository(str(tmp_path / "secrets.d")).reshard(8)
+
+    history = sharded_repository.retireve_history_from_key(key1)
+    assert [crypto.decrypt(secret.val) for secret in history] == ["val1a", "val1b", "val1c"]
+    assert [int(secret.deleted) for secret in history] == [0, 0, 0]
+    assert json.loads((tmp_path / "secrets.d" / "manifest.json").read_text()) == {"shards": 8}
+    assert _decrypted_keys(crypto, sharded_repository) == sorted([config.TAG, "key0", "key1", "key2"])
+
+
+def test_sharded_replace(sharded_repository, crypto):
+    key = crypto.index("key")
+
+    assert sharded_repository.replace(
+        [Secret(key, crypto.encrypt("val")), Secret(name_index(key), crypto.encrypt("key"))]
+    )
+
+    assert _decrypted_keys(crypto, sharded_repository) == ["key"]
+
+
+def test_meta_persists_next_to_the_store(tmp_path):
+    path = tmp_path / "secrets.json"
+    repository = FileRepository(str(path))
+
+    assert repository.get_meta("retention") is None
+    assert not (tmp_path / "secrets.json.meta").exists()
+
+    assert repository.set_meta("retention", {"vault": {"keep_versions": 3}})
+    assert FileRepository(str(path)).get_meta("retention") == {"vault": {"keep_versions": 3}}
+    assert json.loads(path.read_text()) == {}
+
+    repository.clear()
+    assert not (tmp_path / "secrets.json.meta").exists()
+
+
+def test_sqlite_meta(tmp_path):
+    repository = SqliteRepository(str(tmp_path / "secrets.db"))
+    repository.set_meta("retention", {"keys": {}})
+    repository.close()
+
+    assert SqliteRepository(str(tmp_path / "secrets.db")).get_meta("retention") == {"keys": {}}
@@ -0,0 +1,56 @@
+import io
+import json
+
+from secretkv import instrumentation
+from secretkv.instrumentation import AggregatingSink, JsonFileSink, NullSink, StderrSink, span
+from secretkv.main import main
+
+
+def test_span_is_noop_by_default():
+    assert isinstance(instrumentation.get_sink(), NullSink)
+    with span("noop"):
+        pass
+
+
+def test_span_records_into_sink():
+    sink = AggregatingSink()
+    previous = instrumentation.set_sink(sink)
+    try:
+        for _ in range(2):
+            with span("phase"):
+                pass
+    finally:
+        instrumentation.set_sink(previous)
+
+    assert [(s["name"], s["count"]) for s in sink.spans()] == [("phase", 2)]
+
+
+def test_stderr_sink():
+    stream = io.StringIO()
+    sink = StderrSink(stream)
+    sink.record("phase", 0.5)
+    sink.flush()
+
+    assert stream.getvalue().split() == ["phase", "1x", "500.000", "ms"]
+
+
+def test_json_file_sink(tmp_path):
+    sink = JsonFileSink(str(tmp_path / "timings.json"))
+    sink.record("phase", 0.5)
+    sink.flush()
+
+    assert json.loads((tmp_path / "timings.json").read_text()) == {
+        "spans": [{"name": "phase", "count": 1, "seconds": 0.5}]
+    }
+
+
+def test_main_with_timings(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    previous = instrumentation.get_sink()
+    try:
+        main(["--timings", "set", "key", "val", "-p", "123456"])
+    finally:
+        instrumentation.set_sink(previous)
+
+    phases = [line.split()[0] for line in capsys.readouterr().err.splitlines()]
+    assert {"crypto.kdf", "secretkv.verify_password", "store.save", "main.command"} <= set(phases)
@@ -0,0 +1,100 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from secretkv import config, keyagent
+from secretkv.application import SecretKV
+from secretkv.cli import Cli, Command
+from secretkv.crypto import Crypto
+from secretkv.keyagent import Agent
+
+pytestmark = pytest.mark.skipif(not keyagent.is_supported(), reason="requires unix domain sockets")
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / "agent.sock")
+
+
+def test_request_key_without_agent(socket_path):
+    assert keyagent.request_key(socket_path) is None
+
+
+def test_agent_serves_derived_key(crypto, plaintext, ciphertext, socket_path, tmp_path):
+    thread = threading.Thread(target=Agent(crypto, socket_path, ttl=0.5).serve)
+    thread.start()
+    while (key := keyagent.request_key(socket_path)) is None:
+        pass
+    mode = (tmp_path / "agent.sock").stat().st_mode & 0o777
+    thread.join()
+
+    assert mode == 0o600
+
+    other = Crypto()
+    other.configure_from_key(*key)
+    assert other.encrypt(plaintext, deterministic=True) == ciphertext
+
+
+def test_agent_exits_after_ttl(crypto, socket_path, tmp_path):
+    Agent(crypto, socket_path, ttl=0.1).serve()
+    assert not (tmp_path / "agent.sock").exists()
+
+
+def test_peer_is_owner_fails_closed_without_peer_credentials(monkeypatch):
+    monkeypatch.delattr(keyagent.socket, "SO_PEERCRED", raising=False)
+    monkeypatch.delattr(keyagent.socket, "LOCAL_PEERCRED", raising=False)
+    left, right = keyagent.socket.socketpair()
+    with left, right:
+        assert not keyagent.peer_is_owner(left)
+
+
+def test_peer_is_owner_accepts_same_user():
+    left, right = keyagent.socket.socketpair()
+    with left, right:
+        assert keyagent.peer_is_owner(left)
+
+
+def test_agent_survives_stalled_client(crypto, socket_path):
+    thread = threading.Thread(target=Agent(crypto, socket_path, ttl=3).serve)
+    thread.start()
+    while keyagent.request_key(socket_path) is None:
+        pass
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as idle:
+        idle.connect(socket_path)
+        time.sleep(1.2)
+
+    assert keyagent.request_key(socket_path) is not None
+    thread.join()
+
+
+def test_only_touch_renews_agent(crypto, socket_path):
+    thread = threading.Thread(target=Agent(crypto, socket_path, ttl=0.5).serve)
+    start = time.monotonic()
+    thread.start()
+    while keyagent.request_key(socket_path) is None:
+        pass
+    time.sleep(0.3)
+    assert keyagent.touch(socket_path)
+    while keyagent.request_key(socket_path) is not None:
+        time.sleep(0.05)
+    thread.join()
+
+    assert 0.8 <= time.monotonic() - start < 2
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_command_falls_back_to_password_for_wrong_agent_key(skv, password, wrong_password, monkeypatch):
+    other = Crypto()
+    other.configure(wrong_password)
+    monkeypatch.setattr(keyagent, "request_key", lambda: other.export_key())
+    monkeypatch.setattr(keyagent, "touch", lambda: pytest.fail("a wrong key mustn't renew the agent"))
+    monkeypatch.setattr(Cli, "prompt_for_password", staticmethod(lambda: password))
+    monkeypatch.setattr(config, "MASTERPASS", None)
+    app = SecretKV(skv.repository, Crypto())
+
+    output = Command("get", {"key": "key1", "history": False, "masterpass": None}).execute({"app": app})
+
+    assert output == {"values": ["val1b"]}
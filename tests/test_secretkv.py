@@ -1,154 +1,213 @@
+import json
+import time
+from argparse import ArgumentTypeError
+
 import pytest
 import secretkv
-from secretkv.utils import Status
+from secretkv.application import SecretKV, StaleRekeyException
+from secretkv.cli import duration
+from secretkv.crypto import Crypto, is_legacy_key, name_index, token_timestamp
+from secretkv.domain import RetentionPolicy, Secret
+from secretkv.infrastructure import FileRepository, InMemoryRepository
+from secretkv.utils import Status, TTLCache
 from secretkv import config
+from secretkv.crypto import EncryptedStr
 
+REPOSITORIES = [
+    "in_memory_repository",
+    "file_repository",
+    "log_repository",
+    "sqlite_repository",
+    "binary_repository",
+]
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_get(skv, password):
     result = secretkv.get(skv, "key1", password)
     assert result.status == Status.Ok and result.data == {"values": ["val1b"]}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_get_history(skv, password):
     result = secretkv.get(skv, "key1", password, history=True)
     assert result.status == Status.Ok and result.data == {"values": ["val1b", "val1a"]}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_get_missing_key(skv, password):
     result = secretkv.get(skv, "key", password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_get_empty_key(skv, password):
     result = secretkv.get(skv, "", password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_get_deleted_key(skv, password):
     result = secretkv.get(skv, "key0", password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_get_with_wrong_password(skv, wrong_password):
     result = secretkv.get(skv, "key1", wrong_password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_get_tag_key(skv, password):
     result = secretkv.get(skv, config.TAG, password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_set(skv, password):
     result = secretkv.set(skv, "key3", "val3", password)
     assert result.status == Status.Ok and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_set_empty_key(skv, password):
     result = secretkv.set(skv, "", "val3", password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_set_empty_val(skv, password):
     result = secretkv.set(skv, "key3", "", password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_set_with_wrong_password(skv, wrong_password):
     result = secretkv.set(skv, "key1", "val1", wrong_password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_set_tag_key(skv, password):
     result = secretkv.set(skv, config.TAG, "val0", password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_list(skv, password):
     result = secretkv.list(skv, password)
     assert result.status == Status.Ok and result.data == {"keys": ["key1", "key2"]}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_list_including_deleted(skv, password):
     result = secretkv.list(skv, password, all=True)
     assert result.status == Status.Ok and result.data == {"keys": ["key0", "key1", "key2"]}
 
 
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_list_with_prefix_and_glob(skv, password):
+    for key in ["prod/db/user", "prod/db/password", "prod/api/token", "dev/db/user"]:
+        secretkv.set(skv, key, "val", password)
+
+    result = secretkv.list(skv, password, prefix="prod/")
+    assert result.status == Status.Ok
+    assert result.data == {"keys": ["prod/db/user", "prod/db/password", "prod/api/token"]}
+    assert secretkv.list(skv, password, glob="*/db/*").data == {
+        "keys": ["prod/db/user", "prod/db/password", "dev/db/user"]
+    }
+    assert secretkv.list(skv, password, prefix="prod/", glob="*/db/*").data == {
+        "keys": ["prod/db/user", "prod/db/password"]
+    }
+    assert secretkv.list(skv, password, all=True, prefix="key").data == {"keys": ["key0", "key1", "key2"]}
+    assert secretkv.list(skv, password, glob="nope*").data == {"keys": []}
+
+
 @pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+def test_list_decrypts_only_new_names(skv, monkeypatch):
+    skv.list_every_key(False)
+    skv.create_or_append("key3", "val3")
+    decrypted = []
+    decrypt_many = Crypto.decrypt_many
+    monkeypatch.setattr(
+        Crypto, "decrypt_many", lambda self, msgs: decrypted.append(len(msgs)) or decrypt_many(self, msgs)
+    )
+
+    assert SecretKV(skv.repository, skv.crypto).list_every_key(False) == [config.TAG, "key1", "key2", "key3"]
+    assert skv.list_every_key(True) == [config.TAG, "key0", "key1", "key2", "key3"]
+    assert decrypted == [1]
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_list_rebuilds_unreadable_directory(skv):
+    skv.repository.set_meta("directory", "garbage")
+
+    assert skv.list_every_key(False) == [config.TAG, "key1", "key2"]
+    assert skv.repository.get_meta("directory") != "garbage"
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_list_with_wrong_password(skv, wrong_password):
     result = secretkv.list(skv, wrong_password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_list_including_deleted_with_wrong_password(skv, wrong_password):
     result = secretkv.list(skv, wrong_password, all=True)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_list_doesnt_include_tag_key(skv, password):
     result = secretkv.list(skv, password)
     assert result.status == Status.Ok and config.TAG not in result.data.get("keys")
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_list_including_deleted_doesnt_include_tag_key(skv, password):
     result = secretkv.list(skv, password)
     assert result.status == Status.Ok and config.TAG not in result.data.get("keys")
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_delete(skv, password):
     result = secretkv.delete(skv, "key2", password)
     assert result.status == Status.Ok and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_delete_missing_key(skv, password):
     result = secretkv.delete(skv, "key", password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_delete_empty_key(skv, password):
     result = secretkv.delete(skv, "", password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_delete_already_deleted_key(skv, password):
     result = secretkv.delete(skv, "key0", password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_delete_with_wrong_password(skv, wrong_password):
     result = secretkv.delete(skv, "key1", wrong_password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_delete_tag_key(skv, password):
     result = secretkv.delete(skv, config.TAG, password)
     assert result.status == Status.Err and result.data == {}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_set_and_then_get(skv, password):
     secretkv.set(skv, "key3", "val3", password)
 
@@ -156,14 +215,14 @@ def test_set_and_then_get(skv, password):
     assert result.data == {"values": ["val3"]}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_set_and_then_list(skv, password):
     secretkv.set(skv, "key3", "val3", password)
     result = secretkv.list(skv, password)
     assert result.data == {"keys": ["key1", "key2", "key3"]}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_delete_and_then_list(skv, password):
     secretkv.delete(skv, "key2", password)
 
@@ -171,8 +230,546 @@ def test_delete_and_then_list(skv, password):
     assert result.data == {"keys": ["key1"]}
 
 
-@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
 def test_delete_and_then_list_including_deleted(skv, password):
     secretkv.delete(skv, "key2", password)
     result = secretkv.list(skv, password, all=True)
     assert result.data == {"keys": ["key0", "key1", "key2"]}
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_batch(skv, password, tmp_path):
+    operations = [
+        {"op": "set", "key": "key3", "val": "val3"},
+        {"op": "set", "key": "key4", "val": ""},
+        {"op": "get", "key": "key1"},
+        {"op": "get", "key": "key3"},
+        {"op": "get", "key": "key"},
+        {"op": "delete", "key": "key2"},
+        {"op": "delete", "key": "key0"},
+        {"op": "get", "key": config.TAG},
+    ]
+    (tmp_path / "input").write_text("\n".join(json.dumps(operation) for operation in operations) + "\n[]\n")
+
+    result = secretkv.batch(skv, password, input=str(tmp_path / "input"), output=str(tmp_path / "output"))
+
+    assert result.status == Status.Ok
+    assert [json.loads(line) for line in (tmp_path / "output").read_text().splitlines()] == [
+        {"op": "set", "key": "key3", "ok": True},
+        {"op": "set", "key": "key4", "ok": False},
+        {"op": "get", "key": "key1", "ok": True, "values": ["val1b"]},
+        {"op": "get", "key": "key3", "ok": True, "values": ["val3"]},
+        {"op": "get", "key": "key", "ok": False},
+        {"op": "delete", "key": "key2", "ok": True},
+        {"op": "delete", "key": "key0", "ok": False},
+        {"op": "get", "key": config.TAG, "ok": False},
+        {"op": None, "key": None, "ok": False},
+    ]
+    assert secretkv.list(skv, password).data == {"keys": ["key1", "key3"]}
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_batch_with_wrong_password(skv, wrong_password, tmp_path):
+    (tmp_path / "input").write_text('{"op": "get", "key": "key1"}\n')
+    result = secretkv.batch(skv, wrong_password, input=str(tmp_path / "input"))
+    assert result.status == Status.Err and result.data == {}
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_batch_with_missing_input(skv, password, tmp_path):
+    result = secretkv.batch(skv, password, input=str(tmp_path / "missing"), output=str(tmp_path / "output"))
+    assert result.status == Status.Err and result.data == {}
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_dump_plaintext(skv, password, tmp_path):
+    result = secretkv.dump(skv, password, plaintext=True, output=str(tmp_path / "dump"))
+
+    header, *records = [json.loads(line) for line in (tmp_path / "dump").read_text().splitlines()]
+    assert result.status == Status.Ok
+    assert header == {"format": "skv-dump/1", "plaintext": True}
+    assert sorted(records, key=lambda x: x["key"]) == [
+        {"key": "key0", "values": [""]},
+        {"key": "key1", "values": ["val1a", "val1b"]},
+        {"key": "key2", "values": ["val2"]},
+    ]
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_dump_ciphertext(skv, crypto, password, tmp_path):
+    secretkv.dump(skv, password, output=str(tmp_path / "dump"))
+
+    header, *records = [json.loads(line) for line in (tmp_path / "dump").read_text().splitlines()]
+    assert header == {"format": "skv-dump/1", "plaintext": False, "kdf": None}
+    # Every key has its name record along.
+    assert len(records) == 8
+    values = {record["key"]: record["values"] for record in records}
+    assert [crypto.decrypt(EncryptedStr(val)) for val in values[str(crypto.index("key1"))]] == ["val1a", "val1b"]
+    assert crypto.decrypt(EncryptedStr(values[str(name_index(crypto.index("key1")))][0])) == "key1"
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository", "sqlite_repository"], indirect=True)
+def test_dump_plaintext_aborts_on_keys_without_name_record(skv, password, tmp_path):
+    unnamed = skv.crypto.index("key3")
+    skv.repository.save(Secret(unnamed, skv.crypto.encrypt("val3")))
+
+    result = secretkv.dump(skv, password, plaintext=True, output=str(tmp_path / "dump"))
+
+    assert result.status == Status.Err
+    assert result.data == {"message": [f"Dump aborted, no name record for keys: {unnamed}"]}
+    assert not (tmp_path / "dump").exists()
+    assert secretkv.dump(skv, password, output=str(tmp_path / "dump")).status == Status.Ok
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_dump_to_missing_directory(skv, password, tmp_path):
+    result = secretkv.dump(skv, password, output=str(tmp_path / "missing" / "dump"))
+    assert result.status == Status.Err and result.data == {}
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_dump_with_wrong_password(skv, wrong_password, tmp_path):
+    result = secretkv.dump(skv, wrong_password, output=str(tmp_path / "dump"))
+    assert result.status == Status.Err and not (tmp_path / "dump").exists()
+
+
+@pytest.mark.parametrize("plaintext", [True, False])
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_dump_and_then_restore_with_replace(skv, password, plaintext, tmp_path):
+    secretkv.dump(skv, password, plaintext=plaintext, output=str(tmp_path / "dump"))
+    secretkv.set(skv, "key3", "val3", password)
+
+    result = secretkv.restore(skv, password, str(tmp_path / "dump"), replace=True)
+
+    assert result.status == Status.Ok
+    assert secretkv.list(skv, password, all=True).data == {"keys": ["key0", "key1", "key2"]}
+    assert secretkv.get(skv, "key1", password, history=True).data == {"values": ["val1b", "val1a"]}
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_restore_appends_history(skv, password, tmp_path):
+    secretkv.dump(skv, password, plaintext=True, output=str(tmp_path / "dump"))
+
+    result = secretkv.restore(skv, password, str(tmp_path / "dump"))
+
+    assert result.status == Status.Ok
+    assert secretkv.get(skv, "key2", password, history=True).data == {"values": ["val2", "val2"]}
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_restore_ciphertext_with_wrong_key(skv, password, tmp_path):
+    (tmp_path / "dump").write_text(
+        '{"format": "skv-dump/1", "plaintext": false}\n'
+        '{"key": "gAAAAAAAAAAEDD9dWoav88oSAgySOtxskhlXiXqjKPp7dxXidYSLdRxGWiJcRygTgp1AQNtESUY1ztX2WE2SBSdOpF1uUJJlsA=="'
+        ', "values": []}\n'
+    )
+
+    result = secretkv.restore(skv, password, str(tmp_path / "dump"), replace=True)
+
+    assert result.status == Status.Err
+    assert secretkv.list(skv, password).data == {"keys": ["key1", "key2"]}
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository", "file_repository"], indirect=True)
+def test_restore_legacy_ciphertext(skv, legacy_repository, crypto, password, tmp_path):
+    records = [json.dumps(record) + "\n" for record in SecretKV(legacy_repository, crypto).dump()]
+    (tmp_path / "dump").write_text('{"format": "skv-dump/1", "plaintext": false}\n' + "".join(records))
+    secretkv.set(skv, "key3", "val3", password)
+
+    result = secretkv.restore(skv, password, str(tmp_path / "dump"), replace=True)
+
+    assert result.status == Status.Ok
+    assert secretkv.list(skv, password, all=True).data == {"keys": ["key0", "key1", "key2"]}
+    assert secretkv.get(skv, "key1", password, history=True).data == {"values": ["val1b", "val1a"]}
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_restore_ciphertext_without_tombstone_flags(skv, password, tmp_path):
+    records = [{"key": record["key"], "values": record["values"]} for record in skv.dump()]
+    (tmp_path / "dump").write_text(
+        '{"format": "skv-dump/1", "plaintext": false}\n' + "".join(json.dumps(record) + "\n" for record in records)
+    )
+
+    result = secretkv.restore(skv, password, str(tmp_path / "dump"), replace=True)
+
+    assert result.status == Status.Ok
+    assert secretkv.list(skv, password).data == {"keys": ["key1", "key2"]}
+    assert secretkv.list(skv, password, all=True).data == {"keys": ["key0", "key1", "key2"]}
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_restore_without_header(skv, password, tmp_path):
+    (tmp_path / "dump").write_text('{"key": "key3", "values": ["val3"]}\n')
+    result = secretkv.restore(skv, password, str(tmp_path / "dump"))
+    assert result.status == Status.Err
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_restore_missing_file(skv, password, tmp_path):
+    result = secretkv.restore(skv, password, str(tmp_path / "missing"))
+    assert result.status == Status.Err
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_cached_get(skv, password):
+    app = SecretKV(skv._repository, skv.crypto, TTLCache())
+
+    assert [app.get_value_from_key("key1") for _ in range(3)] == ["val1b"] * 3
+    assert (app.cache.hits, app.cache.misses) == (2, 1)
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_cached_get_after_set_and_delete(skv, password):
+    app = SecretKV(skv._repository, skv.crypto, TTLCache())
+    app.get_value_from_key("key1")
+
+    app.create_or_append("key1", "val1c")
+    assert app.get_value_from_key("key1") == "val1c"
+
+    app.mark_as_deleted("key1")
+    assert app.get_value_from_key("key1") is None
+
+
+def test_cached_get_after_external_write(file_repository, crypto):
+    app = SecretKV(file_repository, crypto, TTLCache())
+    app.get_value_from_key("key1")
+
+    other = SecretKV(FileRepository("test.json"), crypto)
+    other.create_or_append("key1", "val1c")
+
+    assert app.get_value_from_key("key1") == "val1c"
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_cached_get_with_wrong_password(skv, password, wrong_password):
+    app = SecretKV(skv._repository, skv.crypto, TTLCache())
+    app.get_value_from_key("key1")
+
+    result = secretkv.get(app, "key1", wrong_password)
+    assert result.status == Status.Err and result.data == {}
+
+
+def test_reshard(sharded_repository, crypto, tmp_path):
+    result = secretkv.reshard(SecretKV(sharded_repository, crypto), None, 8)
+
+    assert result.status == Status.Ok and result.data == {}
+    assert json.loads((tmp_path / "secrets.d" / "manifest.json").read_text()) == {"shards": 8}
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_reshard_unsharded_storage(skv):
+    result = secretkv.reshard(skv, None, 8)
+
+    assert result.status == Status.Ok and result.data == {"message": ["Storage is not sharded"]}
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_keys_are_named_once(skv):
+    skv.create_or_append("key3", "val3a")
+    skv.create_or_append("key3", "val3b")
+    skv.set_many([("key3", "val3c"), ("key4", "val4a"), ("key4", "val4b")])
+
+    for key in ["key3", "key4"]:
+        names = skv.repository.retireve_history_from_key(name_index(skv.crypto.index(key)))
+        assert [skv.crypto.decrypt(secret.val) for secret in names] == [key]
+    assert sorted(skv.list_every_key(False)) == sorted([config.TAG, "key1", "key2", "key3", "key4"])
+
+
+def test_legacy_keys_are_migrated(legacy_repository, crypto):
+    legacy_key = str(crypto.encrypt("key1", deterministic=True))
+    legacy_repository.set_meta("retention", {"keys": {legacy_key: {"keep_versions": 1}}})
+    skv = SecretKV(legacy_repository, crypto)
+
+    assert skv.verify_password()
+
+    assert not any(is_legacy_key(secret.key) for secret in legacy_repository.list_latest_version())
+    assert skv.get_history_from_key("key1") == ["val1a", "val1b"]
+    assert skv.get_value_from_key("key0") is None
+    assert sorted(skv.list_every_key(True)) == sorted([config.TAG, "key0", "key1", "key2"])
+    assert skv.retention_policy("key1") == RetentionPolicy(keep_versions=1)
+    assert [*legacy_repository.get_meta("retention")["keys"]] == [str(crypto.index("key1"))]
+    assert skv.verify_password()
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_tombstones_are_migrated_once(skv, monkeypatch):
+    assert skv.verify_password()
+    monkeypatch.setattr(skv.repository, "migrate_tombstones", lambda classify: pytest.fail("migrated again"))
+
+    assert skv.verify_password()
+
+
+def test_legacy_keys_with_wrong_password(legacy_repository, wrong_password):
+    other = Crypto()
+    other.configure(wrong_password)
+
+    assert not SecretKV(legacy_repository, other).verify_password()
+    assert all(is_legacy_key(secret.key) for secret in legacy_repository.list_latest_version())
+
+
+@pytest.mark.parametrize("skv", [*REPOSITORIES, "sharded_repository"], indirect=True)
+def test_compact_keeps_last_versions(skv, password):
+    assert secretkv.retention(skv, password, keep=1).status == Status.Ok
+
+    result = secretkv.compact(skv, password)
+
+    assert result.status == Status.Ok and result.data == {"message": ["Dropped 1 versions and 0 keys"]}
+    assert secretkv.get(skv, "key1", password, history=True).data == {"values": ["val1b"]}
+    assert secretkv.get(skv, "key2", password).data == {"values": ["val2"]}
+    assert skv.verify_password()
+
+
+@pytest.mark.parametrize("skv", [*REPOSITORIES, "sharded_repository"], indirect=True)
+def test_compact_purges_deleted_keys(skv, password):
+    secretkv.retention(skv, password, purge_deleted=0)
+
+    result = secretkv.compact(skv, password)
+
+    assert result.data == {"message": ["Dropped 1 versions and 1 keys"]}
+    assert sorted(secretkv.list(skv, password, all=True).data["keys"]) == ["key1", "key2"]
+    assert skv.repository.retrieve_by_key(name_index(skv.crypto.index("key0"))) is None
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_compact_key_policy_overrides_vault(skv, password):
+    skv.create_or_append("key2", "val2b")
+    skv.create_or_append("key2", "val2c")
+    secretkv.retention(skv, password, keep=2)
+    secretkv.retention(skv, password, key="key2", keep=1)
+
+    assert skv.compact() == (2, 0)
+    assert skv.get_history_from_key("key1") == ["val1a", "val1b"]
+    assert skv.get_history_from_key("key2") == ["val2c"]
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_compact_max_age_keeps_latest_version(skv, password):
+    skv.set_retention_policy(RetentionPolicy(max_age=60))
+
+    assert skv.compact(now=time.time() + 3600) == (1, 0)
+    assert skv.get_history_from_key("key1") == ["val1b"]
+    assert skv.get_value_from_key("key2") == "val2"
+    assert skv.compact() == (0, 0)
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_retention_show_and_clear(skv, password):
+    secretkv.retention(skv, password, keep=3, max_age=30 * 86400)
+    secretkv.retention(skv, password, keep=5)
+
+    result = secretkv.retention(skv, password)
+    assert result.status == Status.Ok
+    assert result.data == {"retention": ["keep_versions: 5", "max_age: 30d", "purge_deleted_after: -"]}
+
+    secretkv.retention(skv, password, key="key1", purge_deleted=3600)
+    assert secretkv.retention(skv, password, key="key1").data["retention"][2] == "purge_deleted_after: 1h"
+
+    assert secretkv.retention(skv, password, key="key1", clear=True).status == Status.Ok
+    assert skv.retention_policy("key1") == RetentionPolicy()
+    assert skv.retention_policy() == RetentionPolicy(keep_versions=5, max_age=30 * 86400)
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_retention_tag_key(skv, password):
+    assert secretkv.retention(skv, password, key=config.TAG, keep=1).status == Status.Err
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_retention_with_wrong_password(skv, wrong_password):
+    assert secretkv.compact(skv, wrong_password).status == Status.Err
+
+
+@pytest.mark.parametrize("value, seconds", [("90", 90 * 86400), ("12h", 43200), ("1.5m", 90), ("0s", 0)])
+def test_duration(value, seconds):
+    assert duration(value) == seconds
+
+
+@pytest.mark.parametrize("value", ["", "d", "-1d", "inf", "nan", "3w"])
+def test_invalid_duration(value):
+    with pytest.raises(ArgumentTypeError):
+        duration(value)
+
+
+@pytest.fixture
+def new_crypto():
+    crypto = Crypto()
+    crypto.configure("abcdef")
+    return crypto
+
+
+@pytest.mark.parametrize("skv", [*REPOSITORIES, "sharded_repository"], indirect=True)
+def test_rekey(skv, password, tmp_path):
+    result = secretkv.rekey(skv, password, "abcdef", staging=str(tmp_path / "rekey"))
+
+    assert result.status == Status.Ok and result.data == {}
+    assert not (tmp_path / "rekey").exists()
+    assert secretkv.get(skv, "key1", "abcdef", history=True).data == {"values": ["val1b", "val1a"]}
+    assert sorted(secretkv.list(skv, "abcdef", all=True).data["keys"]) == ["key0", "key1", "key2"]
+    assert secretkv.get(skv, "key0", "abcdef").status == Status.Err
+    assert secretkv.get(skv, "key1", password).status == Status.Err
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_rekey_drops_key_directory(skv, new_crypto, tmp_path):
+    skv.list_every_key(False)
+
+    assert skv.rekey(new_crypto, str(tmp_path / "rekey"))
+
+    assert skv.repository.get_meta("directory") is None
+    assert skv.list_every_key(True) == [config.TAG, "key0", "key1", "key2"]
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository", "sqlite_repository"], indirect=True)
+def test_rekey_aborts_on_keys_without_name_record(skv, password, tmp_path):
+    unnamed = skv.crypto.index("key3")
+    skv.repository.save(Secret(unnamed, skv.crypto.encrypt("val3")))
+
+    result = secretkv.rekey(skv, password, "abcdef", staging=str(tmp_path / "rekey"))
+
+    assert result.status == Status.Ok
+    assert result.data == {"message": [f"Rekey aborted, no name record for keys: {unnamed}"]}
+    assert not (tmp_path / "rekey").exists()
+    assert secretkv.get(skv, "key1", password).data == {"values": ["val1b"]}
+    assert skv.repository.retrieve_by_key(unnamed) is not None
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_rekey_wrong_password(skv, wrong_password, tmp_path):
+    assert secretkv.rekey(skv, wrong_password, "abcdef", staging=str(tmp_path / "rekey")).status == Status.Err
+    assert secretkv.rekey(skv, None, "", staging=str(tmp_path / "rekey")).status == Status.Err
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_rekey_keeps_timestamps_and_policies(skv, new_crypto, tmp_path):
+    key = skv.crypto.index("key1")
+    timestamps = [token_timestamp(secret.val) for secret in skv.repository.retireve_history_from_key(key)]
+    skv.set_retention_policy(RetentionPolicy(keep_versions=1), "key1")
+
+    assert skv.rekey(new_crypto, str(tmp_path / "rekey"))
+
+    key = new_crypto.index("key1")
+    assert [token_timestamp(secret.val) for secret in skv.repository.retireve_history_from_key(key)] == timestamps
+    assert skv.crypto is new_crypto
+    assert skv.retention_policy("key1") == RetentionPolicy(keep_versions=1)
+    assert [*skv.repository.get_meta("retention")["keys"]] == [str(key)]
+
+
+@pytest.fixture
+def interrupted_rekey(skv, new_crypto, tmp_path, monkeypatch):
+    monkeypatch.setattr(SecretKV, "CHUNK_SIZE", 1)
+    reencrypt_many = Crypto.reencrypt_many
+    calls = []
+
+    def interrupt(self, msgs, source):
+        calls.append(msgs)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        return reencrypt_many(self, msgs, source)
+
+    monkeypatch.setattr(Crypto, "reencrypt_many", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        skv.rekey(new_crypto, str(tmp_path / "rekey"))
+    monkeypatch.setattr(Crypto, "reencrypt_many", reencrypt_many)
+    return json.loads((tmp_path / "rekey" / "state.json").read_text())
+
+
+@pytest.mark.parametrize("skv", ["file_repository"], indirect=True)
+def test_rekey_resumes_from_checkpoint(skv, new_crypto, tmp_path, monkeypatch, interrupted_rekey):
+    assert interrupted_rekey["done"] == 2
+    calls = []
+    reencrypt_many = Crypto.reencrypt_many
+    monkeypatch.setattr(Crypto, "reencrypt_many", lambda self, *args: calls.append(1) or reencrypt_many(self, *args))
+
+    assert skv.rekey(new_crypto, str(tmp_path / "rekey"))
+
+    # Four keys and their name records, two of which were staged.
+    assert len(calls) == 6
+    assert skv.get_history_from_key("key1") == ["val1a", "val1b"]
+    assert skv.verify_password()
+
+
+@pytest.mark.parametrize("skv", ["file_repository"], indirect=True)
+def test_rekey_restarts_if_store_changed(skv, new_crypto, tmp_path, interrupted_rekey):
+    # key0 was staged before the interruption.
+    skv.create_or_append("key0", "val0")
+
+    assert skv.rekey(new_crypto, str(tmp_path / "rekey"))
+    assert skv.get_value_from_key("key0") == "val0"
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_rekey_to_another_password_in_progress(skv, password, tmp_path, interrupted_rekey):
+    other = Crypto()
+    other.configure("ghijkl")
+
+    with pytest.raises(StaleRekeyException):
+        skv.rekey(other, str(tmp_path / "rekey"))
+
+    result = secretkv.rekey(skv, password, "ghijkl", staging=str(tmp_path / "rekey"))
+
+    assert result.status == Status.Ok
+    assert result.data == {
+        "message": [
+            f"Rekey aborted, {tmp_path / 'rekey'} holds an interrupted rekey to another password: "
+            "resume it with that password or remove the directory"
+        ]
+    }
+    assert (tmp_path / "rekey" / "state.json").exists()
+    assert secretkv.get(skv, "key1", password).data == {"values": ["val1b"]}
+
+
+def test_init(password):
+    repository = InMemoryRepository()
+
+    result = secretkv.init(SecretKV(repository, Crypto()), password, kdf="scrypt")
+
+    assert result.status == Status.Ok and result.data == {"kdf": ["algorithm: scrypt", "n: 16384", "r: 8", "p: 1"]}
+    assert set(repository.get_meta("kdf")) == {"algorithm", "n", "r", "p", "salt"}
+    skv = SecretKV(repository, Crypto())
+    assert secretkv.set(skv, "key1", "val1", password).status == Status.Ok
+    assert secretkv.get(SecretKV(repository, Crypto()), "key1", password).data == {"values": ["val1"]}
+    legacy = Crypto()
+    legacy.configure(password)
+    assert not SecretKV(repository, legacy).verify_password()
+
+
+def test_init_with_target(password, monkeypatch):
+    monkeypatch.setattr("secretkv.crypto._time_kdf", lambda kdf: kdf["iterations"] / 1000)
+    repository = InMemoryRepository()
+
+    result = secretkv.init(SecretKV(repository, Crypto()), password, target_ms=150)
+
+    assert result.data["kdf"] == ["algorithm: pbkdf2", "iterations: 150000"]
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_init_vault_with_secrets(skv, password):
+    result = secretkv.init(skv, password)
+
+    assert result.status == Status.Err and result.data == {"message": ["Vault already has secrets, use skv rekey"]}
+    assert skv.kdf_params() is None
+
+
+def test_restore_ciphertext_into_new_vault(password, tmp_path):
+    repository = InMemoryRepository()
+    secretkv.init(SecretKV(repository, Crypto()), password, kdf="scrypt")
+    secretkv.set(SecretKV(repository, Crypto()), "key1", "val1", password)
+    secretkv.dump(SecretKV(repository, Crypto()), password, output=str(tmp_path / "dump"))
+    restored = InMemoryRepository()
+
+    result = secretkv.restore(SecretKV(restored, Crypto()), password, str(tmp_path / "dump"))
+
+    assert json.loads((tmp_path / "dump").read_text().splitlines()[0])["kdf"] == repository.get_meta("kdf")
+    assert result.status == Status.Ok
+    assert restored.get_meta("kdf") == repository.get_meta("kdf")
+    assert secretkv.get(SecretKV(restored, Crypto()), "key1", password).data == {"values": ["val1"]}
+
+
+def test_rekey_keeps_kdf(password, tmp_path):
+    repository = InMemoryRepository()
+    secretkv.init(SecretKV(repository, Crypto()), password, kdf="scrypt")
+    kdf = repository.get_meta("kdf")
+
+    assert secretkv.rekey(SecretKV(repository, Crypto()), password, "abcdef", str(tmp_path)).status == Status.Ok
+    assert repository.get_meta("kdf") == kdf
+    assert secretkv.list(SecretKV(repository, Crypto()), "abcdef").status == Status.Ok
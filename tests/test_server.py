@@ -0,0 +1,170 @@
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from secretkv import keyagent, server
+from secretkv.cli import Command
+from secretkv.server import Server
+from secretkv.utils import Status
+
+REPOSITORIES = [
+    "in_memory_repository",
+    "file_repository",
+    "log_repository",
+    "sqlite_repository",
+]
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / "server.sock")
+
+
+@pytest.fixture
+def running_server(crypto, in_memory_repository, socket_path):
+    from secretkv.application import SecretKV
+
+    instance = Server(SecretKV(in_memory_repository, crypto), socket_path)
+    thread = threading.Thread(target=instance.serve)
+    thread.start()
+    while server.request("ping", {}, socket_path) is None:
+        pass
+    yield instance
+    instance.shutdown()
+    thread.join()
+
+
+@pytest.mark.parametrize("skv", REPOSITORIES, indirect=True)
+def test_dispatch(skv):
+    instance = Server(skv)
+
+    assert instance.dispatch({"op": "get", "args": {"key": "key1"}}) == {"ok": True, "data": {"values": ["val1b"]}}
+    assert instance.dispatch({"op": "get", "args": {"key": "key1", "history": True}}) == {
+        "ok": True,
+        "data": {"values": ["val1b", "val1a"]},
+    }
+    assert instance.dispatch({"op": "list", "args": {}}) == {"ok": True, "data": {"keys": ["key1", "key2"]}}
+    assert instance.dispatch({"op": "set", "args": {"key": "key3", "val": "val3"}}) == {"ok": True, "data": {}}
+    assert instance.dispatch({"op": "delete", "args": {"key": "key2"}}) == {"ok": True, "data": {}}
+    assert instance.dispatch({"op": "list", "args": {"all": True}}) == {
+        "ok": True,
+        "data": {"keys": ["key0", "key1", "key2", "key3"]},
+    }
+    assert instance.dispatch({"op": "list", "args": {"all": True, "prefix": "key", "glob": "*[02]"}}) == {
+        "ok": True,
+        "data": {"keys": ["key0", "key2"]},
+    }
+
+
+@pytest.mark.parametrize(
+    "request_",
+    [
+        None,
+        {"op": "nope"},
+        {"op": "get", "args": []},
+        {"op": "get", "args": {"key": "key0"}},
+        {"op": "get", "args": {"key": "key1", "nope": 1}},
+        {"op": "set", "args": {"key": "key3", "val": ""}},
+        {"op": "delete", "args": {"key": "missing"}},
+        {"op": "list", "args": {"prefix": 1}},
+    ],
+)
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_dispatch_rejects(skv, request_):
+    assert Server(skv).dispatch(request_) == {"ok": False, "data": {}}
+
+
+@pytest.mark.parametrize("skv", ["in_memory_repository"], indirect=True)
+def test_dispatch_reports_failing_store(skv, monkeypatch):
+    def fail(key):
+        raise OSError("store unavailable")
+
+    monkeypatch.setattr(skv.repository, "retrieve_by_key", fail)
+    instance = Server(skv)
+
+    assert instance.dispatch({"op": "get", "args": {"key": "key1"}}) == {"ok": False, "data": {}}
+    assert instance.dispatch({"op": "get", "args": {"key": 1}}) == {"ok": False, "data": {}}
+
+
+@pytest.mark.skipif(not keyagent.is_supported(), reason="requires unix domain sockets")
+def test_request_round_trip(running_server, socket_path, tmp_path):
+    assert (tmp_path / "server.sock").stat().st_mode & 0o777 == 0o600
+    assert server.request("set", {"key": "key3", "val": "val3"}, socket_path) == {"ok": True, "data": {}}
+    assert server.request("get", {"key": "key3"}, socket_path) == {"ok": True, "data": {"values": ["val3"]}}
+
+
+@pytest.mark.skipif(not keyagent.is_supported(), reason="requires unix domain sockets")
+def test_concurrent_clients(running_server, socket_path):
+    results = []
+
+    def client():
+        results.append(server.request("get", {"key": "key1"}, socket_path))
+
+    threads = [threading.Thread(target=client) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{"ok": True, "data": {"values": ["val1b"]}}] * 16
+
+
+@pytest.mark.skipif(not keyagent.is_supported(), reason="requires unix domain sockets")
+def test_serve_refuses_second_server(running_server, crypto, in_memory_repository, socket_path):
+    from secretkv.application import SecretKV
+
+    with pytest.raises(server.ServerUnavailableException):
+        Server(SecretKV(in_memory_repository, crypto), socket_path).serve()
+
+
+def test_request_without_server(socket_path):
+    assert server.request("ping", {}, socket_path) is None
+
+
+@pytest.mark.skipif(not keyagent.is_supported(), reason="requires unix domain sockets")
+def test_request_waits_for_slow_reply(running_server, socket_path, monkeypatch):
+    dispatch = running_server.dispatch
+    monkeypatch.setattr(running_server, "dispatch", lambda request: time.sleep(0.3) or dispatch(request))
+
+    assert server.request("get", {"key": "key1"}, socket_path, timeout=0.1) == {
+        "ok": True,
+        "data": {"values": ["val1b"]},
+    }
+
+
+@pytest.mark.skipif(not keyagent.is_supported(), reason="requires unix domain sockets")
+def test_request_fails_when_server_drops_connection(socket_path):
+    listener = keyagent.listen(Path(socket_path))
+
+    def drop():
+        conn, _ = listener.accept()
+        conn.makefile("r").readline()
+        conn.close()
+
+    thread = threading.Thread(target=drop)
+    thread.start()
+    try:
+        assert server.request("set", {"key": "key3", "val": "val3"}, socket_path) == {"ok": False, "data": {}}
+    finally:
+        thread.join()
+        listener.close()
+
+
+def test_command_forwards_to_server(monkeypatch):
+    requests = []
+    monkeypatch.setattr(server, "request", lambda op, args: requests.append((op, args)) or {"ok": True, "data": {}})
+
+    response = Command("get", {"key": "key1", "history": False, "masterpass": None}).forward()
+
+    assert response.status == Status.Ok
+    assert requests == [("get", {"key": "key1", "history": False})]
+
+
+def test_command_skips_server(monkeypatch):
+    monkeypatch.setattr(server, "request", lambda op, args: None)
+
+    assert Command("get", {"key": "key1", "masterpass": None}).forward() is None
+    assert Command("get", {"key": "key1", "masterpass": "pass"}).forward() is None
+    assert Command("dump", {"masterpass": None}).forward() is None
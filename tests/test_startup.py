@@ -0,0 +1,93 @@
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+import pytest
+
+from secretkv import benchmark
+from secretkv.cli import Cli, Command
+from secretkv.utils import Result, Status
+
+# What `skv --help` imported before it deferred cryptography and the storage backends.
+EAGER_MODULES = ["secretkv.main", "secretkv.infrastructure", "secretkv.benchmark"]
+# Measured against the eager imports on the same machine, so a slow runner
+# doesn't fail it; the lazy import takes about half as long.
+IMPORT_BUDGET = 0.75
+HEAVY_MODULES = ["cryptography", "sqlite3", "concurrent.futures", "secretkv.application", "secretkv.benchmark"]
+
+
+def import_times(code):
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_help_does_not_import_heavy_modules():
+    times = import_times(
+        "import contextlib, io; from secretkv.main import main\n"
+        "with contextlib.redirect_stdout(io.StringIO()), contextlib.suppress(SystemExit): main(['--help'])"
+    )
+
+    assert "secretkv.main" in times
+    assert not [name for name in times if name.split(".")[0] in HEAVY_MODULES or name in HEAVY_MODULES]
+
+
+def test_help_import_time_within_budget():
+    lazy = import_times("import secretkv.main")["secretkv.main"]
+    eager = import_times(f"import {', '.join(EAGER_MODULES)}")
+
+    assert lazy < IMPORT_BUDGET * sum(eager.get(name, 0) for name in EAGER_MODULES)
+
+
+def test_parse_only_adds_arguments_for_selected_command():
+    cli = Cli(ArgumentParser(prog="skv"))
+
+    command = cli.parse(["get", "key1", "-p", "pass"])
+
+    assert command.func_name == "get"
+    assert command.kwargs == {"key": "key1", "history": False, "masterpass": "pass"}
+    assert [action.dest for action in cli._subcommands["set"]._actions] == ["help"]
+
+
+def test_parse_list_filters():
+    command = Cli(ArgumentParser(prog="skv")).parse(["list", "--prefix", "prod/", "--glob", "*/db/*"])
+
+    assert command.kwargs == {"all": False, "prefix": "prod/", "glob": "*/db/*", "masterpass": None}
+
+
+def test_parse_skips_global_option_values():
+    command = Cli(ArgumentParser(prog="skv")).parse(["--timings-file", "list", "get", "foo", "-p", "pw"])
+
+    assert command.func_name == "get"
+    assert command.kwargs == {"key": "foo", "history": False, "masterpass": "pw"}
+    assert command.timings == "list"
+
+
+def test_parse_rejects_unknown_arguments():
+    with pytest.raises(SystemExit):
+        Cli(ArgumentParser(prog="skv")).parse(["list", "--nope"])
+
+
+def test_bench_choices_match_benchmark_repositories():
+    cli = Cli(ArgumentParser(prog="skv"))
+    cli.parse(["bench"])
+
+    (repositories,) = [action for action in cli._subcommands["bench"]._actions if action.dest == "repositories"]
+    assert sorted(repositories.choices) == sorted(benchmark.REPOSITORIES)
+
+
+def test_output_shows_error_message():
+    assert Command.output(Result(Status.Err, {"message": ["Vault already has secrets"]})) == {
+        "message": ["Vault already has secrets"]
+    }
+    assert Command.output(Result(Status.Err, {})) == {"message": ["Something went wrong!"]}
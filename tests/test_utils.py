@@ -0,0 +1,111 @@
+import json
+import threading
+
+from secretkv.utils import PersistentDict, ReadWriteLock, TTLCache, chunked
+
+
+def test_persistent_dict_writes_through(tmp_path):
+    path = tmp_path / "dict.json"
+    dct = PersistentDict(file=str(path))
+    dct["a"] = 1
+
+    assert json.loads(path.read_text()) == {"a": 1}
+
+
+def test_persistent_dict_parses_once(tmp_path, monkeypatch):
+    path = tmp_path / "dict.json"
+    dct = PersistentDict(file=str(path))
+    dct["a"] = 1
+
+    loads = []
+    monkeypatch.setattr(json, "loads", lambda s: loads.append(s) or {})
+    assert dct["a"] == 1 and len(dct) == 1 and list(dct) == ["a"]
+    assert loads == []
+
+
+def test_persistent_dict_writes_back_once(tmp_path, monkeypatch):
+    path = tmp_path / "dict.json"
+    dct = PersistentDict(file=str(path))
+
+    dumps = []
+    original = json.dumps
+    monkeypatch.setattr(json, "dumps", lambda o: dumps.append(o) or original(o))
+    with dct:
+        for i in range(100):
+            dct[str(i)] = i
+        assert json.loads(path.read_text()) == {}
+
+    assert len(dumps) == 1
+    assert len(json.loads(path.read_text())) == 100
+
+
+def test_persistent_dict_reloads_on_external_change(tmp_path):
+    path = tmp_path / "dict.json"
+    dct = PersistentDict(file=str(path))
+    dct["a"] = 1
+
+    path.write_text(json.dumps({"a": 1, "bb": 2}))
+
+    assert dct["bb"] == 2
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") is None and cache.get("a") == 1 and cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_ttl_cache_expires_entries():
+    now = [0.0]
+    cache = TTLCache(ttl=10, clock=lambda: now[0])
+    cache.put("a", 1)
+    now[0] = 9.9
+    assert cache.get("a") == 1
+    now[0] = 10
+    assert cache.get("a") is None and len(cache) == 0
+
+
+def test_ttl_cache_is_shared_between_threads():
+    cache = TTLCache(max_size=8)
+
+    def use(offset):
+        for i in range(2000):
+            cache.put((offset + i) % 16, i)
+            cache.get((offset + i + 1) % 16)
+            cache.invalidate((offset + i + 2) % 16)
+
+    threads = [threading.Thread(target=use, args=(offset,)) for offset in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache.hits + cache.misses == 8 * 2000
+    assert len(cache) <= 8
+
+
+def test_read_write_lock_shares_reads_and_serializes_writes():
+    lock = ReadWriteLock()
+    events = []
+
+    def write():
+        with lock.write():
+            events.append("write")
+
+    with lock.read(), lock.read():
+        writer = threading.Thread(target=write)
+        writer.start()
+        writer.join(0.05)
+        assert events == []
+
+    writer.join()
+    assert events == ["write"]